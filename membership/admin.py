@@ -1,6 +1,7 @@
 from django.contrib import admin
 from membership.models import Membership, Contact, Fee, BillingCycle, Bill,\
-    Payment
+    Payment, QueuedEmail, BillingRun, PaymentImport, PaymentImportJob, ArchivedBillingCycle, ArchivedBill, \
+    ArchivedPayment
 
 
 class ContactAdmin(admin.ModelAdmin):
@@ -24,9 +25,33 @@ class MembershipAdmin(admin.ModelAdmin):
         qs = Membership.search(search_term)
         return qs, False
 
+class ArchivedAdmin(admin.ModelAdmin):
+    """Archived billing history can be viewed but not changed"""
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_actions(self, request):
+        actions = super(ArchivedAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
 admin.site.register(Membership, MembershipAdmin)
 admin.site.register(Contact, ContactAdmin)
 admin.site.register(Fee)
 admin.site.register(BillingCycle)
 admin.site.register(Bill)
 admin.site.register(Payment)
+admin.site.register(QueuedEmail)
+admin.site.register(BillingRun)
+admin.site.register(PaymentImport)
+admin.site.register(PaymentImportJob)
+admin.site.register(ArchivedBillingCycle, ArchivedAdmin)
+admin.site.register(ArchivedBill, ArchivedAdmin)
+admin.site.register(ArchivedPayment, ArchivedAdmin)
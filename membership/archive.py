@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Moves closed billing history out of the active tables.
+
+A billing cycle is closed when it is paid, or when its membership is
+dissociated or deleted. Closed cycles that ended more than the given
+number of years ago are copied with their bills, cancellations, payments
+and admin log entries into the archive tables and then deleted from the
+active ones, one batch per transaction. The latest cycle of an active
+membership is never archived, since new cycles continue from it.
+"""
+
+from datetime import datetime, timedelta
+import logging
+
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Prefetch, Q, TextField
+from django.db.models.functions import Cast
+
+from membership.models import (ArchivedBill, ArchivedBillingCycle, ArchivedCancelledBill, ArchivedLogEntry,
+                               ArchivedPayment, Bill, BillingCycle, CancelledBill, Payment,
+                               STATUS_DELETED, STATUS_DISASSOCIATED)
+
+logger = logging.getLogger("membership.archive")
+
+DEFAULT_YEARS = 7
+BATCH_SIZE = 500
+
+
+def archivable_cycles(years=DEFAULT_YEARS):
+    """Closed cycles that ended more than years ago, in id order"""
+    cutoff = datetime.now() - timedelta(days=365 * years)
+    newer_cycles = BillingCycle.objects.filter(membership=OuterRef('membership'),
+                                               start__gt=OuterRef('start'))
+    return (BillingCycle.objects.filter(end__lt=cutoff)
+            .filter(Q(is_paid=True) |
+                    Q(membership__status__in=[STATUS_DISASSOCIATED, STATUS_DELETED]))
+            # Unexported cancellations are still needed by the procountor export
+            .exclude(bill__cancelledbill__exported=False)
+            .annotate(has_newer=Exists(newer_cycles))
+            .filter(Q(has_newer=True) |
+                    Q(membership__status__in=[STATUS_DISASSOCIATED, STATUS_DELETED]))
+            .order_by('id'))
+
+
+def _copy(queryset, archive_model):
+    """Inserts the rows of queryset into archive_model, which has the same
+    columns. Returns the number of rows."""
+    columns = [field.attname for field in archive_model._meta.concrete_fields]
+    rows = [archive_model(**values) for values in queryset.order_by().values(*columns)]
+    archive_model.objects.bulk_create(rows)
+    return len(rows)
+
+
+def archive_cycles(cycle_ids):
+    """
+    Moves the cycles with their bills, cancellations, payments and log
+    entries to the archive tables. Returns a dict of moved row counts.
+    """
+    cycles = BillingCycle.objects.filter(id__in=cycle_ids)
+    bills = Bill.objects.filter(billingcycle__in=cycle_ids)
+    cancelled_bills = CancelledBill.objects.filter(bill__billingcycle__in=cycle_ids)
+    payments = Payment.objects.filter(billingcycle__in=cycle_ids)
+
+    # LogEntry.object_id is text
+    log_filter = Q(pk__in=[])
+    for queryset in (cycles, bills, cancelled_bills, payments):
+        object_ids = queryset.order_by().annotate(object_id=Cast('id', TextField())).values('object_id')
+        log_filter |= Q(content_type=ContentType.objects.get_for_model(queryset.model),
+                        object_id__in=object_ids)
+    logentries = LogEntry.objects.filter(log_filter)
+
+    with transaction.atomic():
+        counts = {
+            'cycles': _copy(cycles, ArchivedBillingCycle),
+            'bills': _copy(bills, ArchivedBill),
+            'cancelled_bills': _copy(cancelled_bills, ArchivedCancelledBill),
+            'payments': _copy(payments, ArchivedPayment),
+            'logentries': _copy(logentries, ArchivedLogEntry),
+        }
+        logentries.delete()
+        payments.delete()
+        cancelled_bills.delete()
+        # The cycles of the bills are deleted next
+        Bill.bulk_delete(bills, update_reminder_stages=False)
+        cycles.delete()
+    return counts
+
+
+def archive_billing(years=DEFAULT_YEARS, batch_size=BATCH_SIZE, dry_run=False):
+    """
+    Archives all archivable_cycles(years) in batches. Returns a dict of
+    moved row counts, with dry_run only the number of cycles.
+    """
+    if dry_run:
+        return {'cycles': archivable_cycles(years).count()}
+    totals = dict.fromkeys(['cycles', 'bills', 'cancelled_bills', 'payments', 'logentries'], 0)
+    while True:
+        cycle_ids = list(archivable_cycles(years).values_list('id', flat=True)[:batch_size])
+        if not cycle_ids:
+            break
+        counts = archive_cycles(cycle_ids)
+        for key, value in counts.items():
+            totals[key] += value
+        logger.info("Archived %(cycles)d billing cycles, %(bills)d bills and %(payments)d payments" % counts)
+    return totals
+
+
+def archived_cycles(membership):
+    """
+    Archived cycles of membership in the shape of Membership.dossier()
+    cycles, with bills and payments lists and a cancelled flag.
+    """
+    cycles = list(ArchivedBillingCycle.objects.filter(membership=membership)
+                  .order_by('start', 'id').prefetch_related(
+                      Prefetch('archivedbill_set', to_attr='bills',
+                               queryset=ArchivedBill.objects.select_related('archivedcancelledbill')
+                               .order_by('id')),
+                      Prefetch('archivedpayment_set', to_attr='payments',
+                               queryset=ArchivedPayment.objects.order_by('payment_day', 'id'))))
+    for cycle in cycles:
+        bills = sorted(cycle.bills, key=lambda bill: bill.due_date)
+        cycle.cancelled = bool(bills) and bills[0].is_cancelled()
+    return cycles
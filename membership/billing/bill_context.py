@@ -0,0 +1,152 @@
+# encoding: utf-8
+
+"""
+Derived billing values shared by the email text, PDF and Procountor outputs.
+
+The values are computed once per bill. The batch functions share the fee,
+payment and contact lookups between all the bills of a billing run.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Sum, prefetch_related_objects
+
+from membership.models import Bill, Fee, Payment
+from membership.reference_numbers import barcode_4
+
+CONTACT_FIELDS = ['person', 'organization', 'billing_contact']
+
+
+class FeeTable(object):
+    """In-memory replacement for BillingCycle.get_fee() and get_vat_percentage()"""
+
+    def __init__(self, fees=None):
+        if fees is None:
+            fees = Fee.objects.order_by('start', 'id')
+        self._fees = defaultdict(list)
+        for fee in fees:
+            self._fees[fee.type].append(fee)
+
+    def fee_for(self, cycle):
+        """The latest fee valid at the start of the cycle"""
+        valid = [fee for fee in self._fees[cycle.membership.type] if fee.start <= cycle.start]
+        if not valid:
+            raise Fee.DoesNotExist("No fee for type %s at %s" % (cycle.membership.type, cycle.start))
+        return valid[-1]
+
+
+def bill_context(bill, reminder=None, payments=None):
+    """Context for a single bill, see bill_contexts()"""
+    return bill_contexts([bill], reminder=reminder, payments=payments)[0]
+
+
+def bill_contexts(bills, reminder=None, payments=None):
+    """
+    Contexts for bills. By default a bill is handled as a reminder if it is
+    one; reminder=True/False forces the type, e.g. for the PDF templates.
+    """
+    bills = list(bills)
+    prefetch_related_objects(bills, 'billingcycle__membership')
+    _prefetch_contacts([bill.billingcycle.membership for bill in bills])
+    return _build_contexts([(bill.billingcycle, bill) for bill in bills], reminder, payments)
+
+
+def cycle_contexts(cycles, reminder=None, payments=None):
+    """
+    Contexts for billing cycles without a specific bill. The first bill of
+    the cycle is referred to, if there is one.
+    """
+    cycles = list(cycles)
+    prefetch_related_objects(cycles, 'membership')
+    _prefetch_contacts([cycle.membership for cycle in cycles])
+    return _build_contexts([(cycle, None) for cycle in cycles], reminder, payments)
+
+
+def _prefetch_contacts(memberships):
+    # Prefetching a relation that is empty on every object would still
+    # cost a query
+    for field in CONTACT_FIELDS:
+        related = [m for m in memberships if getattr(m, field + '_id') is not None]
+        if related:
+            prefetch_related_objects(related, field)
+
+
+def _build_contexts(pairs, reminder, payments):
+    """
+    :param pairs: list of (billingcycle, bill or None)
+    :param payments: Payment class; the latest recorded payment date is
+                     looked up for reminders only when given
+    """
+    if not pairs:
+        return []
+    fees = FeeTable()
+    now = datetime.now()
+
+    def is_reminder(bill):
+        if reminder is not None:
+            return reminder
+        return bill is not None and bill.is_reminder()
+
+    reminder_cycle_ids = set(cycle.id for cycle, bill in pairs if is_reminder(bill))
+    amounts_paid = {}
+    latest_payment_date = None
+    if reminder_cycle_ids:
+        amounts_paid = dict(Payment.objects.filter(billingcycle__in=reminder_cycle_ids)
+                            .order_by().values_list('billingcycle').annotate(Sum('amount')))
+        if payments is not None:
+            latest_payment_date = payments.latest_payment_date()
+
+    first_bill_ids = {}
+    billless_cycle_ids = [cycle.id for cycle, bill in pairs if bill is None]
+    if billless_cycle_ids:
+        first_bills = (Bill.objects.filter(billingcycle__in=billless_cycle_ids)
+                       .order_by('-due_date', '-id').values_list('billingcycle', 'id'))
+        # Later rows are earlier bills and overwrite the later ones
+        first_bill_ids = dict(first_bills)
+
+    contexts = []
+    for cycle, bill in pairs:
+        membership = cycle.membership
+        fee = fees.fee_for(cycle)
+        vat = Decimal(fee.vat_percentage) / Decimal(100)
+        context = {
+            'cycle': cycle,
+            'bill': bill,
+            'membership': membership,
+            'billing_contact': membership.get_billing_contact(),
+            'name': membership.name(),
+            'member_id': membership.id,
+            'reminder': is_reminder(bill),
+            'fee': fee.sum,
+            'vat_percentage': fee.vat_percentage,
+            'vat': vat,
+            'original_sum': cycle.sum,
+            'cycle_non_vat_amount': cycle.sum / (Decimal(1) + vat),
+            'reference_number': cycle.reference_number,
+            'bill_id': bill.id if bill else first_bill_ids.get(cycle.id),
+            'date': bill.created if bill else now,
+        }
+        if context['reminder']:
+            context['amount_paid'] = amounts_paid.get(cycle.id) or Decimal('0')
+            context['sum'] = cycle.sum - context['amount_paid']
+            context['due_date'] = None
+            context['latest_payment_date'] = latest_payment_date
+        else:
+            context['amount_paid'] = Decimal('0')
+            context['sum'] = cycle.sum
+            if bill:
+                context['due_date'] = bill.due_date
+            else:
+                context['due_date'] = now + timedelta(days=settings.BILL_DAYS_TO_DUE)
+            context['latest_payment_date'] = None
+        context['non_vat_amount'] = context['sum'] / (Decimal(1) + vat)
+        context['vat_amount'] = vat * context['non_vat_amount']
+        context['barcode'] = barcode_4(iban=settings.IBAN_ACCOUNT_NUMBER,
+                                       refnum=cycle.reference_number,
+                                       duedate=context['due_date'],
+                                       euros=context['sum'])
+        contexts.append(context)
+    return contexts
@@ -4,14 +4,13 @@
 Code to make pdf bills and reminders
 """
 
-from membership.reference_numbers import barcode_4
+from membership.billing.bill_context import bill_context, cycle_contexts
 from membership.utils import group_iban, group_reference
 
 from django.conf import settings
 
 import os
-from decimal import Decimal
-from datetime import datetime, timedelta
+from datetime import datetime
 
 
 from reportlab.pdfgen import canvas
@@ -27,25 +26,37 @@ import locale
 
 PROJECT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..//'))
 
-pdfmetrics.registerFont(TTFont('IstokWeb', os.path.join(settings.FONT_PATH, 'IstokWeb-Regular.ttf')))
-pdfmetrics.registerFont(TTFont('IstokWeb-Bold', os.path.join(settings.FONT_PATH, 'IstokWeb-Bold.ttf')))
+_fonts_registered = False
+
+def register_fonts():
+    """Parses and registers the TrueType fonts on first use only, as it is
+    slow and most processes never render a PDF."""
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    pdfmetrics.registerFont(TTFont('IstokWeb', os.path.join(settings.FONT_PATH, 'IstokWeb-Regular.ttf')))
+    pdfmetrics.registerFont(TTFont('IstokWeb-Bold', os.path.join(settings.FONT_PATH, 'IstokWeb-Bold.ttf')))
+    _fonts_registered = True
 
 LOGO = os.path.join(settings.IMG_PATH, 'kapsi-logo.jpg')
 
 # Unit is centimeter from left upper corner of page
 
-# TODO: Unittests for pdf
 
 def get_billing_email():
     return emailutils.parseaddr(settings.BILLING_FROM_EMAIL)[1]
 
 class PDFTemplate(object):
     __type__ = 'invoice'
+    # Line item column positions
+    xtable = [1,1.5,7,12,13.5,15,17]
+
     def __init__(self, filename, cycle=None):
         """
         :param filename: Filename or file-like object
         :param cycle: optional billingcycle object
         """
+        register_fonts()
         self._dpi = 300.0
         self._scale = float(self._dpi/72.0)
         self.size = (self.scale(A4[0], False), self.scale(A4[1], False))
@@ -67,27 +78,41 @@ class PDFTemplate(object):
 
     def reset(self):
         self.c = canvas.Canvas(self._filename, pagesize=A4,
-                               bottomup = 1)
-
-    def addCycle(self, cycle, payments=None):
+                               bottomup = 1, pageCompression=1)
+        self._static_form = None
+
+    def _drawStatic(self):
+        """Draws the static part of the page from a form XObject that is
+        recorded on first use and shared by all pages of the document."""
+        if self._static_form is None:
+            self._static_form = "static_%s" % self.__type__
+            self.c.beginForm(self._static_form, upperx=self.size[0], uppery=self.size[1])
+            self.addStaticTemplate()
+            self.addStaticContent()
+            self.c.endForm()
+        self.c.doForm(self._static_form)
+
+    def _addPage(self):
         self.c.scale(72.0/self._dpi, 72.0/self._dpi)
-        self.createData(cycle, payments=payments)
+        self._drawStatic()
         self.addTemplate()
         self.addContent()
         self.c.showPage()
         self.page_count += 1
 
-    def addBill(self, bill, payments=None):
-        self.c.scale(72.0/self._dpi, 72.0/self._dpi)
-        self.createData(cycle=bill.billingcycle, bill=bill, payments=payments)
-        self.addTemplate()
-        self.addContent()
-        self.c.showPage()
-        self.page_count += 1
+    def addCycle(self, cycle, payments=None, context=None):
+        self.createData(cycle, payments=payments, context=context)
+        self._addPage()
+
+    def addBill(self, bill, payments=None, context=None):
+        self.createData(cycle=bill.billingcycle, bill=bill, payments=payments, context=context)
+        self._addPage()
 
     def addCycles(self, cycles, payments=None):
-        for cycle in cycles:
-            self.addCycle(cycle, payments=payments)
+        # Fees, payments and contacts are looked up once for all the pages
+        contexts = cycle_contexts(cycles, reminder=self.__type__ == 'reminder', payments=payments)
+        for context in contexts:
+            self.addCycle(context['cycle'], payments=payments, context=context)
 
     def real_y(self, y):
         y = self.scale(y)
@@ -211,28 +236,25 @@ class PDFTemplate(object):
             self._add_text(line, textobject, font, size)
         self.c.drawText(textobject)
 
-    def createData(self, cycle, bill=None, payments=None):
+    def createData(self, cycle, bill=None, payments=None, context=None):
+        """
+        :param context: precomputed bill context, see membership.billing.bill_context
+        """
         # TODO: use Django SHORT_DATE_FORMAT
-        membercontact = cycle.membership.get_billing_contact()
-
-        # Calculate vat; copied from models.Bill#render_as_text(self)
-        vat = Decimal(cycle.get_vat_percentage()) / Decimal(100)
-        if self.__type__ == 'reminder':
-            amount_paid = cycle.amount_paid()
-            sum = cycle.sum - amount_paid
-            non_vat_amount = sum / (Decimal(1) + vat)
-        else:
-            sum = cycle.sum
-            non_vat_amount = (cycle.sum / (Decimal(1) + vat))
+        if context is None:
+            if bill:
+                context = bill_context(bill, reminder=self.__type__ == 'reminder', payments=payments)
+            else:
+                context = cycle_contexts([cycle], reminder=self.__type__ == 'reminder',
+                                         payments=payments)[0]
+        membercontact = context['billing_contact']
+        vat = context['vat']
 
         # Select due date
         if self.__type__ == 'reminder':
             due_date = u"HETI"
-        elif bill:
-            due_date = bill.due_date.strftime("%d.%m.%Y")
         else:
-            due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
-            due_date = due_date.strftime("%d.%m.%Y")
+            due_date = context['due_date'].strftime("%d.%m.%Y")
 
         lineitems = []
         # ['1', 'Jäsenmaksu', '04.05.2010 - 04.05.2011', '32.74 €','7.26 €','40.00 €']
@@ -241,11 +263,12 @@ class PDFTemplate(object):
         lineitems.append(["1",
                       u"Jäsenmaksu",
                       u"%s - %s" % (cycle_start_date, cycle_end_date),
-                      u"%s €" % locale.format("%.2f", cycle.sum / (Decimal(1) + vat)),
-                      u"%s %%" % locale.format("%d", cycle.get_vat_percentage()),
-                      u"%s €" % locale.format("%.2f", vat * non_vat_amount),
+                      u"%s €" % locale.format("%.2f", context['cycle_non_vat_amount']),
+                      u"%s %%" % locale.format("%d", context['vat_percentage']),
+                      u"%s €" % locale.format("%.2f", context['vat_amount']),
                       u"%s €" % locale.format("%.2f", cycle.sum)])
         # Note any payments attached
+        amount_paid = context['amount_paid']
         if self.__type__ == 'reminder' and amount_paid > 0:
             lineitems.append([
                 "2",
@@ -257,60 +280,45 @@ class PDFTemplate(object):
                 "%s €" % locale.format("%.2f", -amount_paid),  # total amount
                 ])
 
-        first_bill = cycle.first_bill()
-        if bill:
-            bill_id = bill.id
-        elif first_bill:
-            bill_id = first_bill.id
-        else:
-            bill_id = None
-        if bill:
-            date = bill.created
-        else:
-            date = datetime.now()
         if payments:
-            latest_payment_date = payments.latest_payment_date()
+            latest_payment_date = context['latest_payment_date']
             if latest_payment_date:
-                latest_payments = min([payments.latest_payment_date(), datetime.now()])
+                latest_payments = min([latest_payment_date, datetime.now()])
             else:
                 latest_payments = datetime(year=2003,month=1, day=1)
         else:
             latest_payments = datetime.now()
-        self.data = {'name': cycle.membership.name(),
+        sum = context['sum']
+        self.data = {'name': context['name'],
                 'address': membercontact.street_address,
                 'postal_code':membercontact.postal_code,
                 'postal_office':membercontact.post_office,
-                'date': date.strftime("%d.%m.%Y"),
+                'date': context['date'].strftime("%d.%m.%Y"),
                 'latest_payment_date': latest_payments.strftime('%d.%m.%Y'),
-                'member_id': cycle.membership.id,
+                'member_id': context['member_id'],
                 'due_date': due_date,
                 'email': membercontact.email,
-                'bill_id': bill_id,
+                'bill_id': context['bill_id'],
                 'vat': vat,
                 'sum': sum,
                 'pretty_sum': locale.format('%.2f', sum),
                 'notify_period': '%d vrk' % (settings.REMINDER_GRACE_DAYS,),
                 'lineitems': lineitems,
-                'reference_number': group_reference(cycle.reference_number)
+                'reference_number': group_reference(context['reference_number']),
+                'barcode': context['barcode'],
         }
 
-    def addTemplate(self):
+    def addStaticTemplate(self):
+        """Draws the parts of the page that are the same on every page"""
         # Logo to upper left corner
         self.drawImage(0.2, 0, 5, 2.5, LOGO)
-        self.drawString(10.5, 3, u"%(date)s" % self.data, alignment="center", size=12)
         self.drawString(1.5, 3, u"Kapsi Internet-käyttäjät ry, PL 11, 90571 OULU",
                       size=8)
-        # Address block
-        self.drawText(1.5, 4, u"%(name)s\n%(address)s\n%(postal_code)s %(postal_office)s" % self.data, size=12)
         #self.drawHorizontalStroke()
 
         self.drawBox(14.5, 3.5, 5, 1.7)
-        self.drawTable(14.7, 4, [[u'Jäsennumero:', '%(member_id)s' % self.data],
-                              [u'Eräpäivä:', '%(due_date)s' % self.data],
-                              [u'Huomautusaika:','%(notify_period)s' % self.data]
-                              ], size=10)
 
-        xtable = [1,1.5,7,12,13.5,15,17]
+        xtable = self.xtable
         self.drawString(xtable[1],6.5, u"Selite", size=9)
         self.drawString(xtable[2],6.5, u"Aikaväli", size=9)
         self.drawString(xtable[3],6.5, u"ilman alv", size=9)
@@ -319,20 +327,6 @@ class PDFTemplate(object):
         self.drawString(xtable[6],6.5, u"Yhteensä", size=9)
         self.drawHorizontalStroke(1,6.6, 18.5)
 
-        y = 7
-        for line in self.data['lineitems']:
-            for i in range(len(xtable)):
-                self.drawString(xtable[i],y, line[i], size=10)
-            y += 0.4
-
-        y -= 0.3
-        self.drawHorizontalStroke(1,y, 18.5)
-        y += 0.4
-        self.drawString(xtable[3],y, u"Maksettavaa yhteensä:" % self.data, size=10)
-        self.drawString(xtable[6],y, u"<b>%(pretty_sum)s €</b>" % self.data, size=10)
-
-
-
         self.drawHorizontalStroke(1,18, 18.5)
 
         self.drawText(1,18.5, u"<b>Kapsi Internet-käyttäjät ry</b>\nPL 11\n90571 Oulu", size=7)
@@ -365,9 +359,6 @@ class PDFTemplate(object):
         self.drawString(2.4, 23.9, u"namn och", size=6, alignment="right")
         self.drawString(2.4, 24.1, u"adress", size=6, alignment="right")
 
-        self.drawText(3.0, 23.5, u"%(name)s\n%(address)s\n%(postal_code)s %(postal_office)s\n%(email)s" % self.data, size=9)
-
-
         self.drawString(2.4, 25.6, u"Allekirjoitus", size=6, alignment="right")
         #self.drawString(2.3, 25.6, u"", size=6, alignment="right")
         self.drawString(2.4, 25.9, u"Ynderskrift", size=6, alignment="right")
@@ -380,14 +371,8 @@ class PDFTemplate(object):
         self.drawText(3.0,20, u"IBAN", size=7)
 
         self.drawText(11.15,25.6, u"Viitenro\nRef.nr", size=7)
-        self.drawText(13.15,25.7, u"%(reference_number)s" % self.data, size=9)
         self.drawText(11.15,26.5, u"Eräpäivä\nFörf.dag", size=7)
-        self.drawText(13.15,26.65, u"%(due_date)s" % self.data, size=9)
         self.drawText(15.9,26.4, u"Euro", size=7)
-        self.drawText(16.9,26.65, u"%(pretty_sum)s" % self.data, size=9)
-
-
-
 
         # Lines on bottom part
         self.drawHorizontalStroke(1,21, 10, width=6)
@@ -406,13 +391,42 @@ class PDFTemplate(object):
         self.drawText(14, 28.3, u"Betalningen förmedlas till mottagare endast i Finland enligt Allmänna\nvillkor för inrikes betalningsförmedling och endast till det\nkontonummer betalaren angivit.", size=5)
         self.drawText(17.8, 29.1, u"PANKKI BANKEN", size=6)
 
-        due_date = None
-        if self.__type__ != 'reminder':
-            due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
-        barcode_string = barcode_4(settings.IBAN_ACCOUNT_NUMBER, self.data['reference_number'], due_date, self.data['sum'])
-        barcode = code128.Code128(str(barcode_string), barWidth=0.12*cm, barHeight=4.5*cm)
+    def addTemplate(self):
+        """Draws the bill specific parts of the page template"""
+        self.drawString(10.5, 3, u"%(date)s" % self.data, alignment="center", size=12)
+        # Address block
+        self.drawText(1.5, 4, u"%(name)s\n%(address)s\n%(postal_code)s %(postal_office)s" % self.data, size=12)
+
+        self.drawTable(14.7, 4, [[u'Jäsennumero:', '%(member_id)s' % self.data],
+                              [u'Eräpäivä:', '%(due_date)s' % self.data],
+                              [u'Huomautusaika:','%(notify_period)s' % self.data]
+                              ], size=10)
+
+        xtable = self.xtable
+        y = 7
+        for line in self.data['lineitems']:
+            for i in range(len(xtable)):
+                self.drawString(xtable[i],y, line[i], size=10)
+            y += 0.4
+
+        y -= 0.3
+        self.drawHorizontalStroke(1,y, 18.5)
+        y += 0.4
+        self.drawString(xtable[3],y, u"Maksettavaa yhteensä:" % self.data, size=10)
+        self.drawString(xtable[6],y, u"<b>%(pretty_sum)s €</b>" % self.data, size=10)
+
+        self.drawText(3.0, 23.5, u"%(name)s\n%(address)s\n%(postal_code)s %(postal_office)s\n%(email)s" % self.data, size=9)
+
+        self.drawText(13.15,25.7, u"%(reference_number)s" % self.data, size=9)
+        self.drawText(13.15,26.65, u"%(due_date)s" % self.data, size=9)
+        self.drawText(16.9,26.65, u"%(pretty_sum)s" % self.data, size=9)
+
+        barcode = code128.Code128(str(self.data['barcode']), barWidth=0.12*cm, barHeight=4.5*cm)
         barcode.drawOn(self.c, self.real_x(2), self.real_y(28.7))
 
+    def addStaticContent(self):
+        pass
+
     def addContent(self):
         pass
 
@@ -422,7 +436,7 @@ class PDFTemplate(object):
 
 class PDFReminder(PDFTemplate):
     __type__ = 'reminder'
-    def addContent(self):
+    def addStaticContent(self):
         self.drawString(10.5, 2, u"<b>MUISTUTUS</b>", alignment="center")
         self.drawText(1, 10, u"""Hei!
 
@@ -439,13 +453,15 @@ Voit ottaa yhteyttä Kapsin laskutukseen osoitteeseen %s esimerkiksi seuraavissa
 """ % (get_billing_email(),), size=10)
 
         self.drawText(1,16, u"<b>Muistutuksen maksamatta jättäminen johtaa jäsenpalveluiden lukitsemiseen ja erottamiseen yhdistyksestä!</b>", size=10)
+
+    def addContent(self):
         self.drawText(1,17, u"Jos olet jo maksanut muistutuksen, tämä viesti on aiheeton. Olemme huomioineet meille näkyvät jäsenmaksu-\nsuoritukset %(latest_payment_date)s asti." % self.data, size=10)
         if self.data['bill_id']:
             self.drawText(11.5,23.4, u"Muistutus laskulle numero %s" % self.data['bill_id'], size=10)
 
 class PDFInvoice(PDFTemplate):
     __type__ = 'invoice'
-    def addContent(self):
+    def addStaticContent(self):
         self.drawString(10.5, 2, u"<b>LASKU</b>", alignment="center")
         self.drawText(1, 10, u"""
 Voit ottaa yhteyttä Kapsin laskutukseen osoitteeseen %s esimerkiksi seuraavissa tilanteissa:
@@ -455,5 +471,7 @@ Voit ottaa yhteyttä Kapsin laskutukseen osoitteeseen %s esimerkiksi seuraavissa
    - haluat sopia maksuaikataulusta
    - sinulla on muuta kysyttävää jäsenasioista
 """ % (get_billing_email(),), size=10)
+
+    def addContent(self):
         if self.data['bill_id']:
             self.drawText(11.5,23.4, u"Laskunumero %s" % self.data['bill_id'], size=10)
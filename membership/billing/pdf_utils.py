@@ -14,6 +14,14 @@ from membership.billing import pdf
 logger = logging.getLogger("membership.billing.pdf")
 
 
+def warm_up():
+    """
+    Loads ReportLab and the fonts ahead of the first PDF render, e.g. in
+    a pre-forking server master process so that workers share them.
+    """
+    pdf.register_fonts()
+
+
 def create_reminder_pdf(cycles, output_file, payments=None):
     """
     Generate reminder pdf with billing cycles `cycles` to file `output_file`
@@ -32,10 +40,11 @@ def create_reminder_pdf(cycles, output_file, payments=None):
         raise
 
 
-def get_bill_pdf(bill, payments=None):
+def get_bill_pdf(bill, payments=None, context=None):
     """
     Get from pdf_file field or generate pdf for Bill
     :param bill: Bill
+    :param context: precomputed bill context, see membership.billing.bill_context
     :return: pdf file content
     """
 
@@ -54,7 +63,7 @@ def get_bill_pdf(bill, payments=None):
         else:
             p = pdf.PDFInvoice(pdf_fp)
 
-        p.addBill(bill, payments=payments)
+        p.addBill(bill, payments=payments, context=context)
         p.generate()
         pdf_fp.seek(0)
         django_file = File(pdf_fp)
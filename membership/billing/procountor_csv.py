@@ -7,7 +7,9 @@ from StringIO import StringIO
 from decimal import Decimal
 
 from django.conf import settings
+from membership.billing.bill_context import bill_context, bill_contexts
 from membership.models import Bill, CancelledBill
+from membership.pagination import chunked
 
 logger = logging.getLogger("membership.billing.procountor")
 
@@ -26,25 +28,30 @@ def finnish_timeformat(t):
 ft = finnish_timeformat
 
 
-def _bill_to_rows(bill, cancel=False):
+def _bill_to_rows(bill, cancel=False, context=None):
     """Map bills to Procountor CSV format
 
     http://support.procountor.com/fi/aineiston-sisaanluku/laskuaineiston-siirtotiedosto.html
+
+    :param context: precomputed bill context, see membership.billing.bill_context
     """
     rows = []
     c = bill.billingcycle
     if c.membership.type in ['H']:
         return rows
+    if context is None:
+        context = bill_context(bill)
 
     bill_delivery = ProcountorBillDelivery.NO_DELIVERY
 
-    if c.membership.get_billing_contact():
-        billing_address = '%s\%s\%s\%s\%s' % (c.membership.name(),
-                            c.membership.get_billing_contact().street_address,
-                            c.membership.get_billing_contact().postal_code,
-                            c.membership.get_billing_contact().post_office,
+    billing_contact = context['billing_contact']
+    if billing_contact:
+        billing_address = '%s\%s\%s\%s\%s' % (context['name'],
+                            billing_contact.street_address,
+                            billing_contact.postal_code,
+                            billing_contact.post_office,
                             'FI')
-        billing_email = c.membership.get_billing_contact().email
+        billing_email = billing_contact.email
     else:
         billing_email = ""
         billing_address = ""
@@ -61,7 +68,7 @@ def _bill_to_rows(bill, cancel=False):
         settings.IBAN_ACCOUNT_NUMBER,  # pankkitili
         '',  # Y-tunnus/HETU/ALV-tunnus
         'tilisiirto',  # Maksutapa
-        c.membership.name(),  # Liikekumppanin nimi
+        context['name'],  # Liikekumppanin nimi
         '',  # Toimitustapa
         '0',  # Laskun alennus %
         't',  # Sis. alv koodi
@@ -79,8 +86,8 @@ def _bill_to_rows(bill, cancel=False):
         billing_email,  # Sähköpostiosoite
         '',  # Maksupäivämäärä
         '',  # Valuuttakurssi
-        "%.2f" % Decimal.copy_negate(c.get_fee()) if cancel else c.get_fee(),  # Laskun loppusumma
-        "%d" % c.get_vat_percentage(),  # ALV-%
+        "%.2f" % Decimal.copy_negate(context['fee']) if cancel else context['fee'],  # Laskun loppusumma
+        "%d" % context['vat_percentage'],  # ALV-%
         '%d' % bill_delivery,  # Laskukanava
         '',  # Verkkolaskutunnus
         '%d' % bill.id,  # Tilausviite
@@ -107,9 +114,9 @@ def _bill_to_rows(bill, cancel=False):
           '%s%s' % (member_type[0], c.start.strftime("%y")),  # Tuotteen koodi
           '-1' if cancel else '1',  # Määrä
           '',  # Yksikkö
-          '%.2f' % c.get_fee(),  # Yksikköhinta
+          '%.2f' % context['fee'],  # Yksikköhinta
           '0',  # Rivin alennusprosentti
-          "%d" % c.get_vat_percentage(),  # Rivin ALV-%
+          "%d" % context['vat_percentage'],  # Rivin ALV-%
           '',  # Rivikommentti
           '',  # Tilausviite
           '',  # Asiakkaan ostotilausnumero
@@ -122,41 +129,52 @@ def _bill_to_rows(bill, cancel=False):
     return rows
 
 
-def create_csv(start=None, mark_cancelled=True):
+def _encode_row(row):
+    return [v.encode("iso-8859-1") if type(v) == unicode else v for v in row]
+
+
+def write_csv(output_file, start=None, mark_cancelled=True, chunk_size=500):
     """
-    Create procountor bill export csv
-    :return: path to csv file
+    Write procountor bill export csv to output_file. The bills are read
+    and written chunk_size bills at a time.
+    :return: number of rows written
     """
 
     if start is None:
         start = datetime.now()
         start = datetime(year=start.year, month=start.month, day=1)
 
-    filehandle = StringIO()
-    output = csv.writer(filehandle, delimiter=b';', quoting=csv.QUOTE_NONE)
-
-    for bill in Bill.objects.filter(created__gte=start, reminder_count=0).all():
-        for row in _bill_to_rows(bill):
-            row2 = []
-            for v in row:
-                if type(v) == unicode:
-                    row2.append(v.encode("iso-8859-1"))
-                else:
-                    row2.append(v)
-            output.writerow(row2)
+    output = csv.writer(output_file, delimiter=b';', quoting=csv.QUOTE_NONE)
+    row_count = 0
+
+    bills = Bill.objects.filter(created__gte=start, reminder_count=0).order_by('id')
+    for chunk in chunked(bills, chunk_size):
+        for context in bill_contexts(chunk):
+            for row in _bill_to_rows(context['bill'], context=context):
+                output.writerow(_encode_row(row))
+                row_count += 1
 
     cancelled_bills = CancelledBill.objects.filter(exported=False)
-    for cb in cancelled_bills:
-        for row in _bill_to_rows(cb.bill, cancel=True):
-            row2 = []
-            for v in row:
-                if type(v) == unicode:
-                    row2.append(v.encode("iso-8859-1"))
-                else:
-                    row2.append(v)
-            output.writerow(row2)
-    if mark_cancelled:
-        cancelled_bills.update(exported=True)
+    last_cancelled_id = None
+    for chunk in chunked(cancelled_bills.select_related('bill').order_by('id'), chunk_size):
+        for context in bill_contexts(cb.bill for cb in chunk):
+            for row in _bill_to_rows(context['bill'], cancel=True, context=context):
+                output.writerow(_encode_row(row))
+                row_count += 1
+        last_cancelled_id = chunk[-1].id
+    if mark_cancelled and last_cancelled_id is not None:
+        # Bills cancelled during the export are left for the next one
+        cancelled_bills.filter(id__lte=last_cancelled_id).update(exported=True)
         logger.info("Marked all cancelled bills as exported.")
 
+    return row_count
+
+
+def create_csv(start=None, mark_cancelled=True):
+    """
+    Create procountor bill export csv
+    :return: csv content
+    """
+    filehandle = StringIO()
+    write_csv(filehandle, start=start, mark_cancelled=mark_cancelled)
     return filehandle.getvalue()
@@ -30,6 +30,11 @@ def unix_email(membership):
 
 # Signal handlers
 def bill_sender(sender, instance=None, **kwargs):
+    # imported here since on top-level it would lead into a circular import
+    from membership.billing.bill_context import bill_context
+    from models import Payment
+    # The same context is used for the text and the PDF
+    context = bill_context(instance, payments=Payment)
     membership = instance.billingcycle.membership
     to = [membership.billing_email()]
     if instance.is_reminder():
@@ -40,7 +45,7 @@ def bill_sender(sender, instance=None, **kwargs):
             to.append(local_email)
 
     if settings.BILL_ATTACH_PDF:
-        pdf = instance.generate_pdf()
+        pdf = instance.generate_pdf(context=context)
         if instance.is_reminder():
             attachments = [("Kapsi_muistutuslasku_%s.pdf" % instance.billingcycle.reference_number, pdf, "application/pdf")]
         else:
@@ -50,7 +55,7 @@ def bill_sender(sender, instance=None, **kwargs):
 
     if settings.BILLING_CC_EMAIL != None:
         email = EmailMessage(instance.bill_subject(),
-                             instance.render_as_text(),
+                             instance.render_as_text(context=context),
                              settings.BILLING_FROM_EMAIL,
                              to,
                              [settings.BILLING_CC_EMAIL],
@@ -58,7 +63,7 @@ def bill_sender(sender, instance=None, **kwargs):
                              headers={'CC': settings.BILLING_CC_EMAIL})
     else:
         email = EmailMessage(instance.bill_subject(),
-                             instance.render_as_text(),
+                             instance.render_as_text(context=context),
                              settings.BILLING_FROM_EMAIL,
                              to,
                              attachments=attachments)
@@ -69,7 +74,7 @@ def bill_sender(sender, instance=None, **kwargs):
 
 def preapprove_email_sender(sender, instance=None, user=None, **kwargs):
     from services.models import Service
-    from models import MEMBER_TYPES_DICT
+    from models import MEMBER_TYPES_DICT, QueuedEmail
     # imported here since on top-level it would lead into a circular import
     email_body = render_to_string('membership/preapprove_mail.txt', {
         'membership': instance,
@@ -82,9 +87,8 @@ def preapprove_email_sender(sender, instance=None, user=None, **kwargs):
                                   settings.FROM_EMAIL,
                                   [settings.SYSADMIN_EMAIL],
                                   headers = {'Reply-To': instance.email_to()})
-    connection = mail.get_connection()
-    connection.send_messages([sysadmin_email])
-    logger.info(u'A preapprove email sent to %s (%s) by %s' % (unicode(instance),
+    QueuedEmail.enqueue(sysadmin_email)
+    logger.info(u'A preapprove email queued for %s (%s) by %s' % (unicode(instance),
                                                                instance.billing_email(),
                                                                user))
 
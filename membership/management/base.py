@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Shared base for the long running management commands.
+"""
+
+import logging
+import resource
+
+from django.core.management.base import BaseCommand
+
+logger = logging.getLogger("membership.management")
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process (kilobytes on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemoryReportingCommand(BaseCommand):
+    """
+    Logs the peak resident set size of the process when the command
+    finishes. It is also written to stderr with --verbosity 2 or more.
+    """
+
+    def execute(self, *args, **options):
+        try:
+            return super(MemoryReportingCommand, self).execute(*args, **options)
+        finally:
+            message = "Peak RSS of %s: %d kB" % (self.__module__.split('.')[-1], peak_rss_kb())
+            logger.info(message)
+            if options.get('verbosity', 1) >= 2:
+                self.stderr.write(message)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+archive_billing.py
+
+Moves closed billing cycles older than the active years with their bills,
+payments and log entries to the archive tables.
+"""
+
+from django.core.management.base import BaseCommand
+
+from membership.archive import BATCH_SIZE, DEFAULT_YEARS, archive_billing
+
+
+class Command(BaseCommand):
+    help = 'Move old closed billing cycles to the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=DEFAULT_YEARS,
+                            help='Archive cycles that ended more than this many years ago (%d)' % DEFAULT_YEARS)
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Cycles moved per transaction (%d)' % BATCH_SIZE)
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only count the cycles that would be archived')
+
+    def handle(self, *args, **options):
+        counts = archive_billing(years=options['years'], batch_size=options['batch_size'],
+                                 dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write("%(cycles)d billing cycles would be archived" % counts)
+        else:
+            self.stdout.write("Archived %(cycles)d billing cycles, %(bills)d bills, "
+                              "%(cancelled_bills)d cancelled bills, %(payments)d payments "
+                              "and %(logentries)d log entries" % counts)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_billing.py
+
+Builds a large synthetic member database with bulk inserts and times the
+billing pipeline stages on it. Run against an empty scratch database.
+"""
+
+from contextlib import contextmanager
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import json
+import logging
+from random import Random
+import shutil
+import sys
+import tempfile
+import time
+from uuid import UUID
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.backends.utils import CursorWrapper
+from django.test import Client
+from django.test.utils import override_settings
+
+from membership.billing.pdf_utils import get_bill_pdf
+from membership.billing.procountor_csv import create_csv
+from membership.management.base import peak_rss_kb
+from membership.management.commands.csvbills import process_op_csv
+from membership.management.commands.csvtestdata import header_row, row
+from membership.management.commands.makebills import makebills
+from membership.models import Bill, BillingCycle, Contact, Fee, Membership, Payment
+from membership.test_utils import first_names, last_names
+
+logger = logging.getLogger("membership.benchmark_billing")
+
+LIST_VIEWS = [
+    '/membership/memberships/approved/',
+    '/membership/bills/',
+    '/membership/bills/unpaid/',
+    '/membership/payments/',
+    '/membership/payments/unknown/',
+]
+
+
+class CountingCursorWrapper(CursorWrapper):
+    """Counts executed queries without storing them like connection.queries"""
+
+    def __init__(self, cursor, db, counter):
+        super(CountingCursorWrapper, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter[0] += 1
+        return super(CountingCursorWrapper, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter[0] += 1
+        return super(CountingCursorWrapper, self).executemany(sql, param_list)
+
+
+@contextmanager
+def measure(name, results):
+    stage = {'stage': name}
+    counter = [0]
+    old_force_debug_cursor = connection.force_debug_cursor
+    connection.force_debug_cursor = True
+    connection.make_debug_cursor = lambda cursor: CountingCursorWrapper(cursor, connection, counter)
+    rss_before = peak_rss_kb()
+    start = time.time()
+    try:
+        yield stage
+    finally:
+        stage['seconds'] = round(time.time() - start, 3)
+        stage['queries'] = counter[0]
+        stage['peak_rss_kb'] = peak_rss_kb()
+        stage['peak_rss_growth_kb'] = stage['peak_rss_kb'] - rss_before
+        del connection.make_debug_cursor
+        connection.force_debug_cursor = old_force_debug_cursor
+        results.append(stage)
+        logger.info("Benchmark stage %(stage)s: %(seconds)ss, %(queries)s queries" % stage)
+
+
+@contextmanager
+def temporary_pdf_storage():
+    """Stores the bill PDFs rendered inside the block in a temporary
+    directory, which is removed afterwards"""
+    field = Bill._meta.get_field('pdf_file')
+    storage = field.storage
+    directory = tempfile.mkdtemp(prefix='benchmark_billing')
+    field.storage = FileSystemStorage(location=directory)
+    try:
+        yield
+    finally:
+        field.storage = storage
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _chunks(count, size):
+    for start in xrange(0, count, size):
+        yield start, min(size, count - start)
+
+
+def generate_members(count, random, batch_size=1000):
+    """Creates count approved person members with bulk inserts"""
+    now = datetime.now()
+    for offset, size in _chunks(count, batch_size):
+        with transaction.atomic():
+            last_id = Contact.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            contacts = []
+            for i in xrange(offset, offset + size):
+                first_name = random.choice(first_names)
+                contacts.append(Contact(first_name=first_name,
+                                        given_names=u"%s Kapsi" % first_name,
+                                        last_name=random.choice(last_names),
+                                        street_address=u"Testikatu %d" % i,
+                                        postal_code=u"%05d" % (i % 100000),
+                                        post_office=u"Testikaupunki",
+                                        country=u"Finland",
+                                        phone=u"%09d" % (40123000 + i),
+                                        sms=u"%09d" % (40123000 + i),
+                                        email=u"user%d@example.com" % i))
+            Contact.objects.bulk_create(contacts)
+            # Primary keys are not returned from bulk inserts on all databases
+            contact_ids = Contact.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)
+            Membership.objects.bulk_create([
+                Membership(type='P', status='A', person_id=contact_id,
+                           nationality=u"Finnish", municipality=u"Testikaupunki",
+                           public_memberlist=random.random() < 0.2,
+                           approved=now - timedelta(days=random.randint(1, 360)))
+                for contact_id in contact_ids])
+
+
+def generate_payment_csv(paid_ratio, random):
+    """Builds an OP payment CSV paying paid_ratio of the open billing cycles"""
+    now = datetime.now()
+    lines = [header_row]
+    cycles = BillingCycle.objects.filter(is_paid=False).order_by('id').values_list(
+        'reference_number', 'sum', 'membership__person__first_name', 'membership__person__last_name')
+    for reference_number, amount, first_name, last_name in cycles.iterator():
+        if random.random() >= paid_ratio:
+            continue
+        lines.append(row.format({
+            'date': (now - timedelta(days=random.randint(0, 10))).strftime('%d.%m.%Y'),
+            'sum': unicode(amount).replace('.', ','),
+            'payer': u"%s %s" % (last_name.upper(), first_name.upper()),
+            'account': settings.IBAN_ACCOUNT_NUMBER,
+            'reference': reference_number,
+            'message': u"Maksu",
+            'id': UUID(int=random.getrandbits(128)).hex[:20],
+        }))
+    return u"\n".join(lines).encode('iso-8859-1'), len(lines) - 1
+
+
+def run_benchmark(members, seed=1, paid_ratio=0.8, pdf_count=100, batch_size=1000):
+    """Generates the dataset and times each pipeline stage. Returns the
+    results as a dictionary."""
+    random = Random(seed)
+    results = []
+    report = {
+        'members': members,
+        'seed': seed,
+        'database': connection.vendor,
+        'started': datetime.now().isoformat(),
+        'stages': results,
+    }
+    # Bills are not delivered anywhere during the benchmark
+    with override_settings(EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend',
+                           ALLOWED_HOSTS=['*']), temporary_pdf_storage():
+        with measure('generate_members', results):
+            generate_members(members, random, batch_size=batch_size)
+
+        with measure('makebills', results) as stage:
+            makebills()
+            stage['bills'] = Bill.objects.count()
+
+        csv_data, payment_count = generate_payment_csv(paid_ratio, random)
+        with measure('process_payments', results) as stage:
+            process_op_csv(StringIO(csv_data))
+            stage['payments'] = payment_count
+
+        with measure('create_csv', results) as stage:
+            stage['bytes'] = len(create_csv(start=datetime(2000, 1, 1), mark_cancelled=False))
+
+        # makebills already rendered the PDFs of the emailed bills, so the
+        # cached files are dropped to time the rendering
+        bills = list(Bill.objects.order_by('id')[:pdf_count])
+        Bill.objects.filter(id__in=[bill.id for bill in bills]).update(pdf_file=None)
+        for bill in bills:
+            bill.pdf_file = None
+        with measure('get_bill_pdf', results) as stage:
+            for bill in bills:
+                get_bill_pdf(bill, payments=Payment)
+            stage['pdfs'] = len(bills)
+
+        user, created = User.objects.get_or_create(username='benchmark',
+                                                   defaults={'is_superuser': True, 'is_staff': True})
+        client = Client()
+        client.force_login(user)
+        for url in LIST_VIEWS:
+            with measure('view %s' % url, results) as stage:
+                stage['status_code'] = client.get(url).status_code
+    return report
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the billing pipeline with a large synthetic dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=10000,
+                            help='Number of approved members to generate (10000)')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Random seed for reproducible data (1)')
+        parser.add_argument('--paid-ratio', type=float, default=0.8,
+                            help='Share of billing cycles paid in the payment CSV (0.8)')
+        parser.add_argument('--pdf-count', type=int, default=100,
+                            help='Number of bill PDFs to render (100)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows per bulk insert (1000)')
+        parser.add_argument('--output', default=None,
+                            help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        if Fee.objects.all().count() == 0:
+            self.stderr.write(
+                "No fees in the database. Did you load fixtures into the " +
+                "database first?\n " +
+                "(./manage.py loaddata membership/fixtures/membership_fees.json)")
+            sys.exit(1)
+        if Membership.objects.count() > 0 or Payment.objects.count() > 0:
+            self.stderr.write("Database not empty, refusing to run benchmark")
+            sys.exit(1)
+
+        report = run_benchmark(members=options['members'],
+                               seed=options['seed'],
+                               paid_ratio=options['paid_ratio'],
+                               pdf_count=options['pdf_count'],
+                               batch_size=options['batch_size'])
+
+        for stage in report['stages']:
+            self.stdout.write("%(stage)-40s %(seconds)10.3f s %(queries)8d queries "
+                              "%(peak_rss_kb)10d kB peak RSS" % stage)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=4, sort_keys=True)
+            self.stdout.write("Results written to %s" % options['output'])
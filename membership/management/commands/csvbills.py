@@ -4,7 +4,10 @@ from __future__ import with_statement
 import logging
 import codecs
 import csv
+from cStringIO import StringIO
+import hashlib
 import os
+import time
 
 from datetime import datetime, timedelta
 from decimal import Decimal
@@ -13,7 +16,7 @@ from django.core.management.base import BaseCommand
 from django.utils.translation import ugettext as _
 from django.contrib.auth.models import User
 
-from membership.models import BillingCycle, Payment
+from membership.models import ArchivedPayment, BillingCycle, Payment, PaymentImport
 from membership.utils import log_change
 
 logger = logging.getLogger("membership.csvbills")
@@ -196,7 +199,7 @@ def attach_payment_to_cycle(payment, user=None):
     if payment.ignore == True or payment.billingcycle != None:
         raise Exception("Unexpected function call. This shouldn't happen.")
     reference = payment.reference_number
-    cycle = BillingCycle.objects.get(reference_number=reference)
+    cycle = BillingCycle.get_by_reference_number(reference)
     if cycle.is_paid == False or cycle.amount_paid() < cycle.sum:
         payment.attach_to_cycle(cycle, user=user)
     else:
@@ -210,14 +213,25 @@ def attach_payment_to_cycle(payment, user=None):
     return cycle
 
 
-def process_payments(reader, user=None):
+def process_payments(reader, user=None, progress=None, progress_interval=100, progress_seconds=10):
     """
     Actual CSV file processing logic
+
+    progress.update() is called every progress_interval rows or
+    progress_seconds, whichever comes first, and at the end with the
+    number of processed rows, attached payments and unidentified payments.
     """
     return_messages = []
     num_attached = num_notattached = 0
     sum_attached = sum_notattached = 0
+    num_rows = 0
+    last_update = time.time()
     for row in reader:
+        if progress and num_rows and (num_rows % progress_interval == 0 or
+                                      time.time() - last_update >= progress_seconds):
+            progress.update(num_rows, num_attached, num_notattached)
+            last_update = time.time()
+        num_rows += 1
         if row == None:
             continue
         if row['amount'] < 0: # Transaction is paid by us, ignored
@@ -261,19 +275,82 @@ def process_payments(reader, user=None):
         sum_notattached)
     logger.info(log_message)
     return_messages.append((None, None, log_message))
+    if progress:
+        progress.update(num_rows, num_attached, num_notattached)
     return return_messages
 
 
-def process_op_csv(file_handle, user=None):
+def existing_transaction_ids(transaction_ids, chunk_size=500):
+    """The given transaction ids that already have a payment, archived or not"""
+    transaction_ids = list(transaction_ids)
+    existing = set()
+    for start in xrange(0, len(transaction_ids), chunk_size):
+        chunk = transaction_ids[start:start + chunk_size]
+        for model in (Payment, ArchivedPayment):
+            existing.update(model.objects.filter(transaction_id__in=chunk).values_list(
+                'transaction_id', flat=True))
+    return existing
+
+
+def import_payment_file(file_handle, reader_class, file_format, user=None, progress=None):
+    """
+    Processes a payment file unless the same file has been imported
+    before. Rows with transaction ids that are already in the database are
+    skipped without processing. The import is recorded in PaymentImport.
+
+    progress.start() is called with the number of new rows before they
+    are processed, see process_payments() for progress.update().
+    """
+    data = file_handle.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+    filename = os.path.basename(getattr(file_handle, 'name', None) or '')
+    previous = PaymentImport.objects.filter(content_hash=content_hash).order_by('imported').first()
+    if previous:
+        msg = _("File already imported on %(date)s, skipped.") % {
+            'date': previous.imported.strftime('%Y-%m-%d %H:%M')}
+        logger.info("%s (%s)" % (msg, content_hash))
+        return [(None, None, msg)]
+
+    rows = [row for row in reader_class(StringIO(data)) if row is not None]
+    seen = existing_transaction_ids(set(row['transaction'] for row in rows))
+    new_rows = [row for row in rows if row['transaction'] not in seen]
+
+    return_messages = []
+    if seen:
+        msg = _("%(seen)d of %(total)d rows already imported, processing %(new)d new rows.") % {
+            'seen': len(rows) - len(new_rows), 'total': len(rows), 'new': len(new_rows)}
+        logger.info(msg)
+        return_messages.append((None, None, msg))
+    if progress:
+        progress.start(len(new_rows))
+    return_messages.extend(process_payments(new_rows, user=user, progress=progress))
+
+    dates = [row['date'] for row in rows]
+    transactions = sorted(row['transaction'] for row in rows)
+    PaymentImport.objects.create(content_hash=content_hash, format=file_format,
+                                 filename=filename[:255], rows=len(rows), new_rows=len(new_rows),
+                                 first_date=min(dates) if dates else None,
+                                 last_date=max(dates) if dates else None,
+                                 first_transaction=transactions[0] if transactions else '',
+                                 last_transaction=transactions[-1] if transactions else '')
+    return return_messages
+
+
+def process_op_csv(file_handle, user=None, progress=None):
     logger.info("Starting OP payment CSV processing...")
-    reader = OpDictReader(file_handle)
-    return process_payments(reader)
+    return import_payment_file(file_handle, OpDictReader, 'op', user=user, progress=progress)
 
 
-def process_procountor_csv(file_handle, user=None):
+def process_procountor_csv(file_handle, user=None, progress=None):
     logger.info("Starting procountor payment CSV processing...")
-    reader = ProcountorDictReader(file_handle)
-    return process_payments(reader)
+    return import_payment_file(file_handle, ProcountorDictReader, 'procountor', user=user,
+                               progress=progress)
+
+
+PAYMENT_FILE_PROCESSORS = {
+    'op': process_op_csv,
+    'procountor': process_procountor_csv,
+}
 
 
 class Command(BaseCommand):
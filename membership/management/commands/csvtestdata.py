@@ -13,8 +13,7 @@ import codecs
 from uuid import uuid4
 from sys import stdout
 
-from django.core.management.base import BaseCommand
-
+from membership.management.base import MemoryReportingCommand
 from membership.models import *
 
 header_row = u'''Kirjauspäivä;Arvopäivä;Määrä EUROA;Tapahtumalajikoodi;Selitys;Saaja/Maksaja;Saajan tilinumero;Viite;Viesti;Arkistotunnus;'''
@@ -43,10 +42,10 @@ def print_csv(stream=stdout, count=10):
     high_sum = False
     wrong_reference = False
 
-    for cycle in BillingCycle.objects.filter(is_paid=False):
-        if count == 0:
-            break
-
+    cycles = (BillingCycle.objects.filter(is_paid=False).order_by('id')
+              .select_related('membership__person', 'membership__organization'))
+    # Only count rows, so no chunking is needed
+    for cycle in cycles[:count]:
         d = dict_for_cycle(cycle)
         if short_sum is False:
             d['sum'] -= 5
@@ -59,13 +58,12 @@ def print_csv(stream=stdout, count=10):
             wrong_reference = True
 
         print(row.format(d), file=stream)
-        count -= 1
 
     paid_cycle = BillingCycle.objects.filter(is_paid=True)[0]
     print(row.format(dict_for_cycle(paid_cycle)), file=stream)
 
 
-class Command(BaseCommand):
+class Command(MemoryReportingCommand):
     help = 'Generate payments CSV to be used for testing out payment import' \
         + ' form'
 
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+dissociate_unpaid.py
+
+Dissociates the approved members who have not paid within the given number
+of days after the due date of their paper reminder.
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from membership.models import Membership
+
+
+class Command(BaseCommand):
+    help = 'Dissociate members who have not paid after a paper reminder'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=14,
+                            help='Days since the due date of the paper reminder (14)')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only list the memberships that would be dissociated')
+        parser.add_argument('--user', default=None,
+                            help='Username recorded in the change log of the memberships')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError("No such user: %s" % options['user'])
+        elif not options['dry_run']:
+            raise CommandError("--user is required unless --dry-run is given")
+
+        ids = list(Membership.paper_reminder_sent_unpaid_after(days=options['days'])
+                   .values_list('id', flat=True))
+        results, memberships = Membership.bulk_dissociate(ids, user, dry_run=options['dry_run'])
+        for membership in memberships:
+            self.stdout.write(u"%s #%d %s" % (
+                "Would dissociate" if options['dry_run'] else "Dissociated",
+                membership.id, membership.name()))
+        self.stdout.write("%d memberships %s" % (
+            len(memberships), "would be dissociated" if options['dry_run'] else "dissociated"))
@@ -14,7 +14,7 @@ from membership.models import Contact, Membership, Fee, Payment
 from membership.management.commands.csvbills import attach_payment_to_cycle
 from membership.reference_numbers import generate_membership_bill_reference_number
 from membership.test_utils import random_first_name, random_last_name
-from services.models import Alias, Service, ServiceType
+from services.models import Alias, Service, get_servicetype
 
 from datetime import datetime
 from decimal import Decimal
@@ -195,20 +195,20 @@ class Command(BaseCommand):
         login_alias.save()
 
         # Services
-        forward_alias_service = Service(servicetype=ServiceType.objects.get(servicetype='Email alias'),
+        forward_alias_service = Service(servicetype=get_servicetype('Email alias'),
                                         alias=forward_alias, owner=membership, data=forward_alias.name)
         forward_alias_service.save()
 
-        unix_account_service = Service(servicetype=ServiceType.objects.get(servicetype='UNIX account'),
+        unix_account_service = Service(servicetype=get_servicetype('UNIX account'),
                                        alias=login_alias, owner=membership, data=login_alias.name)
         unix_account_service.save()
 
         if random() < 0.6:
-            mysql_service = Service(servicetype=ServiceType.objects.get(servicetype='MySQL database'),
+            mysql_service = Service(servicetype=get_servicetype('MySQL database'),
                                     alias=login_alias, owner=membership, data=login_alias.name.replace('-', '_'))
             mysql_service.save()
         if random() < 0.6:
-            postgresql_service = Service(servicetype=ServiceType.objects.get(servicetype='PostgreSQL database'),
+            postgresql_service = Service(servicetype=get_servicetype('PostgreSQL database'),
                                          alias=login_alias, owner=membership, data=login_alias.name)
             postgresql_service.save()
         # End of services
@@ -2,43 +2,68 @@
 
 
 import calendar
-from django.core.management.base import BaseCommand
+from multiprocessing import Pool
+
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, connections
 from django.utils import translation
 
+from membership.management.base import MemoryReportingCommand
 from membership.models import *
+from membership.pagination import chunked_iterator
 from membership.utils import *
 
 logger = logging.getLogger("membership.makebills")
 
+# Value of BillingRun.lock while a run is active
+BILLING_RUN_LOCK = 'makebills'
+# A running run without a checkpoint for this long is assumed to have died
+BILLING_RUN_LOCK_TIMEOUT = timedelta(hours=1)
+# Memberships processed between checkpoints
+CHECKPOINT_INTERVAL = 100
+
 class MembershipNotApproved(Exception): pass
 
-def create_billingcycle(membership):
+class BillingRunLocked(Exception): pass
+
+class BillingShardFailed(Exception): pass
+
+def create_billingcycle(membership, period_end=None):
     """
     Creates a new billing cycle for a membership.
 
     If a previous billing cycle exists, the end date is used as the start
     date for the new one.  If a previous one doesn't exist, e.g. it is a new
     user, we use the time when they were approved.
+
+    The membership row is locked while the cycle is created. If period_end
+    is given and the newest cycle already ends after it, e.g. because
+    another process billed the membership first, nothing is created and
+    None is returned.
     """
     billing_cycle = None
     try:
         if membership.status != 'A':
             logger.critical("%s not Approved. Cannot send bill" % repr(membership))
             raise MembershipNotApproved("%s not Approved. Cannot send bill" % repr(membership))
-        try:
-            newest_existing_billing_cycle = membership.billingcycle_set.latest('end')
-        except ObjectDoesNotExist:
-            newest_existing_billing_cycle = None
-
-        if newest_existing_billing_cycle != None:
-            cycle_start = newest_existing_billing_cycle.end
-        elif membership.approved != None:
-            cycle_start = membership.approved
-        else:
-            logger.critical("%s is missing the approved timestamp. Cannot send bill" % repr(membership))
-            raise MembershipNotApproved("%s is missing the approved timestamp. Cannot send bill" % repr(membership))
 
         with transaction.atomic():
+            list(Membership.objects.select_for_update().filter(pk=membership.pk).values_list('id'))
+            try:
+                newest_existing_billing_cycle = membership.billingcycle_set.latest('end')
+            except ObjectDoesNotExist:
+                newest_existing_billing_cycle = None
+
+            if newest_existing_billing_cycle != None:
+                if period_end is not None and newest_existing_billing_cycle.end > period_end:
+                    return None
+                cycle_start = newest_existing_billing_cycle.end
+            elif membership.approved != None:
+                cycle_start = membership.approved
+            else:
+                logger.critical("%s is missing the approved timestamp. Cannot send bill" % repr(membership))
+                raise MembershipNotApproved("%s is missing the approved timestamp. Cannot send bill" % repr(membership))
+
             billing_cycle = BillingCycle(membership=membership, start=cycle_start)
             billing_cycle.save()
             bill = Bill(billingcycle=billing_cycle)
@@ -78,24 +103,71 @@ def send_reminder(membership):
     bill.send_as_email()
     return bill
 
-def makebills():
-    logger.info("Running makebills...")
-    latest_recorded_payment = Payment.latest_payment_date()
+def start_billing_run(period_end, resume=True):
+    """
+    Takes the billing run lock. A failed run of the same billing period is
+    resumed from its checkpoint unless resume is False or a later run of
+    the period has completed. Raises BillingRunLocked if another run is
+    active.
+    """
+    now = datetime.now()
+    expired = BillingRun.objects.filter(lock=BILLING_RUN_LOCK,
+                                        heartbeat__lt=now - BILLING_RUN_LOCK_TIMEOUT)
+    if expired.update(lock=None, status='F', error="Lock expired"):
+        logger.warning("Released an expired billing run lock")
 
-    dt = datetime.now()
-    last_of_month = datetime(dt.year, dt.month, calendar.monthrange(dt.year, dt.month)[1], 23, 59, 59)
-    for member in Membership.objects.filter(status='A').filter(id__gt=0):
+    previous = None
+    if resume:
+        runs = BillingRun.objects.filter(period_end=period_end)
+        # A completed run has billed everyone, including past a failed
+        # run's checkpoint
+        done = runs.filter(status='D').order_by('-id').values_list('id', flat=True).first()
+        previous = (runs.filter(status='F', id__gt=done or 0)
+                    .order_by('-id').first())
+    try:
+        with transaction.atomic():
+            if previous:
+                # Only one process may take over the failed run
+                taken = BillingRun.objects.filter(id=previous.id, lock=None).update(
+                    lock=BILLING_RUN_LOCK, status='R', heartbeat=now, error='')
+                if not taken:
+                    raise IntegrityError("Billing run %s taken over" % previous.id)
+                return BillingRun.objects.get(id=previous.id)
+            return BillingRun.objects.create(lock=BILLING_RUN_LOCK, period_end=period_end)
+    except IntegrityError:
+        raise BillingRunLocked("Another billing run is in progress")
+
+
+class ShardProgress(object):
+    """Progress counters of a worker process, see BillingRun. The counters
+    are added to the run when the worker finishes."""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.last_membership_id = None
+        self.processed = 0
+        self.cycles_created = 0
+        self.reminders_sent = 0
+
+    def checkpoint(self):
+        # Keeps the lock of the run from expiring
+        BillingRun.objects.filter(id=self.run_id).update(heartbeat=datetime.now())
+
+
+def bill_memberships(members, period_end, latest_recorded_payment, progress):
+    """
+    Creates bills and reminders for members, which must be ordered by id.
+    The counters of progress (a BillingRun or ShardProgress) are updated
+    after each membership.
+    """
+    for member in members:
         # Billing cycles and bills
         cycles = member.billingcycle_set
-        if cycles.count() == 0:
-            cycle = create_billingcycle(member)
-            logger.info("Created billing cycle %s for %s" % (repr(cycle), repr(member)))
-        else:
-            latest_cycle = cycles.latest("end")
-            if latest_cycle.end <= last_of_month:
-                cycle = create_billingcycle(member)
-                logger.info("Created billing cycle %s for %s" %
-                            (repr(cycle), repr(member)))
+        if cycles.count() == 0 or cycles.latest("end").end <= period_end:
+            cycle = create_billingcycle(member, period_end=period_end)
+            if cycle:
+                progress.cycles_created += 1
+                logger.info("Created billing cycle %s for %s" % (repr(cycle), repr(member)))
 
         # Reminders
         latest_cycle = member.billingcycle_set.latest('end')
@@ -104,13 +176,134 @@ def makebills():
                 last_due_date = latest_cycle.last_bill().due_date
                 if can_send_reminder(last_due_date, latest_recorded_payment):
                     reminder = send_reminder(member)
+                    progress.reminders_sent += 1
                     logger.info("Sent reminder %s to %s." % (repr(reminder), repr(member)))
+
+        progress.last_membership_id = member.id
+        progress.processed += 1
+        if progress.processed % CHECKPOINT_INTERVAL == 0:
+            progress.checkpoint()
+
+
+def shard_ranges(ids, shards):
+    """
+    Splits the sorted membership ids into at most shards contiguous
+    (after_id, last_id) ranges of about the same size.
+    """
+    if not ids:
+        return []
+    size = -(-len(ids) // max(shards, 1))
+    ranges = []
+    after_id = ids[0] - 1
+    for start in xrange(0, len(ids), size):
+        last_id = ids[min(start + size, len(ids)) - 1]
+        ranges.append((after_id, last_id))
+        after_id = last_id
+    return ranges
+
+
+def _bill_shard(args):
+    """Worker process entry point, bills the memberships of one id range"""
+    run_id, after_id, last_id, period_end, latest_recorded_payment = args
+    translation.activate(settings.LANGUAGE_CODE)
+    progress = ShardProgress(run_id)
+    error = None
+    try:
+        members = (Membership.objects.filter(status='A', id__gt=after_id, id__lte=last_id)
+                   .order_by('id'))
+        bill_memberships(chunked_iterator(members), period_end, latest_recorded_payment, progress)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        connections.close_all()
+    return after_id, last_id, progress, error
+
+
+def _bill_in_workers(run, members, period_end, latest_recorded_payment, workers):
+    """
+    Bills members in worker processes, one id range each. The checkpoint of
+    the run only advances over the ranges completed from the start, later
+    ranges are billed again on resume.
+    """
+    ids = list(members.values_list('id', flat=True))
+    ranges = shard_ranges(ids, workers)
+    if not ranges:
+        return
+    # Forked processes must not share the database connections
+    connections.close_all()
+    pool = Pool(len(ranges))
+    try:
+        results = pool.map(_bill_shard, [(run.id, after_id, last_id, period_end, latest_recorded_payment)
+                                         for after_id, last_id in ranges])
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = []
+    for after_id, last_id, progress, error in results:
+        run.processed += progress.processed
+        run.cycles_created += progress.cycles_created
+        run.reminders_sent += progress.reminders_sent
+        if not errors:
+            if error:
+                run.last_membership_id = progress.last_membership_id or after_id
+            else:
+                run.last_membership_id = last_id
+        if error:
+            errors.append(error)
+    if errors:
+        raise BillingShardFailed("%d of %d billing workers failed:\n%s" %
+                                 (len(errors), len(ranges), "\n".join(errors)))
+
+
+def makebills(resume=True, workers=1):
+    """
+    Creates bills and reminders for approved memberships. Returns the
+    BillingRun. If the run fails, e.g. on an SMTP error, the next run of the
+    same month continues after the last processed membership.
+
+    With workers > 1 the memberships are split by id range between worker
+    processes.
+    """
+    logger.info("Running makebills...")
+    latest_recorded_payment = Payment.latest_payment_date()
+
+    dt = datetime.now()
+    last_of_month = datetime(dt.year, dt.month, calendar.monthrange(dt.year, dt.month)[1], 23, 59, 59)
+    run = start_billing_run(last_of_month, resume=resume)
+    if run.last_membership_id:
+        logger.info("Resuming billing run %s after membership %s" % (run.id, run.last_membership_id))
+    members = Membership.objects.filter(status='A').filter(id__gt=run.last_membership_id).order_by('id')
+    if workers > 1 and connection.vendor == 'sqlite':
+        # SQLite has no row locks and refuses concurrent write transactions
+        logger.warning("Billing workers are not supported on SQLite, using one process")
+        workers = 1
+    try:
+        if workers > 1:
+            _bill_in_workers(run, members, last_of_month, latest_recorded_payment, workers)
+        else:
+            bill_memberships(chunked_iterator(members), last_of_month, latest_recorded_payment, run)
+    except Exception:
+        run.finish(status='F', error=traceback.format_exc())
+        logger.critical("Billing run %s failed after membership %s" % (run.id, run.last_membership_id))
+        raise
+    run.finish()
     logger.info("Done running makebills.")
+    return run
 
 
-class Command(BaseCommand):
+class Command(MemoryReportingCommand):
     help = 'Find expiring billing cycles, send bills, send reminders'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--no-resume', action='store_false', dest='resume', default=True,
+                            help='Start from the first membership even if the previous run failed')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes billing separate membership id ranges (1)')
+
     def handle(self, *args, **options):
         translation.activate(settings.LANGUAGE_CODE)
-        makebills()
+        try:
+            makebills(resume=options['resume'], workers=options['workers'])
+        except BillingRunLocked as e:
+            raise CommandError(unicode(e))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+match_payments.py
+
+Lists suggested billing cycles for unidentified payments and optionally
+attaches the confident matches.
+"""
+
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from membership.payment_matching import DEFAULT_THRESHOLD, auto_attach, suggest_matches
+
+
+class Command(BaseCommand):
+    help = 'Suggest billing cycles for unidentified payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=3,
+                            help='Suggestions listed per payment (3)')
+        parser.add_argument('--auto-attach', action='store_true', default=False,
+                            help='Attach payments whose best suggestion is above the threshold')
+        parser.add_argument('--threshold', type=Decimal, default=DEFAULT_THRESHOLD,
+                            help='Score needed for automatic attaching (%s)' % DEFAULT_THRESHOLD)
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='With --auto-attach, only show what would be attached')
+        parser.add_argument('--user', default=None,
+                            help='Username recorded in the change log of attached payments')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError("No such user: %s" % options['user'])
+
+        if options['auto_attach']:
+            attached = auto_attach(threshold=options['threshold'], user=user,
+                                   dry_run=options['dry_run'])
+            for payment, suggestion in attached:
+                self.stdout.write(u"%s payment %s to cycle %s of member %s: %s (%.2f)" % (
+                    "Would attach" if options['dry_run'] else "Attached",
+                    payment.id, suggestion.cycle.id, suggestion.cycle.membership_id,
+                    u", ".join(suggestion.reasons), suggestion.score))
+            self.stdout.write("%d payments %s" % (
+                len(attached), "matched" if options['dry_run'] else "attached"))
+            return
+
+        for payment, suggestions in suggest_matches(limit=options['limit']):
+            self.stdout.write(u"Payment %s: %s %s '%s' '%s'" % (
+                payment.id, payment.payment_day.date(), payment.amount,
+                payment.reference_number, payment.payer_name))
+            if not suggestions:
+                self.stdout.write("    no suggestions")
+            for suggestion in suggestions:
+                self.stdout.write(u"    %.2f cycle %s of member %s %s: %s" % (
+                    suggestion.score, suggestion.cycle.id, suggestion.cycle.membership_id,
+                    suggestion.cycle.membership.name(), u", ".join(suggestion.reasons)))
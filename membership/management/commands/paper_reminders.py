@@ -4,13 +4,15 @@ from __future__ import with_statement
 import logging
 from tempfile import NamedTemporaryFile
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
+
+from membership.management.base import MemoryReportingCommand
 from membership.models import BillingCycle
 
 logger = logging.getLogger("paper_bills")
 
 
-class Command(BaseCommand):
+class Command(MemoryReportingCommand):
     help = 'Create paper reminders pdf'
 
     def add_arguments(self, parser):
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+process_payment_imports.py
+
+Processes payment files uploaded through the import payments page. Can be
+run from cron or as a long-lived process with --loop.
+"""
+
+from datetime import datetime, timedelta
+import json
+import logging
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, transaction
+from django.utils import translation
+from django.utils.translation import ugettext as _
+
+from membership.management.commands.csvbills import PAYMENT_FILE_PROCESSORS
+from membership.models import PaymentImportJob
+
+logger = logging.getLogger("membership.process_payment_imports")
+
+# A running job without progress for this long has lost its worker
+JOB_LEASE = timedelta(minutes=10)
+# Jobs that have lost their worker this many times are failed
+MAX_ATTEMPTS = 3
+
+
+class PaymentImportJobLost(Exception):
+    """The job was requeued by recover_stale_jobs() while it was processed"""
+
+
+def _claimed(job):
+    """The job while it is still claimed by this worker"""
+    return PaymentImportJob.objects.filter(id=job.id, status='R', attempts=job.attempts)
+
+
+class JobProgress(object):
+    """
+    Stores the progress of process_payments() in the job. Raises
+    PaymentImportJobLost if the job is no longer claimed by this worker.
+    """
+
+    def __init__(self, job):
+        self.job = job
+
+    def _save(self, **values):
+        values['heartbeat'] = datetime.now()
+        if not _claimed(self.job).update(**values):
+            raise PaymentImportJobLost("Payment import %s was requeued" % self.job.id)
+
+    def start(self, total):
+        self._save(rows_total=total)
+
+    def update(self, processed, attached, unknown):
+        self._save(rows_processed=processed, attached=attached, unknown=unknown)
+
+
+def recover_stale_jobs(now=None):
+    """
+    Queues the running jobs whose lease has expired again, or fails them
+    after MAX_ATTEMPTS. The rows imported before the worker was lost are
+    skipped on the next attempt by their transaction ids. Returns the
+    numbers of requeued and failed jobs.
+    """
+    if now is None:
+        now = datetime.now()
+    stale = PaymentImportJob.objects.filter(status='R', heartbeat__lt=now - JOB_LEASE)
+    failed = stale.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status='F', finished=now,
+        error="Worker lost %d times, last heartbeat before %s" % (MAX_ATTEMPTS, now - JOB_LEASE),
+        messages=json.dumps([(None, None, _("Payment import failed."))]))
+    requeued = stale.filter(attempts__lt=MAX_ATTEMPTS).update(
+        status='Q', rows_total=0, rows_processed=0, attached=0, unknown=0)
+    if failed or requeued:
+        logger.warning("Requeued %d and failed %d payment imports that lost their worker" %
+                       (requeued, failed))
+    return requeued, failed
+
+
+def claim_payment_import_job():
+    """
+    Marks the oldest queued job running and returns it, or None. Rows
+    locked by another worker are skipped where the database supports it.
+    """
+    with transaction.atomic():
+        queued = PaymentImportJob.objects.select_for_update(
+            skip_locked=connection.features.has_select_for_update_skip_locked)
+        job = queued.filter(status='Q').order_by('created', 'id').first()
+        if job is None:
+            return None
+        job.status = 'R'
+        job.started = job.heartbeat = datetime.now()
+        job.attempts += 1
+        job.save(update_fields=['status', 'started', 'heartbeat', 'attempts'])
+    return job
+
+
+def run_payment_import_job(job):
+    """
+    Processes the file of a claimed job and stores the outcome. Nothing is
+    stored if the job has meanwhile been requeued and taken by another
+    worker.
+    """
+    logger.info(u"Processing payment import %s (%s)" % (job.id, job.filename))
+    error = ''
+    try:
+        process = PAYMENT_FILE_PROCESSORS[job.format]
+        job.csv_file.open('rb')
+        try:
+            import_messages = process(job.csv_file, user=job.user, progress=JobProgress(job))
+        finally:
+            job.csv_file.close()
+    except PaymentImportJobLost:
+        logger.warning(u"Payment import %s was requeued while processed, stopped" % job.id)
+        return job
+    except Exception:
+        status = 'F'
+        error = traceback.format_exc()
+        import_messages = [(None, None, _("Payment import failed."))]
+        logger.error(u"Payment import %s failed: %s" % (job.id, error))
+    else:
+        status = 'D'
+    outcome = {'status': status, 'error': error, 'finished': datetime.now(),
+               'messages': json.dumps(import_messages)}
+    if status == 'D':
+        # The payments are in the database and the file is in the registry
+        outcome['csv_file'] = None
+    if not _claimed(job).update(**outcome):
+        logger.warning(u"Payment import %s was requeued while processed, outcome not stored" % job.id)
+        return job
+    if status == 'D':
+        job.csv_file.delete(save=False)
+    job.refresh_from_db()
+    return job
+
+
+def process_payment_imports():
+    """
+    Processes all queued jobs after requeuing the stale ones, returns the
+    number of processed jobs
+    """
+    recover_stale_jobs()
+    count = 0
+    while True:
+        job = claim_payment_import_job()
+        if job is None:
+            return count
+        run_payment_import_job(job)
+        count += 1
+
+
+class Command(BaseCommand):
+    help = 'Process uploaded payment files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep running and poll for new uploads')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to sleep when there are no uploads (with --loop)')
+
+    def handle(self, *args, **options):
+        translation.activate(settings.LANGUAGE_CODE)
+        while True:
+            count = process_payment_imports()
+            if not options['loop']:
+                if count:
+                    self.stdout.write("Processed %d payment files" % count)
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
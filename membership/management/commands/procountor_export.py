@@ -13,11 +13,11 @@ import argparse
 from datetime import datetime
 import logging
 
-from django.core.management.base import BaseCommand
 from django.core import mail
 from django.conf import settings
 
-from membership.billing.procountor_csv import create_csv
+from membership.billing.procountor_csv import create_csv, write_csv
+from membership.management.base import MemoryReportingCommand
 
 
 logger = logging.getLogger("membership.billing.procountor")
@@ -31,7 +31,18 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 
-class Command(BaseCommand):
+class DecodingWriter(object):
+    """Writes the encoded CSV output to a text stream such as self.stdout"""
+
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self.encoding = encoding
+
+    def write(self, data):
+        self.stream.write(data.decode(self.encoding), ending='')
+
+
+class Command(MemoryReportingCommand):
     help = 'Closes the specified poll for voting'
 
     def add_arguments(self, parser):
@@ -57,8 +68,14 @@ Mukana myös uudet hyvityslaskut.
         # Mark cancelled bills exported only when they are sent by email
         mark_cancelled = bool(options['email'])
 
-        content = create_csv(start=datetime(year=start.year, month=start.month, day=start.day),
-                             mark_cancelled=mark_cancelled)
+        start = datetime(year=start.year, month=start.month, day=start.day)
+
+        if options['email']:
+            content = create_csv(start=start, mark_cancelled=mark_cancelled)
+        else:
+            # The console output is written as the bills are read
+            content = write_csv(DecodingWriter(self.stdout, "ISO-8859-1"), start=start,
+                                mark_cancelled=mark_cancelled)
 
         # Send only if needed
         if content:
@@ -73,7 +90,6 @@ Mukana myös uudet hyvityslaskut.
                 email.send()
                 message = "Sent Procountor bill list CSV by email"
             else:
-                self.stdout.write(content.decode("ISO-8859-1"))
                 message = 'Wrote Procountor bill list CSV to console'
             logger.info(message)
         else:
@@ -1,13 +1,10 @@
 # -*- encoding: utf-8 -*-
 
-from django.core.management.base import BaseCommand
+from membership.management.base import MemoryReportingCommand
+from membership.public_memberlist import public_memberlist_data, public_memberlist_xml
 
-from membership.models import *
-from membership.public_memberlist import public_memberlist_data
 
-
-class Command(BaseCommand):
+class Command(MemoryReportingCommand):
     def handle(self, *args, **options):
-        template_name = 'membership/public_memberlist.xml'
-        data = public_memberlist_data()
-        return render_to_string(template_name, data)
+        for part in public_memberlist_xml(public_memberlist_data()):
+            self.stdout.write(part, ending='')
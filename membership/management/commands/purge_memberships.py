@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+purge_memberships.py
+
+Deletes old membership applications (or other memberships by status) in
+bulk for data retention, along with the contacts no membership refers to.
+"""
+
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from membership.models import Membership, STATUS_DELETED, ALLOWED_STATUS_TRANSITIONS
+
+
+class Command(BaseCommand):
+    help = 'Delete old memberships in bulk and purge contacts without memberships'
+
+    def add_arguments(self, parser):
+        deletable = sorted(status for status, targets in ALLOWED_STATUS_TRANSITIONS.items()
+                           if STATUS_DELETED in targets)
+        parser.add_argument('--status', action='append', choices=deletable,
+                            help='Status of the memberships to delete, can be repeated (N)')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Delete memberships created more than this many days ago (365)')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report the counts and roll back')
+        parser.add_argument('--user', default=None,
+                            help='Username recorded in the change log of the memberships')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError("No such user: %s" % options['user'])
+        elif not options['dry_run']:
+            raise CommandError("--user is required unless --dry-run is given")
+
+        created_before = datetime.now() - timedelta(days=options['days'])
+        ids = list(Membership.objects.filter(status__in=options['status'] or ['N'],
+                                             created__lt=created_before)
+                   .values_list('id', flat=True))
+        counts = Membership.purge(ids, user, dry_run=options['dry_run'])
+
+        self.stdout.write(
+            "%s %d memberships, %d services, %d aliases and %d contacts, "
+            "%s %d aliases" % (
+                "Would delete" if options['dry_run'] else "Deleted",
+                counts['memberships'], counts['services'], counts['aliases_deleted'],
+                counts['contacts'],
+                "would expire" if options['dry_run'] else "expired",
+                counts['aliases_expired']))
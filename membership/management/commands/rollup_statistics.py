@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+rollup_statistics.py
+
+Stores the daily membership statistics, meant to be run from cron once a
+day shortly after midnight for the previous day. Snapshot statistics
+(counts by status, unpaid cycles) are the state at the time of the run,
+so --date can only backfill the counts of events on older days.
+"""
+
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from membership.statistics import collect_statistics, default_day
+
+
+class Command(BaseCommand):
+    help = 'Store the daily membership statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', default=None,
+                            help='Day to store the statistics for as YYYY-MM-DD (yesterday)')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("Invalid date: %s" % options['date'])
+            if day > date.today():
+                raise CommandError("Cannot store statistics for a future date")
+        else:
+            day = default_day()
+        count = collect_statistics(day)
+        self.stdout.write("Stored %d statistics for %s" % (count, day.isoformat()))
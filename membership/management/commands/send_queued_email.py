@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+send_queued_email.py
+
+Delivers emails queued in the QueuedEmail table. Can be run from cron or as
+a long-lived process with --loop.
+"""
+
+from datetime import datetime, timedelta
+import logging
+from multiprocessing.pool import ThreadPool
+import time
+import traceback
+
+from django.core import mail
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, transaction
+
+from membership.models import QueuedEmail
+
+logger = logging.getLogger("membership.send_queued_email")
+
+# Claimed emails are not picked up by other workers until the lease expires
+CLAIM_LEASE = timedelta(minutes=10)
+BACKOFF_BASE = timedelta(minutes=1)
+BACKOFF_MAX = timedelta(hours=6)
+
+
+def backoff(attempts):
+    """Delay before the next delivery attempt, doubling on each failure"""
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def claim_queued_email(batch_size, now=None):
+    """
+    Claims a batch of due emails by pushing their next attempt forward.
+
+    Rows locked by another worker are skipped where the database supports it.
+    """
+    if now is None:
+        now = datetime.now()
+    with transaction.atomic():
+        queued = QueuedEmail.objects.select_for_update(
+            skip_locked=connection.features.has_select_for_update_skip_locked)
+        queued = list(queued.filter(status='Q', next_attempt__lte=now)
+                      .order_by('next_attempt', 'id')[:batch_size])
+        QueuedEmail.objects.filter(id__in=[e.id for e in queued]).update(
+            next_attempt=now + CLAIM_LEASE)
+    return queued
+
+
+def _send(message):
+    """Sends one message, returning the error or None. Run in a worker thread."""
+    try:
+        mail.get_connection().send_messages([message])
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+def deliver_queued_email(workers=4, batch_size=50, max_attempts=8):
+    """
+    Delivers one batch of due emails using a pool of sending threads.
+
+    Returns a (sent, failed) tuple. Failed deliveries are retried with
+    exponential backoff until max_attempts is reached.
+    """
+    queued = claim_queued_email(batch_size)
+    if not queued:
+        return 0, 0
+    messages = [e.to_message() for e in queued]
+    if workers > 1 and len(messages) > 1:
+        pool = ThreadPool(min(workers, len(messages)))
+        try:
+            errors = pool.map(_send, messages)
+        finally:
+            pool.close()
+    else:
+        errors = [_send(message) for message in messages]
+
+    now = datetime.now()
+    sent = failed = 0
+    for email, error in zip(queued, errors):
+        email.attempts += 1
+        if error is None:
+            email.status = 'S'
+            email.sent = now
+            email.last_error = ''
+            sent += 1
+        else:
+            email.last_error = error
+            if email.attempts >= max_attempts:
+                email.status = 'F'
+                logger.critical(u"Giving up delivering email %s after %d attempts: %s" %
+                                (email.id, email.attempts, error))
+            else:
+                email.next_attempt = now + backoff(email.attempts)
+                logger.warning(u"Delivering email %s failed, retrying at %s: %s" %
+                               (email.id, email.next_attempt, error))
+            failed += 1
+        email.save(update_fields=['status', 'sent', 'attempts', 'last_error', 'next_attempt'])
+    logger.info("Delivered %d queued emails, %d failed" % (sent, failed))
+    return sent, failed
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of concurrent sending threads')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Number of emails claimed at a time')
+        parser.add_argument('--max-attempts', type=int, default=8,
+                            help='Delivery attempts before giving up')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep running and poll for new emails')
+        parser.add_argument('--interval', type=float, default=10,
+                            help='Seconds to sleep when the queue is empty (with --loop)')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = deliver_queued_email(workers=options['workers'],
+                                                batch_size=options['batch_size'],
+                                                max_attempts=options['max_attempts'])
+            if not options['loop']:
+                if sent or failed:
+                    self.stdout.write("Sent %d emails, %d failed" % (sent, failed))
+                break
+            if sent + failed < options['batch_size']:
+                close_old_connections()
+                time.sleep(options['interval'])
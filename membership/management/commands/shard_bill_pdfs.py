@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+shard_bill_pdfs.py
+
+Moves the cached bill PDFs from the flat bill_pdfs directory to the
+sharded layout of bill_pdf_path(). Safe to run again after an interruption.
+"""
+
+import logging
+import os
+import posixpath
+
+from django.core.management.base import BaseCommand
+
+from membership.models import ArchivedBill, Bill, bill_pdf_path, cache_storage
+from membership.pagination import chunked_iterator
+
+logger = logging.getLogger("membership.shard_bill_pdfs")
+
+
+def shard_bill_pdfs(dry_run=False, chunk_size=500):
+    """
+    Moves the PDF of every bill and archived bill whose file is not yet at
+    bill_pdf_path(). Bills whose file no longer exists are cleared so that
+    the PDF is generated again when needed. Returns a dict of counts.
+    """
+    counts = {'moved': 0, 'missing': 0}
+    for model in (Bill, ArchivedBill):
+        bills = model.objects.exclude(pdf_file='').exclude(pdf_file__isnull=True).order_by('id')
+        for bill in chunked_iterator(bills.only('id', 'pdf_file'), chunk_size):
+            name = bill.pdf_file.name
+            new_name = bill_pdf_path(bill, posixpath.basename(name))
+            if name == new_name:
+                continue
+            source, target = cache_storage.path(name), cache_storage.path(new_name)
+            # The file may already have been moved by an interrupted run
+            if not os.path.exists(source) and not os.path.exists(target):
+                counts['missing'] += 1
+                if not dry_run:
+                    model.objects.filter(id=bill.id).update(pdf_file=None)
+                continue
+            counts['moved'] += 1
+            if dry_run:
+                continue
+            if os.path.exists(source):
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.rename(source, target)
+            model.objects.filter(id=bill.id).update(pdf_file=new_name)
+    logger.info("Moved %(moved)d bill PDFs, cleared %(missing)d missing ones" % counts)
+    return counts
+
+
+class Command(BaseCommand):
+    help = 'Move cached bill PDFs to the sharded directory layout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only count the files that would be moved')
+
+    def handle(self, *args, **options):
+        counts = shard_bill_pdfs(dry_run=options['dry_run'])
+        self.stdout.write("%s %d bill PDFs, %s %d missing ones" % (
+            "Would move" if options['dry_run'] else "Moved", counts['moved'],
+            "would clear" if options['dry_run'] else "cleared", counts['missing']))
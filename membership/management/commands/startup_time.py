@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+startup_time.py
+
+Measures how long a fresh process takes to get ready, e.g. to compare the
+effect of import changes on management command and worker startup.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Each target is run in its own interpreter after django.setup()
+TARGETS = [
+    ('django.setup', ''),
+    ('membership.models', 'import membership.models'),
+    ('sikteeri.wsgi', 'import sikteeri.wsgi'),
+    ('pdf warm up', 'from membership.billing.pdf_utils import warm_up; warm_up()'),
+]
+
+SNIPPET = """
+import json, sys, time
+start = time.time()
+import django
+django.setup()
+%s
+print(json.dumps({'seconds': time.time() - start,
+                  'modules': len(sys.modules),
+                  'reportlab': 'reportlab' in sys.modules}))
+"""
+
+
+def measure_startup(code, env=None):
+    """Runs code in a fresh interpreter. Returns a dictionary with the setup
+    time measured inside the process, the total wall clock time including
+    interpreter startup, the number of loaded modules and whether ReportLab
+    was loaded."""
+    if env is None:
+        env = os.environ.copy()
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', SNIPPET % code],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = process.communicate()
+    total = time.time() - start
+    if process.returncode != 0:
+        raise CommandError(stderr)
+    result = json.loads(stdout.strip().splitlines()[-1])
+    result['total_seconds'] = total
+    return result
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+class Command(BaseCommand):
+    help = 'Measure process startup and import time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs per target, the median is reported (5)')
+        parser.add_argument('--target', action='append', default=None,
+                            choices=[name for name, code in TARGETS],
+                            help='Only measure this target (may be repeated)')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        targets = [(name, code) for name, code in TARGETS
+                   if not options['target'] or name in options['target']]
+        results = []
+        for name, code in targets:
+            runs = [measure_startup(code) for i in xrange(max(options['repeat'], 1))]
+            results.append({
+                'target': name,
+                'seconds': round(_median([r['seconds'] for r in runs]), 3),
+                'total_seconds': round(_median([r['total_seconds'] for r in runs]), 3),
+                'modules': runs[-1]['modules'],
+                'reportlab': runs[-1]['reportlab'],
+            })
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=4, sort_keys=True))
+            return
+        for result in results:
+            self.stdout.write("%(target)-20s %(seconds)8.3f s setup %(total_seconds)8.3f s total "
+                              "%(modules)6d modules reportlab=%(reportlab)s" % result)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0005_cancelledbill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('message', models.TextField(verbose_name='Message')),
+                ('status', models.CharField(default='Q', max_length=1, verbose_name='Status', db_index=True, choices=[('Q', 'Queued'), ('S', 'Sent'), ('F', 'Failed')])),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('next_attempt', models.DateTimeField(default=datetime.datetime.now, verbose_name='Next delivery attempt', db_index=True)),
+                ('attempts', models.IntegerField(default=0, verbose_name='Delivery attempts')),
+                ('last_error', models.TextField(verbose_name='Last delivery error', blank=True)),
+                ('sent', models.DateTimeField(null=True, verbose_name='Sent', blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0006_queuedemail'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='billingcycle',
+            name='reference_number',
+            field=models.CharField(max_length=64, verbose_name='Reference number', db_index=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0007_billingcycle_reference_number_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started', models.DateTimeField(auto_now_add=True, verbose_name='Started')),
+                ('heartbeat', models.DateTimeField(default=datetime.datetime.now, verbose_name='Last checkpoint')),
+                ('finished', models.DateTimeField(null=True, verbose_name='Finished', blank=True)),
+                ('status', models.CharField(default='R', max_length=1, verbose_name='Status', choices=[('R', 'Running'), ('D', 'Done'), ('F', 'Failed')])),
+                ('lock', models.CharField(max_length=16, unique=True, null=True, verbose_name='Lock', blank=True)),
+                ('period_end', models.DateTimeField(verbose_name='Billing period end')),
+                ('last_membership_id', models.IntegerField(default=0, verbose_name='Last processed membership id')),
+                ('processed', models.IntegerField(default=0, verbose_name='Processed memberships')),
+                ('cycles_created', models.IntegerField(default=0, verbose_name='Billing cycles created')),
+                ('reminders_sent', models.IntegerField(default=0, verbose_name='Reminders sent')),
+                ('error', models.TextField(verbose_name='Error', blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0008_billingrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentImport',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_hash', models.CharField(max_length=64, verbose_name='Content hash', db_index=True)),
+                ('format', models.CharField(max_length=16, verbose_name='File type')),
+                ('filename', models.CharField(max_length=255, verbose_name='File name', blank=True)),
+                ('imported', models.DateTimeField(auto_now_add=True, verbose_name='Imported')),
+                ('rows', models.IntegerField(default=0, verbose_name='Rows')),
+                ('new_rows', models.IntegerField(default=0, verbose_name='New rows')),
+                ('first_date', models.DateTimeField(null=True, verbose_name='First payment day', blank=True)),
+                ('last_date', models.DateTimeField(null=True, verbose_name='Last payment day', blank=True)),
+                ('first_transaction', models.CharField(max_length=30, verbose_name='First transaction id', blank=True)),
+                ('last_transaction', models.CharField(max_length=30, verbose_name='Last transaction id', blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.core.files.storage
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('membership', '0009_paymentimport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentImportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('csv_file', models.FileField(storage=django.core.files.storage.FileSystemStorage(location=settings.CACHE_DIRECTORY), upload_to='payment_imports', null=True, verbose_name='CSV File')),
+                ('filename', models.CharField(max_length=255, verbose_name='File name', blank=True)),
+                ('format', models.CharField(max_length=16, verbose_name='File type')),
+                ('status', models.CharField(default='Q', max_length=1, verbose_name='Status', db_index=True, choices=[('Q', 'Queued'), ('R', 'Running'), ('D', 'Done'), ('F', 'Failed')])),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('started', models.DateTimeField(null=True, verbose_name='Started', blank=True)),
+                ('finished', models.DateTimeField(null=True, verbose_name='Finished', blank=True)),
+                ('rows_total', models.IntegerField(default=0, verbose_name='Rows')),
+                ('rows_processed', models.IntegerField(default=0, verbose_name='Processed rows')),
+                ('attached', models.IntegerField(default=0, verbose_name='Attached payments')),
+                ('unknown', models.IntegerField(default=0, verbose_name='Unidentified payments')),
+                ('messages', models.TextField(verbose_name='Messages', blank=True)),
+                ('error', models.TextField(verbose_name='Error', blank=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, verbose_name='User', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+    ]
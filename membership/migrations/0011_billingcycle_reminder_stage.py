@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    def set_reminder_stages(apps, schema_editor):
+        BillingCycle = apps.get_model("membership", "BillingCycle")
+        Bill = apps.get_model("membership", "Bill")
+        # Same values as BillingCycle.reminder_stage_for()
+        cycle_ids = defaultdict(list)
+        counts = Bill.objects.order_by().values_list('billingcycle').annotate(models.Count('id'))
+        for cycle_id, bill_count in counts:
+            cycle_ids[min(bill_count, 3)].append(cycle_id)
+        for stage, ids in cycle_ids.items():
+            for i in range(0, len(ids), 500):
+                BillingCycle.objects.filter(id__in=ids[i:i + 500]).update(reminder_stage=stage)
+        paper_cycles = Bill.objects.filter(type='P').values('billingcycle')
+        BillingCycle.objects.filter(id__in=paper_cycles).update(reminder_stage=4)
+
+    dependencies = [
+        ('membership', '0010_paymentimportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingcycle',
+            name='reminder_stage',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Not billed'), (1, 'Billed'), (2, 'Reminded'), (3, 'Paper reminder due'), (4, 'Paper reminder sent')], default=0, verbose_name='Reminder stage'),
+        ),
+        migrations.AddIndex(
+            model_name='billingcycle',
+            index=models.Index(fields=['reminder_stage', 'is_paid'], name='membership_cycle_stage_paid'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['type', 'due_date'], name='membership_bill_type_due'),
+        ),
+        migrations.RunPython(set_reminder_stages, migrations.RunPython.noop),
+    ]
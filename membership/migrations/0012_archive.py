@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.core.files.storage
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('membership', '0011_billingcycle_reminder_stage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedBillingCycle',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('start', models.DateTimeField(verbose_name='Start')),
+                ('end', models.DateTimeField(verbose_name='End')),
+                ('sum', models.DecimalField(decimal_places=2, max_digits=6, verbose_name='Sum')),
+                ('is_paid', models.BooleanField(default=False, verbose_name='Is paid')),
+                ('reference_number', models.CharField(db_index=True, max_length=64, verbose_name='Reference number')),
+                ('reminder_stage', models.PositiveSmallIntegerField(choices=[(0, 'Not billed'), (1, 'Billed'), (2, 'Reminded'), (3, 'Paper reminder due'), (4, 'Paper reminder sent')], default=0, verbose_name='Reminder stage')),
+                ('membership', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='membership.Membership', verbose_name='Membership')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedBill',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('reminder_count', models.IntegerField(default=0, verbose_name='Reminder count')),
+                ('due_date', models.DateTimeField(verbose_name='Due date')),
+                ('created', models.DateTimeField(verbose_name='Created')),
+                ('last_changed', models.DateTimeField(verbose_name='Last changed')),
+                ('pdf_file', models.FileField(storage=django.core.files.storage.FileSystemStorage(location=settings.CACHE_DIRECTORY), null=True, upload_to=b'bill_pdfs')),
+                ('type', models.CharField(choices=[(b'E', 'Email'), (b'P', 'Paper'), (b'S', 'SMS')], default=b'E', max_length=1, verbose_name='Bill type')),
+                ('billingcycle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='membership.ArchivedBillingCycle', verbose_name='Cycle')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedCancelledBill',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(verbose_name='Created')),
+                ('exported', models.BooleanField(default=False)),
+                ('bill', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='membership.ArchivedBill', verbose_name='Original bill')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('ignore', models.BooleanField(default=False, verbose_name='Ignored payment')),
+                ('comment', models.CharField(blank=True, max_length=64, verbose_name='Comment')),
+                ('reference_number', models.CharField(blank=True, max_length=64, verbose_name='Reference number')),
+                ('message', models.CharField(blank=True, max_length=256, verbose_name='Message')),
+                ('transaction_id', models.CharField(max_length=30, unique=True, verbose_name='Transaction id')),
+                ('payment_day', models.DateTimeField(verbose_name='Payment day')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Amount')),
+                ('type', models.CharField(max_length=64, verbose_name='Type')),
+                ('payer_name', models.CharField(max_length=64, verbose_name='Payer name')),
+                ('duplicate', models.BooleanField(default=False, verbose_name='Duplicate payment')),
+                ('billingcycle', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='membership.ArchivedBillingCycle', verbose_name='Cycle')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedLogEntry',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('action_time', models.DateTimeField(verbose_name='action time')),
+                ('object_id', models.TextField(blank=True, null=True, verbose_name='object id')),
+                ('object_repr', models.CharField(max_length=200, verbose_name='object repr')),
+                ('action_flag', models.PositiveSmallIntegerField(verbose_name='action flag')),
+                ('change_message', models.TextField(blank=True, verbose_name='change message')),
+                ('content_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='contenttypes.ContentType', verbose_name='content type')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.core.files.storage
+from django.db import migrations, models
+import membership.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0012_archive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bill',
+            name='pdf_file',
+            field=models.FileField(null=True, storage=django.core.files.storage.FileSystemStorage(location=settings.CACHE_DIRECTORY), upload_to=membership.models.bill_pdf_path),
+        ),
+        migrations.AlterField(
+            model_name='archivedbill',
+            name='pdf_file',
+            field=models.FileField(null=True, storage=django.core.files.storage.FileSystemStorage(location=settings.CACHE_DIRECTORY), upload_to=membership.models.bill_pdf_path),
+        ),
+    ]
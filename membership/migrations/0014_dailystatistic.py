@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0013_bill_pdf_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True, verbose_name='Date')),
+                ('name', models.CharField(max_length=32, verbose_name='Statistic')),
+                ('key', models.CharField(blank=True, max_length=64, verbose_name='Key')),
+                ('value', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Value')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailystatistic',
+            unique_together=set([('name', 'key', 'date')]),
+        ),
+    ]
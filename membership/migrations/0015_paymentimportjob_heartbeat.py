@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0014_dailystatistic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentimportjob',
+            name='heartbeat',
+            field=models.DateTimeField(default=datetime.datetime.now, verbose_name='Last checkpoint'),
+        ),
+        migrations.AddField(
+            model_name='paymentimportjob',
+            name='attempts',
+            field=models.IntegerField(default=0, verbose_name='Attempts'),
+        ),
+    ]
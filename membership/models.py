@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict
 from datetime import datetime, timedelta
 from decimal import Decimal
+import hashlib
+import json
 import logging
+import posixpath
 from django.core.files.storage import FileSystemStorage
-from membership.billing.pdf_utils import get_bill_pdf, create_reminder_pdf
 
-from membership.reference_numbers import barcode_4, group_right,\
-    generate_membership_bill_reference_number
+from membership.reference_numbers import group_right,\
+    generate_membership_bill_reference_number, decode_membership_bill_reference_number,\
+    strip_reference_number, membership_bill_year, ReferenceNumberException
 
 logger = logging.getLogger("membership.models")
 import traceback
@@ -17,18 +21,19 @@ from cStringIO import StringIO
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.db import transaction
-from django.db.models import Q, Sum, Count
+from django.db.models import Q, F, Sum, Count, Prefetch, Case, When, Exists, OuterRef, Subquery
 from django.utils.translation import ugettext_lazy as _
 import django.utils.timezone
 from django.conf import settings
 from django.template.loader import render_to_string
+from django.core.mail import EmailMessage
 from django.forms import ValidationError
 
 from django.db.models.query import QuerySet
 
 from django.contrib.contenttypes.models import ContentType
 
-from utils import log_change, tupletuple_to_dict
+from utils import log_change, bulk_log_change, bake_log_entries, tupletuple_to_dict
 
 from membership.signals import send_as_email, send_preapprove_email, send_duplicate_payment_notice
 from email_utils import bill_sender, preapprove_email_sender, duplicate_payment_sender, format_email
@@ -65,6 +70,29 @@ MEMBER_STATUS = ((STATUS_NEW, _('New')),
                  (STATUS_DELETED, _('Deleted')))
 MEMBER_STATUS_DICT = tupletuple_to_dict(MEMBER_STATUS)
 
+# Allowed transitions From State: [TO STATES]
+ALLOWED_STATUS_TRANSITIONS = {
+    STATUS_NEW: [
+        STATUS_PREAPPROVED,
+        STATUS_DELETED
+    ],
+    STATUS_PREAPPROVED: [
+        STATUS_APPROVED,
+        STATUS_DELETED
+    ],
+    STATUS_APPROVED: [
+        STATUS_DIS_REQUESTED,
+        STATUS_DISASSOCIATED
+    ],
+    STATUS_DISASSOCIATED: [
+        STATUS_DELETED
+    ],
+    STATUS_DIS_REQUESTED: [
+        STATUS_DISASSOCIATED,
+        STATUS_APPROVED
+    ],
+}
+
 BILL_EMAIL = 'E'
 BILL_PAPER = 'P'
 BILL_SMS = 'S'
@@ -75,6 +103,21 @@ BILL_TYPES = (
 )
 BILL_TYPES_DICT = tupletuple_to_dict(BILL_TYPES)
 
+# BillingCycle.reminder_stage, maintained when bills are created, change type
+# or are deleted
+REMINDER_STAGE_NONE = 0
+REMINDER_STAGE_BILLED = 1
+REMINDER_STAGE_REMINDED = 2
+REMINDER_STAGE_PAPER_DUE = 3
+REMINDER_STAGE_PAPER_SENT = 4
+REMINDER_STAGES = (
+    (REMINDER_STAGE_NONE, _('Not billed')),
+    (REMINDER_STAGE_BILLED, _('Billed')),
+    (REMINDER_STAGE_REMINDED, _('Reminded')),
+    (REMINDER_STAGE_PAPER_DUE, _('Paper reminder due')),
+    (REMINDER_STAGE_PAPER_SENT, _('Paper reminder sent')),
+)
+
 def logging_log_change(sender, instance, created, **kwargs):
     operation = "created" if created else "modified"
     logger.info('%s %s: %s' % (sender.__name__, operation, repr(instance)))
@@ -123,30 +166,46 @@ class Contact(models.Model):
         billing = Q(billing_contact=self)
         tech = Q(tech_contact=self)
         refs = Membership.objects.filter(person | org | billing | tech)
-        if refs.count() == 0:
+        if not refs.exists():
             logger.info("Deleting contact %s: no more references (by %s)" % (
                 str(self), str(user)))
             self.logs.delete()
             self.delete()
 
     def find_memberid(self):
-        # Is there better way to find a memberid?
-        try:
-            return Membership.objects.get(person_id=self.id).id
-        except Membership.DoesNotExist:
-            pass
-        try:
-            return Membership.objects.get(organization_id=self.id).id
-        except Membership.DoesNotExist:
-            pass
-        try:
-            return Membership.objects.get(billing_contact_id=self.id).id
-        except Membership.DoesNotExist:
-            pass
-        try:
-            return Membership.objects.get(tech_contact_id=self.id).id
-        except Membership.DoesNotExist:
-             return None
+        # The person and organization references come before billing and tech
+        role = Case(When(person_id=self.id, then=0),
+                    When(organization_id=self.id, then=1),
+                    When(billing_contact_id=self.id, then=2),
+                    default=3, output_field=models.IntegerField())
+        ids = (Membership.objects.filter(Q(person_id=self.id) | Q(organization_id=self.id) |
+                                         Q(billing_contact_id=self.id) | Q(tech_contact_id=self.id))
+               .annotate(role=role).order_by('role', 'id').values_list('id', flat=True)[:1])
+        return ids[0] if ids else None
+
+    @classmethod
+    def orphans(cls):
+        """Contacts no membership refers to, found with one anti-join"""
+        return cls.objects.filter(person_set=None, billing_set=None,
+                                  tech_contact_set=None, organization_set=None)
+
+    @classmethod
+    def purge_orphans(cls, candidate_ids, chunk_size=500):
+        """Deletes the orphans() among candidate_ids and their change log,
+        returns the number of deleted contacts"""
+        candidate_ids = sorted(set(candidate_ids))
+        ids = []
+        for i in xrange(0, len(candidate_ids), chunk_size):
+            ids.extend(cls.orphans().filter(id__in=candidate_ids[i:i + chunk_size])
+                       .values_list('id', flat=True))
+        content_type = ContentType.objects.get_for_model(cls)
+        for i in xrange(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            content_type.logentry_set.filter(object_id__in=[unicode(id) for id in chunk]).delete()
+            cls.objects.filter(id__in=chunk).delete()
+        if ids:
+            logger.info("Deleted %d contacts with no more references" % len(ids))
+        return len(ids)
 
     def email_to(self):
         if self.email:
@@ -301,34 +360,12 @@ class Membership(models.Model):
         super(Membership, self).save(*args, **kwargs)
 
     def _change_status(self, new_status):
-        # Allowed transitions From State: [TO STATES]
-        _allowed_transitions = {
-            STATUS_NEW: [
-                STATUS_PREAPPROVED,
-                STATUS_DELETED
-            ],
-            STATUS_PREAPPROVED: [
-                STATUS_APPROVED,
-                STATUS_DELETED
-            ],
-            STATUS_APPROVED: [
-                STATUS_DIS_REQUESTED,
-                STATUS_DISASSOCIATED
-            ],
-            STATUS_DISASSOCIATED: [
-                STATUS_DELETED
-            ],
-            STATUS_DIS_REQUESTED: [
-                STATUS_DISASSOCIATED,
-                STATUS_APPROVED
-            ],
-        }
         with transaction.atomic():
             me = Membership.objects.select_for_update().filter(pk=self.pk)[0]
             current_status = me.status
             if new_status == current_status:
                 raise MembershipAlreadyStatus("Membership is already {status}".format(status=new_status))
-            elif new_status not in _allowed_transitions[current_status]:
+            elif new_status not in ALLOWED_STATUS_TRANSITIONS[current_status]:
                 raise MembershipOperationError("Membership status can't change from {current} to {new}".format(
                     current=current_status, new=new_status))
             me.status = new_status
@@ -371,6 +408,87 @@ class Membership(models.Model):
         self._change_status(new_status=STATUS_APPROVED)
         log_change(self, user, change_message="Approved")
 
+    @classmethod
+    def _bulk_change_status(cls, ids, new_status, user, change_message, dry_run=False):
+        """
+        Changes the status of many memberships with a fixed number of queries.
+
+        Preapproval, approval and dissociation are supported. Returns a dict
+        of per-id results ('ok', 'already', 'not_found' or
+        'invalid_transition') and the list of changed memberships. With
+        dry_run nothing is changed and the list has the memberships that
+        would be.
+        """
+        assert user is not None or dry_run
+        assert new_status in (STATUS_PREAPPROVED, STATUS_APPROVED, STATUS_DISASSOCIATED)
+        ids = set(ids)
+        results = dict((id, 'not_found') for id in ids)
+        with transaction.atomic():
+            locked = cls.objects.select_for_update().filter(pk__in=ids)
+            changed_ids = []
+            for id, status in locked.values_list('id', 'status'):
+                if status == new_status:
+                    results[id] = 'already'
+                elif new_status not in ALLOWED_STATUS_TRANSITIONS.get(status, []):
+                    results[id] = 'invalid_transition'
+                else:
+                    results[id] = 'ok'
+                    changed_ids.append(id)
+            if not changed_ids:
+                return results, []
+
+            now = datetime.now()
+            changed = cls.objects.filter(pk__in=changed_ids)
+            if dry_run:
+                return results, list(changed.select_related('person', 'organization').order_by('id'))
+            if new_status == STATUS_APPROVED:
+                # Preserve original approve time (cancel dissociation)
+                changed.filter(approved__isnull=True).update(approved=now)
+                changed.update(status=new_status, dissociation_requested=None, last_changed=now)
+            elif new_status == STATUS_DISASSOCIATED:
+                cls.bulk_cancel_outstanding_bills(changed_ids)
+                changed.update(status=new_status, dissociated=now, last_changed=now)
+            else:
+                changed.update(status=new_status, last_changed=now)
+
+            memberships = list(changed.select_related('person', 'organization').order_by('id'))
+            bulk_log_change(memberships, user, change_message=change_message)
+        for membership in memberships:
+            logger.info('Membership modified: %s' % repr(membership))
+        return results, memberships
+
+    @classmethod
+    def bulk_preapprove(cls, ids, user):
+        results, memberships = cls._bulk_change_status(ids, STATUS_PREAPPROVED, user,
+                                                       change_message="Preapproved")
+        for membership in memberships:
+            ret_items = send_preapprove_email.send_robust(cls, instance=membership, user=user)
+            for sender, error in ret_items:
+                if error is not None:
+                    raise error
+        logger.info("%d memberships preapproved." % len(memberships))
+        return results
+
+    @classmethod
+    def bulk_approve(cls, ids, user):
+        results, memberships = cls._bulk_change_status(ids, STATUS_APPROVED, user,
+                                                       change_message="Approved")
+        logger.info("%d memberships approved." % len(memberships))
+        return results
+
+    @classmethod
+    def bulk_dissociate(cls, ids, user, dry_run=False):
+        """
+        Dissociates many memberships and cancels their outstanding bills
+        like dissociate(). Returns the per-id results of
+        _bulk_change_status() and the list of (to be) dissociated memberships.
+        """
+        results, memberships = cls._bulk_change_status(ids, STATUS_DISASSOCIATED, user,
+                                                       change_message="Dissociated", dry_run=dry_run)
+        if not dry_run:
+            logger.info("%d memberships dissociated." % len(memberships))
+        return results, memberships
+
     def request_dissociation(self, user):
         assert user is not None
         self._change_status(new_status='S')
@@ -400,6 +518,28 @@ class Membership(models.Model):
         except ObjectDoesNotExist:
             return  # No billing cycle, no need to cancel bills
 
+    @classmethod
+    def bulk_cancel_outstanding_bills(cls, ids):
+        """
+        cancel_outstanding_bills() for the memberships with ids, with a
+        fixed number of queries. Returns the created CancelledBills.
+        """
+        latest_cycle = (BillingCycle.objects.filter(membership=OuterRef('membership'))
+                        .order_by('-start').values('id')[:1])
+        first_bill = Bill.objects.filter(billingcycle=OuterRef('pk')).order_by('due_date').values('id')[:1]
+        first_bill_ids = (BillingCycle.objects.filter(membership__in=ids)
+                          .annotate(latest_cycle=Subquery(latest_cycle), first_bill=Subquery(first_bill))
+                          .filter(id=F('latest_cycle'), is_paid=False)
+                          .values_list('first_bill', flat=True))
+        bills = (Bill.objects.filter(id__in=[id for id in first_bill_ids if id is not None],
+                                     reminder_count=0, cancelledbill__isnull=True)
+                 .select_related('billingcycle'))
+        cancelled = CancelledBill.objects.bulk_create([CancelledBill(bill=bill) for bill in bills])
+        for cancelled_bill in cancelled:
+            logger.info("Created CancelledBill for Member #{member} bill {bill.pk}".format(
+                bill=cancelled_bill.bill, member=cancelled_bill.bill.billingcycle.membership_id))
+        return cancelled
+
     @transaction.atomic
     def delete_membership(self, user):
         assert user is not None
@@ -432,6 +572,99 @@ class Membership(models.Model):
                 contact.delete_if_no_references(user)
         log_change(self, user, change_message="Deleted")
 
+    @classmethod
+    def purge(cls, ids, user, dry_run=False, chunk_size=500):
+        """
+        delete_membership() for many memberships in one transaction with
+        bulk updates and deletes, followed by Contact.purge_orphans() for
+        the contacts of the deleted memberships. Memberships that can not be deleted are skipped. Returns a dict of
+        counts of deleted memberships, deleted services and aliases,
+        expired aliases and deleted contacts. With dry_run the transaction
+        is rolled back.
+        """
+        # must be imported here due to cyclic imports
+        from services.models import Alias, Service
+        assert user is not None or dry_run
+        deletable = [status for status, targets in ALLOWED_STATUS_TRANSITIONS.items()
+                     if STATUS_DELETED in targets]
+        counts = dict.fromkeys(['memberships', 'services', 'aliases_deleted',
+                                'aliases_expired', 'contacts'], 0)
+        ids = sorted(set(ids))
+        now = datetime.now()
+        contact_ids = set()
+        with transaction.atomic():
+            for i in xrange(0, len(ids), chunk_size):
+                locked = cls.objects.select_for_update().filter(pk__in=ids[i:i + chunk_size],
+                                                                status__in=deletable)
+                rows = list(locked.values_list('id', 'status', 'person_id', 'organization_id',
+                                               'billing_contact_id', 'tech_contact_id'))
+                if not rows:
+                    continue
+                new_ids = [row[0] for row in rows if row[1] == STATUS_NEW]
+                other_ids = [row[0] for row in rows if row[1] != STATUS_NEW]
+                contact_ids.update(id for row in rows for id in row[2:] if id is not None)
+                changed_ids = new_ids + other_ids
+
+                # Applications lose their services and aliases, members keep
+                # the aliases reserved until they expire
+                __, deleted = Service.objects.filter(owner__in=new_ids).delete()
+                counts['services'] += deleted.get(Service._meta.label, 0)
+                __, deleted = Alias.objects.filter(owner__in=new_ids).delete()
+                counts['aliases_deleted'] += deleted.get(Alias._meta.label, 0)
+                counts['aliases_expired'] += (Alias.objects.filter(owner__in=other_ids)
+                                              .filter(Q(expiration_date__isnull=True) |
+                                                      Q(expiration_date__gt=now))
+                                              .update(expiration_date=now))
+
+                cls.objects.filter(pk__in=changed_ids).update(
+                    status=STATUS_DELETED, person=None, billing_contact=None, tech_contact=None,
+                    organization=None, municipality='', birth_year=None,
+                    organization_registration_number='', last_changed=now)
+                if user is not None:
+                    bulk_log_change(list(cls.objects.filter(pk__in=changed_ids).order_by('id')),
+                                    user, change_message="Deleted")
+                counts['memberships'] += len(changed_ids)
+            counts['contacts'] = Contact.purge_orphans(contact_ids, chunk_size=chunk_size)
+            if dry_run:
+                # Everything is done to get exact counts, then undone
+                transaction.set_rollback(True)
+                return counts
+        logger.info("Purged %(memberships)d memberships, %(services)d services, "
+                    "%(aliases_deleted)d aliases and %(contacts)d contacts, "
+                    "expired %(aliases_expired)d aliases." % counts)
+        return counts
+
+    def dossier(self, include_archived=False):
+        """
+        Collects everything shown on the membership detail page with a fixed
+        number of queries, however long the billing history is.
+
+        Billing cycles get prefetched bills and payments lists and a
+        cancelled flag, bills have their cancellation prefetched. With
+        include_archived the archived cycles are listed first.
+        """
+        from services.models import Service
+        from membership.archive import archived_cycles
+        cycles = list(self.billingcycle_set.order_by('start', 'id').prefetch_related(
+            Prefetch('bill_set', to_attr='bills',
+                     queryset=Bill.objects.select_related('cancelledbill').order_by('id')),
+            Prefetch('payment_set', to_attr='payments',
+                     queryset=Payment.objects.order_by('payment_day', 'id'))))
+        for cycle in cycles:
+            # Same as BillingCycle.is_cancelled() without the extra queries
+            bills = sorted(cycle.bills, key=lambda bill: bill.due_date)
+            cycle.cancelled = bool(bills) and bills[0].is_cancelled()
+        if include_archived:
+            cycles = archived_cycles(self) + cycles
+        return {
+            'cycles': cycles,
+            'has_archived': (include_archived or
+                             ArchivedBillingCycle.objects.filter(membership=self).exists()),
+            'aliases': list(self.alias_set.all()),
+            'services': list(Service.objects.filter(owner=self).select_related('servicetype', 'alias')),
+            'logentries': bake_log_entries(self.logs.select_related('user')),
+        }
+
     def duplicates(self):
         """
         Finds duplicates of memberships, looks for similar names, emails, phone
@@ -529,18 +762,13 @@ class Membership(models.Model):
 
     @classmethod
     def paper_reminder_sent_unpaid_after(cls, days=14):
-        unpaid_filter = Q(billingcycle__is_paid=False)
-        type_filter = Q(type=BILL_PAPER)
-        date_filter = Q(due_date__lt=datetime.now() - timedelta(days=days))
-        not_deleted_filter = Q(billingcycle__membership__status__exact=STATUS_APPROVED)
-        bill_qs = Bill.objects.filter(unpaid_filter, type_filter, date_filter,
-                                      not_deleted_filter)
-
-        membership_ids = set()
-        for bill in bill_qs:
-            membership_ids.add(bill.billingcycle.membership.id)
-
-        return Membership.objects.filter(id__in=membership_ids)
+        overdue_paper_bills = Bill.objects.filter(billingcycle__membership=OuterRef('pk'),
+                                                  billingcycle__is_paid=False,
+                                                  type=BILL_PAPER,
+                                                  due_date__lt=datetime.now() - timedelta(days=days))
+        return (Membership.objects.filter(status=STATUS_APPROVED)
+                .annotate(paper_reminder_overdue=Exists(overdue_paper_bills))
+                .filter(paper_reminder_overdue=True))
 
     def __repr__(self):
         plain_self = unicode(self).encode('ASCII', 'backslashreplace')
@@ -603,13 +831,18 @@ class BillingCycle(models.Model):
             ("read_bills", "Can read billing details"),
             ("manage_bills", "Can manage billing"),
         )
+        indexes = [
+            models.Index(fields=['reminder_stage', 'is_paid'], name='membership_cycle_stage_paid'),
+        ]
 
     membership = models.ForeignKey('Membership', verbose_name=_('Membership'))
     start =  models.DateTimeField(default=django.utils.timezone.now, verbose_name=_('Start'))
     end =  models.DateTimeField(verbose_name=_('End'))
     sum = models.DecimalField(_('Sum'), max_digits=6, decimal_places=2) # This limits sum to 9999,99
     is_paid = models.BooleanField(default=False, verbose_name=_('Is paid'))
-    reference_number = models.CharField(max_length=64, verbose_name=_('Reference number')) # NOT an integer since it can begin with 0 XXX: format
+    reference_number = models.CharField(max_length=64, verbose_name=_('Reference number'), db_index=True) # NOT an integer since it can begin with 0 XXX: format
+    reminder_stage = models.PositiveSmallIntegerField(choices=REMINDER_STAGES, default=REMINDER_STAGE_NONE,
+                                                      verbose_name=_('Reminder stage'))
     logs = property(_get_logs)
 
     objects = BillingCycleManager()
@@ -696,6 +929,37 @@ class BillingCycle(models.Model):
             return first_bill.is_cancelled()
         return False
 
+    @classmethod
+    def get_by_reference_number(cls, reference):
+        """
+        Finds the cycle paid with reference. The reference is looked up as
+        such first, since stored references may begin with 0, and then
+        without bank formatting. Stored references are not regenerated when
+        a cycle changes, so a membership bill reference is decoded to a
+        lookup by membership id and cycle start year only as a last resort.
+        Raises BillingCycle.DoesNotExist.
+        """
+        try:
+            return cls.objects.get(reference_number=reference)
+        except cls.DoesNotExist:
+            pass
+        stripped = strip_reference_number(reference)
+        if stripped != reference:
+            try:
+                return cls.objects.get(reference_number=stripped)
+            except cls.DoesNotExist:
+                pass
+        try:
+            membership_id, year = decode_membership_bill_reference_number(stripped)
+        except ReferenceNumberException:
+            raise cls.DoesNotExist("No billing cycle with reference number %s" % reference)
+        cycles = list(cls.objects.filter(membership_id=membership_id,
+                                         start__year=membership_bill_year(year))[:2])
+        if len(cycles) != 1:
+            # An ambiguous year does not identify the cycle
+            raise cls.DoesNotExist("No billing cycle with reference number %s" % reference)
+        return cycles[0]
+
     @classmethod
     def get_reminder_billingcycles(cls, memberid=None):
         """
@@ -711,17 +975,16 @@ class BillingCycle(models.Model):
         # Single membership case
         if memberid:
             logger.info('memberid: %s' % memberid)
+            paper_bills = Bill.objects.filter(billingcycle=OuterRef('pk'), type=BILL_PAPER)
             qs = qs.filter(membership__id=memberid)
-            qs = qs.exclude(bill__type=BILL_PAPER)
+            qs = qs.annotate(has_paper_bill=Exists(paper_bills)).filter(has_paper_bill=False)
             return qs
 
         # For all memberships in Approved state
-        qs = qs.annotate(bills=Count('bill'))
-        qs = qs.filter(bills__gt=2,
+        qs = qs.filter(reminder_stage=REMINDER_STAGE_PAPER_DUE,
                        is_paid__exact=False,
                        membership__status=STATUS_APPROVED,
                        membership__id__gt=-1)
-        qs = qs.exclude(bill__type=BILL_PAPER)
         qs = qs.order_by('start')
 
         return qs
@@ -732,6 +995,8 @@ class BillingCycle(models.Model):
         cycles = cls.create_paper_reminder_list(memberid)
         if len(cycles) == 0:
             return None
+        # ReportLab is slow to import, load it only when rendering
+        from membership.billing.pdf_utils import create_reminder_pdf
         create_reminder_pdf(cycles, buffer, payments=Payment)
         pdf_content = buffer.getvalue()
         buffer.close()
@@ -744,19 +1009,42 @@ class BillingCycle(models.Model):
         :param memberid: optional member id
         :return: list of billingcycles
         """
-        datalist = []
-        for cycle in cls.get_reminder_billingcycles(memberid).all():
-            # check if paper reminder already sent
-            cont = False
-            for bill in cycle.bill_set.all():
-                if bill.type == BILL_PAPER:
-                    cont = True
-                    break
-            if cont:
-                continue
+        # get_reminder_billingcycles() already excludes cycles with a paper bill
+        return list(cls.get_reminder_billingcycles(memberid))
+
+    @staticmethod
+    def reminder_stage_for(bill_count, paper_bill_count):
+        if paper_bill_count:
+            return REMINDER_STAGE_PAPER_SENT
+        return min(bill_count, REMINDER_STAGE_PAPER_DUE)
+
+    def update_reminder_stage(self):
+        """Recomputes reminder_stage from the bills of the cycle"""
+        counts = self.bill_set.aggregate(bills=Count('id'),
+                                         paper_bills=Count(Case(When(type=BILL_PAPER, then=1))))
+        self.reminder_stage = self.reminder_stage_for(counts['bills'], counts['paper_bills'])
+        BillingCycle.objects.filter(pk=self.pk).update(reminder_stage=self.reminder_stage)
 
-            datalist.append(cycle)
-        return datalist
+    @classmethod
+    def update_reminder_stages(cls, cycle_ids, chunk_size=500):
+        """update_reminder_stage() for many cycles with one aggregate query
+        and one update per stage in each chunk"""
+        cycle_ids = sorted(set(cycle_ids))
+        for i in xrange(0, len(cycle_ids), chunk_size):
+            chunk = cycle_ids[i:i + chunk_size]
+            stage_ids = defaultdict(list)
+            counts = (Bill.objects.filter(billingcycle__in=chunk).order_by()
+                      .values('billingcycle')
+                      .annotate(bills=Count('id'), paper_bills=Count(Case(When(type=BILL_PAPER, then=1))))
+                      .values_list('billingcycle', 'bills', 'paper_bills'))
+            billed = set()
+            for cycle_id, bill_count, paper_bill_count in counts:
+                stage_ids[cls.reminder_stage_for(bill_count, paper_bill_count)].append(cycle_id)
+                billed.add(cycle_id)
+            stage_ids[REMINDER_STAGE_NONE] = [id for id in chunk if id not in billed]
+            for stage, ids in stage_ids.items():
+                if ids:
+                    cls.objects.filter(id__in=ids).update(reminder_stage=stage)
 
 
     def end_date(self):
@@ -786,6 +1074,18 @@ class BillingCycle(models.Model):
 
 cache_storage = FileSystemStorage(location=settings.CACHE_DIRECTORY)
 
+BILL_PDF_DIRECTORY = "bill_pdfs"
+
+
+def bill_pdf_path(instance, filename):
+    """
+    Path of a bill PDF in cache_storage. The files are spread into 256 * 256
+    directories by the hash of the file name, so that no directory grows
+    too large to list or look up quickly.
+    """
+    digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    return posixpath.join(BILL_PDF_DIRECTORY, digest[:2], digest[2:4], filename)
+
 
 class CancelledBill(models.Model):
     """List of bills that have been cancelled"""
@@ -802,13 +1102,18 @@ class CancelledBill(models.Model):
 
 
 class Bill(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['type', 'due_date'], name='membership_bill_type_due'),
+        ]
+
     billingcycle = models.ForeignKey(BillingCycle, verbose_name=_('Cycle'))
     reminder_count = models.IntegerField(default=0, verbose_name=_('Reminder count'))
     due_date = models.DateTimeField(verbose_name=_('Due date'))
 
     created = models.DateTimeField(auto_now_add=True, verbose_name=_('Created'))
     last_changed = models.DateTimeField(auto_now=True, verbose_name=_('Last changed'))
-    pdf_file = models.FileField(upload_to="bill_pdfs", storage=cache_storage, null=True)
+    pdf_file = models.FileField(upload_to=bill_pdf_path, storage=cache_storage, null=True)
     type = models.CharField(max_length=1, choices=BILL_TYPES, blank=False, null=False, verbose_name=_('Bill type'), default='E')
     logs = property(_get_logs)
 
@@ -824,7 +1129,35 @@ class Bill(models.Model):
             # Second is from reminder_count so that tests can assume due_date
             # is monotonically increasing
             self.due_date = self.due_date.replace(hour=23, minute=59, second=self.reminder_count % 60)
+        adding = self.pk is None
         super(Bill, self).save(*args, **kwargs)
+        # The type of a bill may be changed in the admin
+        if adding or self.type != getattr(self, '_loaded_type', None):
+            self.billingcycle.update_reminder_stage()
+        self._loaded_type = self.type
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        bill = super(Bill, cls).from_db(db, field_names, values)
+        # Without triggering a query if the type is deferred
+        bill._loaded_type = bill.__dict__.get('type')
+        return bill
+
+    @classmethod
+    def bulk_delete(cls, queryset, update_reminder_stages=True):
+        """
+        Deletes the bills of queryset with one query, without the per-bill
+        post_delete handler, and updates the reminder stages of their cycles
+        at once. The update can be skipped when the cycles are deleted too.
+        Cancellations of the bills must be deleted first. Returns the number
+        of deleted bills.
+        """
+        if update_reminder_stages:
+            cycle_ids = list(queryset.order_by().values_list('billingcycle', flat=True).distinct())
+        count = queryset._raw_delete(queryset.db)
+        if update_reminder_stages:
+            BillingCycle.update_reminder_stages(cycle_ids)
+        return count
 
     def is_reminder(self):
         return self.reminder_count > 0
@@ -838,81 +1171,61 @@ class Bill(models.Model):
         return False
 
     # FIXME: different template based on class? should this code be here?
-    def render_as_text(self):
+    def render_as_text(self, context=None):
         """
         Renders the object as text suitable for sending as e-mail.
+
+        :param context: precomputed bill context, see membership.billing.bill_context
         """
-        membership = self.billingcycle.membership
-        vat = Decimal(self.billingcycle.get_vat_percentage()) / Decimal(100)
-        if not self.is_reminder():
-            non_vat_amount = (self.billingcycle.sum / (Decimal(1) + vat))
-            return render_to_string('membership/bill.txt', {
-                'membership_type' : MEMBER_TYPES_DICT[membership.type],
-                'membership_type_raw' : membership.type,
-                'bill_id': self.id,
-                'member_id': membership.id,
-                'member_name': membership.name(),
-                'billing_contact': membership.billing_contact,
-                'billing_name': unicode(membership.get_billing_contact()),
-                'street_address': membership.get_billing_contact().street_address,
-                'postal_code': membership.get_billing_contact().postal_code,
-                'post_office': membership.get_billing_contact().post_office,
-                'billingcycle': self.billingcycle,
-                'iban_account_number': settings.IBAN_ACCOUNT_NUMBER,
-                'bic_code': settings.BIC_CODE,
-                'due_date': self.due_date,
-                'today': datetime.now(),
-                'reference_number': group_right(self.billingcycle.reference_number),
-                'sum': self.billingcycle.sum,
-                'vat_amount': vat * non_vat_amount,
-                'non_vat_amount': non_vat_amount,
-                'vat_percentage': self.billingcycle.get_vat_percentage(),
-                'barcode': barcode_4(iban = settings.IBAN_ACCOUNT_NUMBER,
-                                     refnum = self.billingcycle.reference_number,
-                                     duedate = self.due_date,
-                                     euros = self.billingcycle.sum)
-                })
+        if context is None:
+            from membership.billing.bill_context import bill_context
+            context = bill_context(self, payments=Payment)
+        membership = context['membership']
+        billing_contact = context['billing_contact']
+        common = {
+            'membership_type' : MEMBER_TYPES_DICT[membership.type],
+            'membership_type_raw' : membership.type,
+            'bill_id': self.id,
+            'member_id': context['member_id'],
+            'member_name': context['name'],
+            'billing_contact': membership.billing_contact,
+            'billing_name': unicode(billing_contact),
+            'street_address': billing_contact.street_address,
+            'postal_code': billing_contact.postal_code,
+            'post_office': billing_contact.post_office,
+            'billingcycle': self.billingcycle,
+            'iban_account_number': settings.IBAN_ACCOUNT_NUMBER,
+            'bic_code': settings.BIC_CODE,
+            'today': datetime.now(),
+            'reference_number': group_right(context['reference_number']),
+            'sum': context['sum'],
+            'vat_amount': context['vat_amount'],
+            'non_vat_amount': context['non_vat_amount'],
+            'vat_percentage': context['vat_percentage'],
+            'barcode': context['barcode'],
+        }
+        if not context['reminder']:
+            common['due_date'] = self.due_date
+            return render_to_string('membership/bill.txt', common)
         else:
-            amount_paid = self.billingcycle.amount_paid()
-            sum = self.billingcycle.sum - amount_paid
-            non_vat_amount = sum / (Decimal(1) + vat)
-            return render_to_string('membership/reminder.txt', {
-                'membership_type' : MEMBER_TYPES_DICT[membership.type],
-                'membership_type_raw' : membership.type,
-                'bill_id': self.id,
-                'member_id': membership.id,
-                'member_name': membership.name(),
-                'billing_contact': membership.billing_contact,
-                'billing_name': unicode(membership.get_billing_contact()),
-                'street_address': membership.get_billing_contact().street_address,
-                'postal_code': membership.get_billing_contact().postal_code,
-                'post_office': membership.get_billing_contact().post_office,
+            common.update({
                 'municipality': membership.municipality,
-                'billing_email': membership.get_billing_contact().email,
+                'billing_email': billing_contact.email,
                 'email': membership.primary_contact().email,
-                'billingcycle': self.billingcycle,
-                'iban_account_number': settings.IBAN_ACCOUNT_NUMBER,
-                'bic_code': settings.BIC_CODE,
-                'today': datetime.now(),
-                'latest_recorded_payment': Payment.latest_payment_date(),
-                'reference_number': group_right(self.billingcycle.reference_number),
-                'original_sum': self.billingcycle.sum,
-                'amount_paid': amount_paid,
-                'sum': sum,
-                'vat_amount': vat * non_vat_amount,
-                'non_vat_amount':   non_vat_amount,
-                'vat_percentage': self.billingcycle.get_vat_percentage(),
-                'barcode': barcode_4(iban = settings.IBAN_ACCOUNT_NUMBER,
-                                     refnum = self.billingcycle.reference_number,
-                                     duedate = None,
-                                     euros = sum)
-                })
-
-    def generate_pdf(self):
+                'latest_recorded_payment': context['latest_payment_date'],
+                'original_sum': context['original_sum'],
+                'amount_paid': context['amount_paid'],
+            })
+            return render_to_string('membership/reminder.txt', common)
+
+    def generate_pdf(self, context=None):
         """
         Generate pdf and return pdf content
+
+        :param context: precomputed bill context, see membership.billing.bill_context
         """
-        return get_bill_pdf(self, payments=Payment)
+        from membership.billing.pdf_utils import get_bill_pdf
+        return get_bill_pdf(self, payments=Payment, context=context)
 
 
     # FIXME: Should save sending date
@@ -1001,7 +1314,7 @@ class Payment(models.Model):
     def send_duplicate_payment_notice(self, user, **kwargs):
         if not user:
             raise Exception('send_duplicate_payment_notice user objects as parameter')
-        billingcycle = BillingCycle.objects.get(reference_number=self.reference_number)
+        billingcycle = BillingCycle.get_by_reference_number(self.reference_number)
         if billingcycle.sum > 0:
             ret_items = send_duplicate_payment_notice.send_robust(self.__class__, instance=self, user=user, billingcycle=billingcycle)
             for item in ret_items:
@@ -1028,6 +1341,279 @@ class ApplicationPoll(models.Model):
     date = models.DateTimeField(auto_now=True, verbose_name=_('Timestamp'))
     answer = models.CharField(max_length=512, verbose_name=_('Service specific data'))
 
+
+class DailyStatistic(models.Model):
+    """
+    One value of a daily membership statistics rollup, e.g. the number of
+    approved memberships (name 'status', key 'A') on a date. Filled in by
+    the rollup_statistics command, see membership.statistics.
+    """
+    class Meta:
+        unique_together = ('name', 'key', 'date')
+
+    date = models.DateField(db_index=True, verbose_name=_('Date'))
+    name = models.CharField(max_length=32, verbose_name=_('Statistic'))
+    key = models.CharField(max_length=64, blank=True, verbose_name=_('Key'))
+    value = models.DecimalField(max_digits=12, decimal_places=2, verbose_name=_('Value'))
+
+    def __unicode__(self):
+        return u"%s %s %s: %s" % (self.date, self.name, self.key, self.value)
+
+QUEUED_EMAIL_STATUS = (('Q', _('Queued')),
+                       ('S', _('Sent')),
+                       ('F', _('Failed')))
+
+
+class QueuedEmail(models.Model):
+    """
+    Outgoing email stored in the database until the send_queued_email
+    command delivers it, so request handlers never wait for the mail relay.
+    """
+
+    message = models.TextField(verbose_name=_('Message'))
+    status = models.CharField(max_length=1, choices=QUEUED_EMAIL_STATUS, default='Q',
+                              db_index=True, verbose_name=_('Status'))
+    created = models.DateTimeField(auto_now_add=True, verbose_name=_('Created'))
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True,
+                                        verbose_name=_('Next delivery attempt'))
+    attempts = models.IntegerField(default=0, verbose_name=_('Delivery attempts'))
+    last_error = models.TextField(blank=True, verbose_name=_('Last delivery error'))
+    sent = models.DateTimeField(null=True, blank=True, verbose_name=_('Sent'))
+
+    @classmethod
+    def enqueue(cls, email):
+        """Stores an EmailMessage without attachments for delivery"""
+        if email.attachments:
+            raise ValueError("Queued emails can not have attachments")
+        message = {
+            'subject': unicode(email.subject),
+            'body': unicode(email.body),
+            'from_email': unicode(email.from_email),
+            'to': [unicode(address) for address in email.to],
+            'cc': [unicode(address) for address in email.cc],
+            'bcc': [unicode(address) for address in email.bcc],
+            'headers': dict((unicode(k), unicode(v)) for k, v in email.extra_headers.items()),
+        }
+        queued = cls.objects.create(message=json.dumps(message))
+        logger.info(u"Email %s queued to %s" % (queued.id, ", ".join(message['to'])))
+        return queued
+
+    def to_message(self):
+        return EmailMessage(**json.loads(self.message))
+
+    def __unicode__(self):
+        return u"%s %s" % (self.id, self.get_status_display())
+
+
+class PaymentImport(models.Model):
+    """
+    Registry of imported payment files. A file with the same content hash
+    is not processed again, and only the rows with new transaction ids of
+    an overlapping file are.
+    """
+
+    content_hash = models.CharField(max_length=64, db_index=True, verbose_name=_('Content hash'))
+    format = models.CharField(max_length=16, verbose_name=_('File type'))
+    filename = models.CharField(max_length=255, blank=True, verbose_name=_('File name'))
+    imported = models.DateTimeField(auto_now_add=True, verbose_name=_('Imported'))
+    rows = models.IntegerField(default=0, verbose_name=_('Rows'))
+    new_rows = models.IntegerField(default=0, verbose_name=_('New rows'))
+    first_date = models.DateTimeField(null=True, blank=True, verbose_name=_('First payment day'))
+    last_date = models.DateTimeField(null=True, blank=True, verbose_name=_('Last payment day'))
+    first_transaction = models.CharField(max_length=30, blank=True, verbose_name=_('First transaction id'))
+    last_transaction = models.CharField(max_length=30, blank=True, verbose_name=_('Last transaction id'))
+
+    def __unicode__(self):
+        return u"%s %s" % (self.filename or self.content_hash[:12], self.imported)
+
+
+PAYMENT_IMPORT_JOB_STATUS = (('Q', _('Queued')),
+                             ('R', _('Running')),
+                             ('D', _('Done')),
+                             ('F', _('Failed')))
+
+
+class PaymentImportJob(models.Model):
+    """
+    Uploaded payment file waiting for or processed by the
+    process_payment_imports command. The counters are updated while the
+    file is processed and the import messages are stored when it is done.
+    A running job whose heartbeat is older than the lease of the command
+    is assumed to have lost its worker.
+    """
+
+    csv_file = models.FileField(upload_to="payment_imports", storage=cache_storage, null=True,
+                                verbose_name=_('CSV File'))
+    filename = models.CharField(max_length=255, blank=True, verbose_name=_('File name'))
+    format = models.CharField(max_length=16, verbose_name=_('File type'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                             on_delete=models.SET_NULL, verbose_name=_('User'))
+    status = models.CharField(max_length=1, choices=PAYMENT_IMPORT_JOB_STATUS, default='Q',
+                              db_index=True, verbose_name=_('Status'))
+    created = models.DateTimeField(auto_now_add=True, verbose_name=_('Created'))
+    started = models.DateTimeField(null=True, blank=True, verbose_name=_('Started'))
+    heartbeat = models.DateTimeField(default=datetime.now, verbose_name=_('Last checkpoint'))
+    finished = models.DateTimeField(null=True, blank=True, verbose_name=_('Finished'))
+    attempts = models.IntegerField(default=0, verbose_name=_('Attempts'))
+    rows_total = models.IntegerField(default=0, verbose_name=_('Rows'))
+    rows_processed = models.IntegerField(default=0, verbose_name=_('Processed rows'))
+    attached = models.IntegerField(default=0, verbose_name=_('Attached payments'))
+    unknown = models.IntegerField(default=0, verbose_name=_('Unidentified payments'))
+    messages = models.TextField(blank=True, verbose_name=_('Messages'))
+    error = models.TextField(blank=True, verbose_name=_('Error'))
+
+    def import_messages(self):
+        """(cycle id, payment id, message) tuples as returned by process_payments()"""
+        if not self.messages:
+            return []
+        return [tuple(message) for message in json.loads(self.messages)]
+
+    def is_finished(self):
+        return self.status in ('D', 'F')
+
+    def progress(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'status_display': unicode(self.get_status_display()),
+            'finished': self.is_finished(),
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed,
+            'attached': self.attached,
+            'unknown': self.unknown,
+        }
+
+    def __unicode__(self):
+        return u"%s %s" % (self.filename, self.get_status_display())
+
+
+BILLING_RUN_STATUS = (('R', _('Running')),
+                      ('D', _('Done')),
+                      ('F', _('Failed')))
+
+
+class BillingRun(models.Model):
+    """
+    Progress of a makebills run. Memberships are processed in id order, so
+    everything up to last_membership_id is done and a failed run can be
+    resumed from there. The unique lock column is set while the run is
+    active, which prevents concurrent runs.
+    """
+
+    started = models.DateTimeField(auto_now_add=True, verbose_name=_('Started'))
+    heartbeat = models.DateTimeField(default=datetime.now, verbose_name=_('Last checkpoint'))
+    finished = models.DateTimeField(null=True, blank=True, verbose_name=_('Finished'))
+    status = models.CharField(max_length=1, choices=BILLING_RUN_STATUS, default='R',
+                              verbose_name=_('Status'))
+    lock = models.CharField(max_length=16, null=True, blank=True, unique=True,
+                            verbose_name=_('Lock'))
+    period_end = models.DateTimeField(verbose_name=_('Billing period end'))
+    last_membership_id = models.IntegerField(default=0, verbose_name=_('Last processed membership id'))
+    processed = models.IntegerField(default=0, verbose_name=_('Processed memberships'))
+    cycles_created = models.IntegerField(default=0, verbose_name=_('Billing cycles created'))
+    reminders_sent = models.IntegerField(default=0, verbose_name=_('Reminders sent'))
+    error = models.TextField(blank=True, verbose_name=_('Error'))
+
+    def checkpoint(self):
+        self.heartbeat = datetime.now()
+        self.save(update_fields=['heartbeat', 'last_membership_id', 'processed',
+                                 'cycles_created', 'reminders_sent'])
+
+    def finish(self, status='D', error=''):
+        self.status = status
+        self.error = error
+        self.lock = None
+        self.finished = datetime.now()
+        self.heartbeat = self.finished
+        self.save()
+
+    def __unicode__(self):
+        return u"%s %s" % (self.id, self.get_status_display())
+
+
+# Archive tables. Closed billing cycles older than the active years are
+# moved here with their bills, payments and log entries by the
+# archive_billing command. The rows keep their original ids.
+
+class ArchivedBillingCycle(models.Model):
+    """Same columns as BillingCycle"""
+    id = models.IntegerField(primary_key=True)
+    membership = models.ForeignKey('Membership', verbose_name=_('Membership'))
+    start = models.DateTimeField(verbose_name=_('Start'))
+    end = models.DateTimeField(verbose_name=_('End'))
+    sum = models.DecimalField(_('Sum'), max_digits=6, decimal_places=2)
+    is_paid = models.BooleanField(default=False, verbose_name=_('Is paid'))
+    reference_number = models.CharField(max_length=64, verbose_name=_('Reference number'), db_index=True)
+    reminder_stage = models.PositiveSmallIntegerField(choices=REMINDER_STAGES, default=REMINDER_STAGE_NONE,
+                                                      verbose_name=_('Reminder stage'))
+
+    archived = True
+
+    def end_date(self):
+        return self.end.date() - timedelta(days=1)
+
+    def __unicode__(self):
+        return str(self.start.date()) + "--" + str(self.end_date())
+
+
+class ArchivedBill(models.Model):
+    """Same columns as Bill"""
+    id = models.IntegerField(primary_key=True)
+    billingcycle = models.ForeignKey(ArchivedBillingCycle, verbose_name=_('Cycle'))
+    reminder_count = models.IntegerField(default=0, verbose_name=_('Reminder count'))
+    due_date = models.DateTimeField(verbose_name=_('Due date'))
+    created = models.DateTimeField(verbose_name=_('Created'))
+    last_changed = models.DateTimeField(verbose_name=_('Last changed'))
+    pdf_file = models.FileField(upload_to=bill_pdf_path, storage=cache_storage, null=True)
+    type = models.CharField(max_length=1, choices=BILL_TYPES, default='E', verbose_name=_('Bill type'))
+
+    def is_reminder(self):
+        return self.reminder_count > 0
+
+    def is_cancelled(self):
+        try:
+            return self.archivedcancelledbill is not None
+        except ArchivedCancelledBill.DoesNotExist:
+            return False
+
+
+class ArchivedCancelledBill(models.Model):
+    """Same columns as CancelledBill"""
+    id = models.IntegerField(primary_key=True)
+    bill = models.OneToOneField(ArchivedBill, verbose_name=_('Original bill'))
+    created = models.DateTimeField(verbose_name=_('Created'))
+    exported = models.BooleanField(default=False)
+
+
+class ArchivedPayment(models.Model):
+    """Same columns as Payment"""
+    id = models.IntegerField(primary_key=True)
+    billingcycle = models.ForeignKey(ArchivedBillingCycle, verbose_name=_('Cycle'), null=True)
+    ignore = models.BooleanField(default=False, verbose_name=_('Ignored payment'))
+    comment = models.CharField(max_length=64, verbose_name=_('Comment'), blank=True)
+    reference_number = models.CharField(max_length=64, verbose_name=_('Reference number'), blank=True)
+    message = models.CharField(max_length=256, verbose_name=_('Message'), blank=True)
+    transaction_id = models.CharField(max_length=30, verbose_name=_('Transaction id'), unique=True)
+    payment_day = models.DateTimeField(verbose_name=_('Payment day'))
+    amount = models.DecimalField(max_digits=9, decimal_places=2, verbose_name=_('Amount'))
+    type = models.CharField(max_length=64, verbose_name=_('Type'))
+    payer_name = models.CharField(max_length=64, verbose_name=_('Payer name'))
+    duplicate = models.BooleanField(default=False, verbose_name=_('Duplicate payment'))
+
+
+class ArchivedLogEntry(models.Model):
+    """Same columns as django.contrib.admin.models.LogEntry"""
+    id = models.IntegerField(primary_key=True)
+    action_time = models.DateTimeField(verbose_name=_('action time'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('user'))
+    content_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, blank=True, null=True,
+                                     verbose_name=_('content type'))
+    object_id = models.TextField(_('object id'), blank=True, null=True)
+    object_repr = models.CharField(_('object repr'), max_length=200)
+    action_flag = models.PositiveSmallIntegerField(_('action flag'))
+    change_message = models.TextField(_('change message'), blank=True)
+
+
 models.signals.post_save.connect(logging_log_change, sender=Membership)
 models.signals.post_save.connect(logging_log_change, sender=Contact)
 models.signals.post_save.connect(logging_log_change, sender=BillingCycle)
@@ -1035,6 +1621,17 @@ models.signals.post_save.connect(logging_log_change, sender=Bill)
 models.signals.post_save.connect(logging_log_change, sender=Fee)
 models.signals.post_save.connect(logging_log_change, sender=Payment)
 
+
+def bill_deleted(sender, instance, **kwargs):
+    """Recomputes the reminder stage of the cycle when a bill is deleted"""
+    try:
+        billingcycle = instance.billingcycle
+    except ObjectDoesNotExist:
+        return
+    billingcycle.update_reminder_stage()
+
+models.signals.post_delete.connect(bill_deleted, sender=Bill)
+
 # These are registered here due to import madness and general clarity
 send_as_email.connect(bill_sender, sender=Bill, dispatch_uid="email_bill")
 send_preapprove_email.connect(preapprove_email_sender, sender=Membership,
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset (seek) pagination for the long list views.
+
+Instead of OFFSET, a page is fetched with a WHERE condition on the sort
+keys of the last row of the previous page, so deep pages are as fast as
+the first one. The total count is estimated.
+"""
+
+import base64
+from datetime import datetime
+import json
+import re
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import CharField, F, IntegerField, Q, TextField, Value
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
+
+
+class KeysetNotSupported(Exception):
+    """The ordering of the queryset can not be used as a keyset"""
+    pass
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def estimate_count(queryset):
+    """
+    Row estimate of the query planner on PostgreSQL, exact count elsewhere.
+    """
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN " + sql, params)
+            match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+        if match:
+            return int(match.group(1))
+    return queryset.count()
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder rounds datetimes to milliseconds, which would break
+    # the equality comparisons of the seek condition
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super(CursorEncoder, self).default(o)
+
+
+class KeysetKey(object):
+    """One column of the keyset"""
+
+    def __init__(self, model, term, index):
+        self.term = term
+        self.descending = term.startswith('-')
+        path = term.lstrip('-')
+        if path == 'pk':
+            path = model._meta.pk.name
+        self.field, nullable, path = self._resolve(model, path)
+        self.path = path
+        self.expression = None
+        if nullable:
+            # NULL does not compare, so it is replaced with the smallest value
+            if isinstance(self.field, (CharField, TextField)):
+                self.expression = Coalesce(F(path), Value(''))
+            elif isinstance(self.field, IntegerField) or self.field.primary_key:
+                self.expression = Coalesce(F(path), Value(0))
+            else:
+                raise KeysetNotSupported("Nullable sort key %s" % term)
+        elif '__' in path:
+            self.expression = F(path)
+        self.name = '_keyset_%d' % index if self.expression is not None else path
+
+    @staticmethod
+    def _resolve(model, path):
+        """Returns the field, whether the value can be NULL and the lookup
+        path comparing the field value"""
+        nullable = False
+        opts = model._meta
+        parts = path.split('__')
+        for i, part in enumerate(parts):
+            try:
+                field = opts.get_field(part)
+            except FieldDoesNotExist:
+                raise KeysetNotSupported("Unknown sort key %s" % path)
+            last = i == len(parts) - 1
+            if field.is_relation:
+                if not (field.many_to_one or field.one_to_one) or not field.concrete:
+                    raise KeysetNotSupported("Multi-valued sort key %s" % path)
+                nullable = nullable or field.null
+                if last:
+                    if field.related_model._meta.ordering:
+                        raise KeysetNotSupported("Sort key %s uses related ordering" % path)
+                    parts[i] = field.attname
+                    return field.target_field, nullable, '__'.join(parts)
+                opts = field.related_model._meta
+            elif not last:
+                raise KeysetNotSupported("Invalid sort key %s" % path)
+            else:
+                nullable = nullable or field.null
+                return field, nullable, path
+
+    def value(self, obj):
+        return getattr(obj, self.name)
+
+    def to_python(self, value):
+        if value is None:
+            raise InvalidCursor("Missing cursor value")
+        return self.field.to_python(value)
+
+    def order_by(self, forward):
+        descending = self.descending if forward else not self.descending
+        return ('-' if descending else '') + self.name
+
+
+class KeysetPage(object):
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return self.paginator.encode_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        return self.paginator.encode_cursor(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a queryset by its ordering. A unique total order is made by
+    adding the primary key as the last sort key. Raises KeysetNotSupported
+    when the ordering can not be used, e.g. with multi-valued relations.
+    """
+    keyset = True
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        model = queryset.model
+        ordering = list(queryset.query.order_by) or list(model._meta.ordering)
+        for term in ordering:
+            if not isinstance(term, basestring) or term == '?':
+                raise KeysetNotSupported("Unsupported ordering %r" % term)
+        pk_terms = ('pk', model._meta.pk.name)
+        if not [term for term in ordering if term.lstrip('-') in pk_terms]:
+            if ordering and ordering[0].startswith('-'):
+                ordering.append('-pk')
+            else:
+                ordering.append('pk')
+        self.keys = [KeysetKey(model, term, i) for i, term in enumerate(ordering)]
+        self.ordering = [key.term for key in self.keys]
+
+    @cached_property
+    def count(self):
+        return estimate_count(self.queryset)
+
+    def encode_cursor(self, obj):
+        data = json.dumps({'o': self.ordering, 'v': [key.value(obj) for key in self.keys]},
+                          cls=CursorEncoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """Returns the key values, or None if the cursor is for another ordering"""
+        try:
+            data = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+            ordering, values = data['o'], data['v']
+        except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+            raise InvalidCursor("Invalid cursor")
+        if ordering != self.ordering:
+            return None
+        if len(values) != len(self.keys):
+            raise InvalidCursor("Invalid cursor")
+        try:
+            return [key.to_python(value) for key, value in zip(self.keys, values)]
+        except Exception:
+            raise InvalidCursor("Invalid cursor")
+
+    def _seek(self, values, forward):
+        """Rows after (or before) the row with the key values"""
+        condition = None
+        for i, key in enumerate(self.keys):
+            descending = key.descending if forward else not key.descending
+            q = Q(**{'%s__%s' % (key.name, 'lt' if descending else 'gt'): values[i]})
+            for previous, value in zip(self.keys[:i], values[:i]):
+                q &= Q(**{previous.name: value})
+            condition = q if condition is None else condition | q
+        return condition
+
+    def _fetch(self, values, forward):
+        """per_page + 1 rows after (or before) the key values, or from the start"""
+        qs = self.queryset
+        annotations = dict((key.name, key.expression) for key in self.keys
+                           if key.expression is not None)
+        if annotations:
+            qs = qs.annotate(**annotations)
+        if values is not None:
+            qs = qs.filter(self._seek(values, forward))
+        qs = qs.order_by(*[key.order_by(forward) for key in self.keys])
+        return list(qs[:self.per_page + 1])
+
+    def page(self, after=None, before=None):
+        """Page after or before the cursor, or the first page"""
+        values = None
+        if before or after:
+            values = self.decode_cursor(before or after)
+        # A cursor of another ordering starts from the first page
+        forward = not before or values is None
+
+        object_list = self._fetch(values, forward)
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if forward:
+            return KeysetPage(object_list, self, has_next=has_more,
+                              has_previous=values is not None)
+        object_list.reverse()
+        return KeysetPage(object_list, self, has_next=values is not None,
+                          has_previous=has_more)
+
+    def chunks(self):
+        """Yields all the rows as lists of at most per_page objects"""
+        values = None
+        while True:
+            object_list = self._fetch(values, True)
+            if object_list[:self.per_page]:
+                yield object_list[:self.per_page]
+            if len(object_list) <= self.per_page:
+                return
+            values = [key.value(object_list[self.per_page - 1]) for key in self.keys]
+
+
+def chunked(queryset, chunk_size=1000):
+    """
+    Iterates over the queryset in its order as lists of at most chunk_size
+    objects. Unlike iterating the queryset, only one chunk is held in
+    memory, and unlike QuerySet.iterator() the chunks can be used with
+    prefetch_related_objects().
+    """
+    return KeysetPaginator(queryset, chunk_size).chunks()
+
+
+def chunked_iterator(queryset, chunk_size=1000):
+    """The objects of chunked(queryset, chunk_size) one by one"""
+    for chunk in chunked(queryset, chunk_size):
+        for obj in chunk:
+            yield obj
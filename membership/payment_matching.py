@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Suggests billing cycles for payments that could not be attached by their
+reference number.
+
+Open cycles are loaded once into an in-memory index. Each payment is then
+scored against the candidate cycles found by a repaired reference number,
+a reference number in the message, the outstanding amount and the payer
+name.
+"""
+
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from difflib import SequenceMatcher
+import logging
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+
+from membership.models import BillingCycle, Payment, STATUS_DELETED
+from membership.reference_numbers import check_checknumber, strip_reference_number
+from membership.utils import log_change
+
+logger = logging.getLogger("membership.payment_matching")
+
+# Score weights, the total score is between 0 and 1
+REFERENCE_WEIGHT = Decimal('0.5')
+AMOUNT_WEIGHT = Decimal('0.2')
+NAME_WEIGHT = Decimal('0.3')
+
+REFERENCE_EXACT = Decimal('1.0')
+REFERENCE_IN_MESSAGE = Decimal('0.9')
+REFERENCE_REPAIRED = Decimal('0.8')
+
+# Names less similar than this are not considered a match at all
+NAME_MIN_SIMILARITY = 0.6
+
+DEFAULT_THRESHOLD = Decimal('0.8')
+# The best suggestion must beat the next one by this much to be auto attached
+AUTO_ATTACH_MARGIN = Decimal('0.1')
+
+Suggestion = namedtuple('Suggestion', ['cycle', 'score', 'reasons'])
+Candidate = namedtuple('Candidate', ['payment', 'score', 'reasons'])
+
+CANDIDATES_PER_PAGE = 20
+
+
+def normalize_name(name):
+    """Uppercase words without accents, in alphabetical order, since banks
+    write names as LAST FIRST in ASCII"""
+    name = unicodedata.normalize('NFKD', unicode(name))
+    name = u"".join(c for c in name if not unicodedata.combining(c))
+    return u" ".join(sorted(re.findall(r'\w+', name.upper(), re.UNICODE)))
+
+
+def name_tokens(normalized):
+    return set(token for token in normalized.split() if len(token) >= 3)
+
+
+def repaired_references(reference):
+    """
+    References one typing error away from reference that have a valid
+    check digit: a dropped, an extra, a mistyped or two transposed digits.
+    """
+    variants = set()
+    if not reference.isdigit():
+        return variants
+    digits = '0123456789'
+    for i in xrange(len(reference) + 1):
+        for d in digits:
+            variants.add(reference[:i] + d + reference[i:])
+    for i in xrange(len(reference)):
+        variants.add(reference[:i] + reference[i + 1:])
+        for d in digits:
+            variants.add(reference[:i] + d + reference[i + 1:])
+    for i in xrange(len(reference) - 1):
+        variants.add(reference[:i] + reference[i + 1] + reference[i] + reference[i + 2:])
+    variants.discard(reference)
+    return set(v.lstrip('0') for v in variants
+               if len(v) > 1 and check_checknumber(v) and v.lstrip('0'))
+
+
+class OpenCycleIndex(object):
+    """Unpaid billing cycles of undeleted memberships indexed by reference,
+    outstanding amount and name"""
+
+    def __init__(self, cycles=None):
+        if cycles is None:
+            cycles = (BillingCycle.objects.filter(is_paid=False)
+                      .exclude(membership__status=STATUS_DELETED)
+                      .select_related('membership__person', 'membership__organization',
+                                      'membership__billing_contact'))
+        cycles = list(cycles)
+        paid = dict(Payment.objects.filter(billingcycle__in=[c.id for c in cycles])
+                    .order_by().values_list('billingcycle').annotate(Sum('amount')))
+        self.by_reference = {}
+        self.by_amount = defaultdict(set)
+        self.by_token = defaultdict(set)
+        self.names = {}
+        self.outstanding = {}
+        for cycle in cycles:
+            self.add(cycle, cycle.sum - (paid.get(cycle.id) or Decimal('0')))
+
+    def add(self, cycle, outstanding):
+        self.by_reference[strip_reference_number(cycle.reference_number)] = cycle
+        self.by_amount[outstanding].add(cycle)
+        self.outstanding[cycle] = outstanding
+        membership = cycle.membership
+        names = set([normalize_name(membership.name())])
+        billing_contact = membership.get_billing_contact()
+        if billing_contact:
+            names.add(normalize_name(billing_contact.name()))
+        names.discard(u"")
+        self.names[cycle] = names
+        for name in names:
+            for token in name_tokens(name):
+                self.by_token[token].add(cycle)
+
+    def remove(self, cycle):
+        self.by_reference.pop(strip_reference_number(cycle.reference_number), None)
+        self.by_amount[self.outstanding.pop(cycle)].discard(cycle)
+        for name in self.names.pop(cycle):
+            for token in name_tokens(name):
+                self.by_token[token].discard(cycle)
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def suggest(self, payment, limit=5):
+        """Ranked suggestions for payment, best first"""
+        reference_scores = {}
+        reasons = defaultdict(list)
+
+        def reference_match(cycle, score, reason):
+            if score > reference_scores.get(cycle, 0):
+                reference_scores[cycle] = score
+                reasons[cycle].append(reason)
+
+        reference = strip_reference_number(payment.reference_number or u"")
+        if reference in self.by_reference:
+            reference_match(self.by_reference[reference], REFERENCE_EXACT, u"reference")
+        elif reference:
+            for variant in repaired_references(reference):
+                if variant in self.by_reference:
+                    reference_match(self.by_reference[variant], REFERENCE_REPAIRED,
+                                    u"reference %s" % variant)
+        for number in re.findall(r'\d[\d ]{3,}\d', payment.message or u""):
+            number = strip_reference_number(number)
+            if number in self.by_reference:
+                reference_match(self.by_reference[number], REFERENCE_IN_MESSAGE,
+                                u"reference in message")
+
+        payer = normalize_name(payment.payer_name or u"")
+        name_candidates = set()
+        for token in name_tokens(payer):
+            name_candidates.update(self.by_token.get(token, ()))
+        amount_candidates = self.by_amount.get(payment.amount, set())
+
+        suggestions = []
+        for cycle in set(reference_scores) | name_candidates:
+            score = REFERENCE_WEIGHT * reference_scores.get(cycle, 0)
+            if cycle in amount_candidates:
+                score += AMOUNT_WEIGHT
+                reasons[cycle].append(u"amount")
+            similarity = max([SequenceMatcher(None, payer, name).ratio()
+                              for name in self.names[cycle]] or [0])
+            if payer and similarity >= NAME_MIN_SIMILARITY:
+                score += NAME_WEIGHT * Decimal(str(round(similarity, 2)))
+                reasons[cycle].append(u"name %d%%" % (similarity * 100))
+            if score > 0:
+                suggestions.append(Suggestion(cycle, score, reasons[cycle]))
+        suggestions.sort(key=lambda s: (-s.score, s.cycle.id))
+        return suggestions[:limit]
+
+
+def unknown_payments():
+    """Payments listed in /payments/unknown/"""
+    return Payment.objects.filter(billingcycle=None, ignore=False).order_by('payment_day', 'id')
+
+
+def suggest_matches(payments=None, index=None, limit=5):
+    """Returns a list of (payment, suggestions) tuples"""
+    if payments is None:
+        payments = unknown_payments()
+    if index is None:
+        index = OpenCycleIndex()
+    return [(payment, index.suggest(payment, limit=limit)) for payment in payments]
+
+
+def is_confident(suggestions, threshold=DEFAULT_THRESHOLD):
+    """Whether the best suggestion is good and clearly better than the next"""
+    if not suggestions or suggestions[0].score < threshold:
+        return False
+    return len(suggestions) == 1 or suggestions[0].score - suggestions[1].score >= AUTO_ATTACH_MARGIN
+
+
+def auto_attach(payments=None, threshold=DEFAULT_THRESHOLD, user=None, dry_run=False):
+    """
+    Attaches payments to their best suggestion when is_confident(). A cycle
+    receives at most one payment per run. Returns a list of
+    (payment, suggestion) tuples of the attached payments.
+    """
+    if payments is None:
+        # The cycle of a duplicate payment is already paid
+        payments = unknown_payments().exclude(duplicate=True)
+    index = OpenCycleIndex()
+    attached = []
+    for payment in payments:
+        suggestions = index.suggest(payment, limit=2)
+        if not is_confident(suggestions, threshold):
+            continue
+        best = suggestions[0]
+        attached.append((payment, best))
+        index.remove(best.cycle)
+        if dry_run:
+            continue
+        with transaction.atomic():
+            payment.attach_to_cycle(best.cycle, user=user)
+            if user:
+                log_change(payment, user, change_message="Automatically matched (%s, score %.2f)" %
+                           (u", ".join(best.reasons), best.score))
+        logger.info(u"Payment %s automatically attached to cycle %s (%s, score %.2f)" %
+                    (payment.id, best.cycle.id, u", ".join(best.reasons), best.score))
+    return attached
+
+
+def outstanding_amount(cycle):
+    paid = cycle.payment_set.aggregate(Sum('amount'))['amount__sum']
+    return cycle.sum - (paid or Decimal('0'))
+
+
+def payment_candidates(cycle, query=u"", page=1, per_page=CANDIDATES_PER_PAGE):
+    """
+    Unattached payments for manually connecting to cycle, best first. The
+    score is computed in the database so that only one page of payments is
+    loaded. Returns a (list of Candidate, has_next) tuple.
+    """
+    # Scores are percentages in the database, on the same scale as suggest()
+    reference_cases = []
+    reference = strip_reference_number(cycle.reference_number)
+    if reference:
+        reference_cases = [
+            (Q(reference_number__in=[cycle.reference_number, reference]), REFERENCE_EXACT, u"reference"),
+            (Q(message__contains=reference), REFERENCE_IN_MESSAGE, u"reference in message"),
+        ]
+        repaired = repaired_references(reference)
+        if repaired:
+            reference_cases.append((Q(reference_number__in=repaired), REFERENCE_REPAIRED,
+                                    u"similar reference"))
+    reference_reasons = {}
+    whens = []
+    for condition, score, reason in reference_cases:
+        score = int(REFERENCE_WEIGHT * score * 100)
+        reference_reasons[score] = reason
+        whens.append(When(condition, then=Value(score)))
+    reference_score = Case(*whens, default=Value(0), output_field=IntegerField())
+    amount_score = Case(When(amount=outstanding_amount(cycle), then=Value(int(AMOUNT_WEIGHT * 100))),
+                        default=Value(0), output_field=IntegerField())
+
+    payments = Payment.objects.filter(billingcycle=None, ignore=False)
+    for word in query.split():
+        payments = payments.filter(Q(payer_name__icontains=word) |
+                                   Q(reference_number__icontains=word) |
+                                   Q(message__icontains=word))
+    payments = (payments.annotate(reference_score=reference_score, amount_score=amount_score)
+                .annotate(score=F('reference_score') + F('amount_score'))
+                .order_by('-score', '-payment_day', '-id'))
+    offset = (max(page, 1) - 1) * per_page
+    payments = list(payments[offset:offset + per_page + 1])
+
+    candidates = []
+    for payment in payments[:per_page]:
+        reasons = []
+        if payment.reference_score:
+            reasons.append(reference_reasons[payment.reference_score])
+        if payment.amount_score:
+            reasons.append(u"amount")
+        candidates.append(Candidate(payment, Decimal(payment.score) / 100, reasons))
+    return candidates, len(payments) > per_page
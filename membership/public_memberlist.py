@@ -1,11 +1,15 @@
 # This is shared between management commands and views
+from django.template.loader import render_to_string
+
 from membership.models import Membership
+from membership.pagination import chunked_iterator
 
 def public_memberlist_data():
     '''Get the membership counts and data for public memberlist.'''
     mship = Membership.objects.filter(status__exact='A', id__gt=0)
     membership_count = mship.count()
     public_members = mship.filter(public_memberlist="True") \
+                          .select_related('person', 'organization') \
                           .order_by('person__last_name',
                                     'person__first_name')
     public_membership_count = public_members.count()
@@ -13,3 +17,9 @@ def public_memberlist_data():
                 public_membership_count=public_membership_count,
                 public_members=public_members)
 
+def public_memberlist_xml(data):
+    '''Render the public memberlist XML piece by piece, one member at a time.'''
+    yield render_to_string('membership/public_memberlist_header.xml', data)
+    for member in chunked_iterator(data['public_members']):
+        yield render_to_string('membership/public_memberlist_person.xml', {'member': member})
+    yield render_to_string('membership/public_memberlist_footer.xml')
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from datetime import date
 from decimal import Decimal
 
 class ReferenceNumberException(Exception): pass
@@ -8,16 +9,51 @@ class IBANFormatException(ReferenceNumberException): pass
 class InvalidAmountException(ReferenceNumberException): pass
 class DueDateFormatException(ReferenceNumberException): pass
 
+# 01 on ollut perinteisesti jäsenmaksun maksutapahtumakoodi
+MEMBERSHIP_BILL_TYPE_SUFFIX = "01"
+
 def generate_membership_bill_reference_number(membership_id, bill_year):
     # [jäsennumero] yyxxz
     # jossa yy=vuosi kahdella numerolla, xx=maksutapahtumakoodi ja z tarkistenumero
-    # 01 on ollut perinteisesti jäsenmaksun maksutapahtumakoodi
-    bill_type_suffix = "01"
-
     return add_checknumber("%i%s%s" % \
                            (membership_id,
                             str(bill_year)[-2:],
-                            bill_type_suffix))
+                            MEMBERSHIP_BILL_TYPE_SUFFIX))
+
+def strip_reference_number(reference):
+    """Removes whitespace and the leading zeros of bank formatted references"""
+    return "".join(reference.split()).lstrip('0')
+
+def decode_membership_bill_reference_number(reference):
+    """
+    Reverse of generate_membership_bill_reference_number. Validates the
+    check digit and returns a (membership_id, two digit year) tuple.
+
+    Raises ReferenceNumberFormatException if the reference is not a
+    membership bill reference number.
+    """
+    reference = strip_reference_number(reference)
+    # At least one digit of membership id, year, suffix and check digit
+    if not reference.isdigit() or len(reference) < 6:
+        raise ReferenceNumberFormatException("Reference number '%s' invalid" % reference)
+    if not check_checknumber(reference):
+        raise ReferenceNumberFormatException("Reference number '%s' check digit invalid" % reference)
+    number = reference[:-1]
+    if number[-2:] != MEMBERSHIP_BILL_TYPE_SUFFIX:
+        raise ReferenceNumberFormatException("Reference number '%s' is not for a membership bill" % reference)
+    return int(number[:-4]), int(number[-4:-2])
+
+def membership_bill_year(two_digit_year, today=None):
+    """
+    Full year of a two digit year decoded from a membership bill reference
+    number. Years more than one year in the future are in the last century.
+    """
+    if today is None:
+        today = date.today()
+    year = today.year - today.year % 100 + two_digit_year
+    if year > today.year + 1:
+        year -= 100
+    return year
 
 def generate_checknumber(number):
     check = 0
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Daily rollup of membership statistics.
+
+collect_statistics() computes the statistics of one day with a handful of
+grouped aggregate queries and stores them as DailyStatistic rows, so that
+trends are read from the rollup table instead of aggregating the full
+tables again for every day. The rollup is meant to be collected for
+the previous day shortly after midnight, when the events of that day are
+complete and the current state is its end-of-day state. Snapshot
+statistics can only be taken of the current state, so older days can
+only be backfilled with the event statistics.
+"""
+
+from datetime import date, datetime, time, timedelta
+import logging
+
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from membership.models import (ApplicationPoll, BillingCycle, DailyStatistic, Membership,
+                               STATUS_APPROVED)
+
+logger = logging.getLogger("membership.statistics")
+
+# Statistics stored by collect_statistics(). Those marked as snapshots are
+# the state at collection time, the others count events on the day.
+STATISTICS = (
+    'status',        # snapshot: memberships by status
+    'type',          # snapshot: approved memberships by type
+    'unpaid',        # snapshot: 'count' and 'sum' of unpaid cycles of approved memberships
+    'applications',  # memberships created
+    'approvals',     # memberships approved
+    'poll',          # application poll answers by choice
+)
+SNAPSHOT_STATISTICS = ('status', 'type', 'unpaid')
+
+
+def _grouped_counts(queryset, field):
+    return queryset.order_by().values_list(field).annotate(Count('id'))
+
+
+def default_day():
+    """The day collected by default, yesterday"""
+    return date.today() - timedelta(days=1)
+
+
+def takes_snapshot(day):
+    """Whether the current state is stored as the snapshot of day"""
+    return day >= default_day()
+
+
+def compute_statistics(day):
+    """
+    Statistics of day as a list of (name, key, value) tuples. The snapshot
+    statistics are included only if takes_snapshot(day).
+    """
+    start = datetime.combine(day, time.min)
+    end = start + timedelta(days=1)
+    rows = []
+    if takes_snapshot(day):
+        for status, count in _grouped_counts(Membership.objects.all(), 'status'):
+            rows.append(('status', status, count))
+        for type, count in _grouped_counts(Membership.objects.filter(status=STATUS_APPROVED), 'type'):
+            rows.append(('type', type, count))
+        unpaid = (BillingCycle.objects.filter(membership__status=STATUS_APPROVED, is_paid=False)
+                  .aggregate(count=Count('id'), sum=Sum('sum')))
+        rows.append(('unpaid', 'count', unpaid['count']))
+        rows.append(('unpaid', 'sum', unpaid['sum'] or 0))
+    rows.append(('applications', '',
+                 Membership.objects.filter(created__gte=start, created__lt=end).count()))
+    rows.append(('approvals', '',
+                 Membership.objects.filter(approved__gte=start, approved__lt=end).count()))
+    poll_counts = {}
+    for answer, count in _grouped_counts(ApplicationPoll.objects.filter(date__gte=start, date__lt=end),
+                                         'answer'):
+        # Free text answers are stored as 'other: <text>'
+        answer = answer.split(':', 1)[0]
+        poll_counts[answer] = poll_counts.get(answer, 0) + count
+    for answer, count in sorted(poll_counts.items()):
+        rows.append(('poll', answer, count))
+    return rows
+
+
+def collect_statistics(day):
+    """
+    Stores the statistics of day, replacing any collected earlier for the
+    same day. The snapshots stored earlier for a day older than
+    default_day() are kept. Returns the number of rows stored.
+    """
+    rows = [DailyStatistic(date=day, name=name, key=key, value=value)
+            for name, key, value in compute_statistics(day)]
+    replaced = DailyStatistic.objects.filter(date=day)
+    if not takes_snapshot(day):
+        replaced = replaced.exclude(name__in=SNAPSHOT_STATISTICS)
+    with transaction.atomic():
+        replaced.delete()
+        DailyStatistic.objects.bulk_create(rows)
+    logger.info("Collected %d statistics for %s" % (len(rows), day))
+    return len(rows)
+
+
+def statistics_series(names=None, start=None, end=None):
+    """
+    Time series of the stored statistics between start and end (inclusive)
+    as {name: {key: [[date, value], ...]}}, with ISO dates in date order.
+    """
+    statistics = DailyStatistic.objects.all()
+    if names:
+        statistics = statistics.filter(name__in=names)
+    if start:
+        statistics = statistics.filter(date__gte=start)
+    if end:
+        statistics = statistics.filter(date__lte=end)
+    series = {}
+    for name, key, day, value in (statistics.order_by('name', 'key', 'date')
+                                  .values_list('name', 'key', 'date', 'value')):
+        value = int(value) if value == int(value) else float(value)
+        series.setdefault(name, {}).setdefault(key, []).append([day.isoformat(), value])
+    return series
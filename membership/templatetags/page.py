@@ -33,6 +33,40 @@ class Page(template.Node):
         return "?" + "&".join(["=".join(k) for k in querystring.items()])
 
 
+class Cursor(template.Node):
+    def __init__(self, field):
+        self.direction = field.replace('"', '')
+
+    def render(self, context):
+        """Return querystring part of URI for keyset pagination
+        >>> class P(object):
+        ...     next_cursor = 'abc'
+        ...     previous_cursor = 'xyz'
+        >>> c = Cursor("next")
+        >>> c.render({'querystring': {'after': 'old'}, 'page_obj': P()})
+        u'?after=abc'
+        >>> c = Cursor("previous")
+        >>> c.render({'querystring': {}, 'page_obj': P()})
+        u'?before=xyz'
+        >>> c = Cursor("first")
+        >>> c.render({'querystring': {'sort': 'id:1', 'before': 'old'}, 'page_obj': P()})
+        u'?sort=id:1'
+        """
+        querystring = context.get('querystring', {})
+        if isinstance(querystring, QueryDict):
+            querystring = querystring.dict()
+        else:
+            querystring = dict(querystring)
+        for key in ('page', 'after', 'before'):
+            querystring.pop(key, None)
+        page_obj = context.get('page_obj')
+        if self.direction == 'next':
+            querystring['after'] = page_obj.next_cursor
+        elif self.direction == 'previous':
+            querystring['before'] = page_obj.previous_cursor
+        return "?" + "&".join(["=".join(k) for k in querystring.items()])
+
+
 def do_page(parser, token):
     """Get sorturl by sort field"""
     tag_name, field = token.split_contents()
@@ -40,3 +74,12 @@ def do_page(parser, token):
 
 
 register.tag('page', do_page)
+
+
+def do_cursor(parser, token):
+    """Get keyset pagination url by direction: first, previous or next"""
+    tag_name, field = token.split_contents()
+    return Cursor(field)
+
+
+register.tag('cursor', do_cursor)
@@ -100,6 +100,11 @@ class SortUrl(template.Node):
         querystring = context.get('querystring', {})
         if isinstance(querystring, QueryDict):
             querystring = querystring.dict()
+        else:
+            querystring = dict(querystring)
+        # Keyset cursors are only valid for the ordering they were made with
+        querystring.pop('after', None)
+        querystring.pop('before', None)
         sort = querystring.get('sort', "{key}:None".format(key=self.field))
         key, __, __ = sort.partition(':')
 
@@ -2,18 +2,24 @@
 from __future__ import with_statement
 
 import calendar
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 
 from StringIO import StringIO
 
+import mailbox
 import os
 import os.path
+import posixpath
+import shutil
+import tempfile
 import logging
 import json
+import re
 
 from django.core.mail import EmailMessage
 from django.core.management import call_command
+from django.core.management.base import CommandError
 
 from membership import unpaid_members
 
@@ -22,38 +28,71 @@ logger = logging.getLogger("membership.tests")
 from django.contrib.auth.models import User
 from django.core import mail
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
 from django.conf import settings
 from django.db.models import Q
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.http import HttpResponse, HttpRequest
+from django.utils.html import escape
 from django.utils.translation import ugettext_lazy as _
 
 from membership import email_utils
 from membership.models import (Bill, BillingCycle, Contact, CancelledBill, Membership,
                                MembershipOperationError, MembershipAlreadyStatus,
-                               Fee, Payment, PaymentAttachedError, MEMBER_STATUS)
+                               Fee, Payment, PaymentAttachedError, MEMBER_STATUS,
+                               REMINDER_STAGE_NONE, REMINDER_STAGE_BILLED, REMINDER_STAGE_REMINDED, REMINDER_STAGE_PAPER_DUE,
+                               REMINDER_STAGE_PAPER_SENT)
+from membership.models import ArchivedBill, ArchivedBillingCycle, ArchivedLogEntry, ArchivedPayment
+from membership.models import bill_pdf_path, cache_storage, ApplicationPoll, DailyStatistic
 from membership.models import logger as models_logger
+from membership.models import BillingRun, PaymentImport, PaymentImportJob, QueuedEmail
 from membership import reference_numbers
 from membership.utils import tupletuple_to_dict, log_change, group_iban, admtool_membership_details
 from membership.forms import LoginField, PhoneNumberField, OrganizationRegistrationNumber
 from membership.test_utils import create_dummy_member, MockLoggingHandler
 from membership.decorators import trusted_host_required
 from sikteeri.iptools import IpRangeList
+from sikteeri import mboxemailbackend
+from services import models as services_models
 from services.models import Service, ServiceType, Alias
-from membership.billing.procountor_csv import create_csv
+from services.models import get_servicetype, clear_servicetype_cache, provision_services, \
+    SERVICETYPE_CACHE_SECONDS
+from membership.billing.procountor_csv import create_csv, write_csv
+from membership.billing.pdf_utils import create_reminder_pdf, get_bill_pdf
+from membership.billing.bill_context import bill_context, bill_contexts, cycle_contexts
+from membership.pagination import KeysetNotSupported, KeysetPaginator, InvalidCursor, chunked, chunked_iterator
+from membership.payment_matching import OpenCycleIndex, auto_attach, payment_candidates, repaired_references, \
+    suggest_matches
 from membership.reference_numbers import generate_membership_bill_reference_number
+from membership.reference_numbers import decode_membership_bill_reference_number, membership_bill_year
 from membership.reference_numbers import generate_checknumber, add_checknumber, check_checknumber, group_right
 from membership.reference_numbers import barcode_4, canonize_iban, canonize_refnum, canonize_sum, canonize_duedate
 from membership.reference_numbers import ReferenceNumberException
 from membership.reference_numbers import ReferenceNumberFormatException
 from membership.reference_numbers import IBANFormatException, InvalidAmountException
+from membership.management.commands import makebills as makebills_command
 from membership.management.commands.makebills import logger as makebills_logger
 from membership.management.commands.makebills import makebills
 from membership.management.commands.makebills import create_billingcycle
 from membership.management.commands.makebills import send_reminder
 from membership.management.commands.makebills import can_send_reminder
 from membership.management.commands.makebills import MembershipNotApproved
+from membership.management.commands.makebills import BillingRunLocked, BILLING_RUN_LOCK
+from membership.management.commands.makebills import ShardProgress, bill_memberships, shard_ranges
+from membership.management.commands.makebills import BillingShardFailed, _bill_in_workers
 from membership.management.commands.csvbills import process_op_csv, process_procountor_csv
+from membership.management.commands.csvbills import existing_transaction_ids
+from membership.management.commands.process_payment_imports import JOB_LEASE, MAX_ATTEMPTS, \
+    claim_payment_import_job, recover_stale_jobs, run_payment_import_job
+from membership.management.commands.csvbills import OpDictReader, process_payments
+from membership.management.commands.shard_bill_pdfs import shard_bill_pdfs
+from membership.archive import archivable_cycles
+from membership.statistics import collect_statistics, statistics_series
+from membership.management.commands.csvtestdata import header_row, print_csv, row as csv_row
+from membership.management.commands.send_queued_email import deliver_queued_email
+from membership.management.commands.startup_time import measure_startup
 from membership.management.commands.csvbills import PaymentFromFutureException, RequiredFieldNotFoundException
 
 __test__ = {
@@ -92,6 +131,27 @@ class ReferenceNumberTest(TestCase):
                 self.assertFalse(number in numbers)
                 numbers.add(number)
 
+    def test_decode_reference_number(self):
+        for membership_id in (1, 42, 12345):
+            for year in (2009, 2015, 2100):
+                number = generate_membership_bill_reference_number(membership_id, year)
+                self.assertEqual(decode_membership_bill_reference_number(number),
+                                 (membership_id, year % 100))
+        self.assertEqual(decode_membership_bill_reference_number("000 42150 11"), (42, 15))
+
+    def test_membership_bill_year(self):
+        today = date(2026, 10, 19)
+        self.assertEqual(membership_bill_year(26, today), 2026)
+        self.assertEqual(membership_bill_year(27, today), 2027)
+        self.assertEqual(membership_bill_year(9, today), 2009)
+        self.assertEqual(membership_bill_year(99, today), 1999)
+
+    def test_decode_invalid_reference_number(self):
+        # Wrong check digit, payment type 02 instead of 01, too short, not a number
+        for number in ("4215013", "4215024", "12344", "abc", ""):
+            self.assertRaises(ReferenceNumberFormatException,
+                              decode_membership_bill_reference_number, number)
+
     def test_grouping(self):
         self.assertEqual(group_right('1'), '1')
         self.assertEqual(group_right('12'), '12')
@@ -333,6 +393,8 @@ class BillingTest(TestCase):
         membership = create_dummy_member('N', type='H')
         self.assertEqual(len(mail.outbox), 0)
         membership.preapprove(self.user)
+        self.assertEqual(QueuedEmail.objects.filter(status='Q').count(), 1)
+        deliver_queued_email()
         self.assertEqual(len(mail.outbox), 1)
         mail.outbox = []
 
@@ -453,6 +515,164 @@ class SingleMemberBillingTest(TestCase):
         self.assertEqual(len(mail.outbox), 2)
 
 
+class BillingRunTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        self.memberships = []
+        for i in xrange(3):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+            self.memberships.append(membership)
+
+    def period_end(self):
+        dt = datetime.now()
+        return datetime(dt.year, dt.month, calendar.monthrange(dt.year, dt.month)[1], 23, 59, 59)
+
+    def test_run_is_recorded(self):
+        run = makebills()
+        self.assertEqual(run.status, 'D')
+        self.assertIsNone(run.lock)
+        self.assertEqual(run.processed, 3)
+        self.assertEqual(run.cycles_created, 3)
+        self.assertEqual(run.last_membership_id, self.memberships[-1].id)
+        # The lock is released, so the next run can start
+        self.assertEqual(makebills().cycles_created, 0)
+
+    def test_concurrent_run_is_refused(self):
+        BillingRun.objects.create(lock=BILLING_RUN_LOCK, period_end=datetime.now())
+        self.assertRaises(BillingRunLocked, makebills)
+        self.assertEqual(BillingCycle.objects.count(), 0)
+
+    def test_failed_run_is_resumed(self):
+        broken = self.memberships[1]
+        approved = broken.approved
+        broken.approved = None
+        broken.save()
+        self.assertRaises(MembershipNotApproved, makebills)
+        failed = BillingRun.objects.get()
+        self.assertEqual(failed.status, 'F')
+        self.assertIn("MembershipNotApproved", failed.error)
+        self.assertEqual(failed.last_membership_id, self.memberships[0].id)
+
+        broken.approved = approved
+        broken.save()
+        run = makebills()
+        self.assertEqual(run.id, failed.id)
+        self.assertEqual(run.status, 'D')
+        self.assertEqual(run.processed, 3)
+        self.assertEqual(BillingCycle.objects.count(), 3)
+
+        # A fresh run starts from the beginning
+        self.assertEqual(makebills(resume=False).processed, 3)
+
+    def test_failed_run_before_completed_run_is_not_resumed(self):
+        last_of_month = self.period_end()
+        stale = BillingRun.objects.create(period_end=last_of_month, status='F',
+                                          last_membership_id=self.memberships[-1].id, processed=3)
+        completed = makebills(resume=False)
+        self.assertEqual(completed.status, 'D')
+        # New memberships after the completed run are billed by the next run
+        membership = create_dummy_member('N')
+        membership.preapprove(self.user)
+        membership.approve(self.user)
+        run = makebills()
+        self.assertNotIn(run.id, [stale.id, completed.id])
+        self.assertEqual(run.processed, 4)
+        self.assertEqual(membership.billingcycle_set.count(), 1)
+        self.assertEqual(BillingRun.objects.get(id=stale.id).status, 'F')
+
+    def test_expired_lock_is_taken_over(self):
+        last_of_month = self.period_end()
+        dead = BillingRun.objects.create(lock=BILLING_RUN_LOCK, period_end=last_of_month,
+                                         heartbeat=datetime.now() - timedelta(hours=2),
+                                         last_membership_id=self.memberships[0].id, processed=1)
+        run = makebills()
+        self.assertEqual(run.id, dead.id)
+        self.assertEqual(run.processed, 3)
+        self.assertEqual(BillingCycle.objects.count(), 2)
+
+
+    def test_shard_ranges(self):
+        self.assertEqual(shard_ranges([], 4), [])
+        self.assertEqual(shard_ranges([3, 5, 8, 9, 20], 2), [(2, 8), (8, 20)])
+        self.assertEqual(shard_ranges([3, 5], 4), [(2, 3), (3, 5)])
+        self.assertEqual(shard_ranges(range(1, 101), 3)[-1], (68, 100))
+
+    def test_bill_in_workers(self):
+        for i in xrange(3):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+            self.memberships.append(membership)
+        ids = [membership.id for membership in self.memberships]
+
+        def bill_shard(args):
+            run_id, after_id, last_id, period_end, latest_recorded_payment = args
+            progress = ShardProgress(run_id)
+            shard_ids = [i for i in ids if after_id < i <= last_id]
+            # The middle shard fails after its first membership
+            failed = ids[2] in shard_ids
+            for membership_id in shard_ids[:1] if failed else shard_ids:
+                progress.last_membership_id = membership_id
+                progress.processed += 1
+                progress.cycles_created += 1
+            return after_id, last_id, progress, "Shard failed" if failed else None
+
+        pools = []
+
+        class InProcessPool(object):
+            """The shards run in this process"""
+            def __init__(self, processes):
+                self.processes = processes
+                pools.append(self)
+
+            def map(self, function, args):
+                return map(function, args)
+
+            def close(self):
+                pass
+
+            def join(self):
+                pass
+
+        for name, stub in (('Pool', InProcessPool), ('_bill_shard', bill_shard)):
+            self.addCleanup(setattr, makebills_command, name, getattr(makebills_command, name))
+            setattr(makebills_command, name, stub)
+
+        run = BillingRun.objects.create(period_end=self.period_end())
+        members = Membership.objects.filter(status='A').order_by('id')
+        with self.assertRaises(BillingShardFailed) as cm:
+            _bill_in_workers(run, members, self.period_end(), None, 3)
+        self.assertIn("1 of 3 billing workers failed", str(cm.exception))
+        self.assertIn("Shard failed", str(cm.exception))
+        self.assertEqual([pool.processes for pool in pools], [3])
+        # The checkpoint stops in the failed shard, the later shard is billed again on resume
+        self.assertEqual(run.last_membership_id, ids[2])
+        self.assertEqual((run.processed, run.cycles_created), (5, 5))
+
+    def test_membership_is_billed_once(self):
+        last_of_month = self.period_end()
+        membership = self.memberships[0]
+        self.assertTrue(create_billingcycle(membership, period_end=last_of_month))
+        # Another process deciding to bill the same membership gets nothing
+        self.assertIsNone(create_billingcycle(membership, period_end=last_of_month))
+        self.assertEqual(membership.billingcycle_set.count(), 1)
+
+    def test_shard(self):
+        run = BillingRun.objects.create(period_end=datetime.now())
+        progress = ShardProgress(run.id)
+        last_of_month = self.period_end()
+        members = Membership.objects.filter(id__gt=self.memberships[0].id).order_by('id')
+        bill_memberships(members, last_of_month, None, progress)
+        self.assertEqual(progress.processed, 2)
+        self.assertEqual(progress.cycles_created, 2)
+        self.assertEqual(progress.last_membership_id, self.memberships[-1].id)
+        self.assertEqual(BillingCycle.objects.filter(membership=self.memberships[0]).count(), 0)
+
+
 class ProcountorExportTest(TestCase):
     # Allowable bookkeeping account ids
     BOOK_ACCOUNTS = ['9039', '9037', '9038']
@@ -831,6 +1051,20 @@ class ProcountorExportTest(TestCase):
         self.assertEqual(len(result_csv.splitlines()), 4, "Creating cancelled bill csv failed")
         self.check_procountor_csv_format(result_csv)
 
+    def test_write_csv_in_chunks(self):
+        for i in xrange(3):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        makebills()
+        self.membership.request_dissociation(self.user)
+        self.membership.dissociate(self.user)
+        expected = create_csv(mark_cancelled=False)
+        out = StringIO()
+        self.assertEqual(write_csv(out, chunk_size=2), 10)
+        self.assertEqual(out.getvalue(), expected)
+        self.assertEqual(CancelledBill.objects.filter(exported=False).count(), 0)
+
 
 class SingleMemberBillingModelsTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
@@ -951,6 +1185,454 @@ class CanSendReminderTest(TestCase):
         can_send = can_send_reminder(month_ago, Payment.latest_payment_date())
         self.assertTrue(can_send, "Should be true with recent payment")
 
+class PDFTemplateTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        for i in xrange(3):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        makebills()
+
+    def test_reminder_pages_share_static_form(self):
+        output = StringIO()
+        create_reminder_pdf(BillingCycle.objects.all(), output, payments=Payment)
+        content = output.getvalue()
+        self.assertTrue(content.startswith('%PDF'))
+        self.assertEqual(len(re.findall(r'/Type /Page\b', content)), 3)
+        self.assertEqual(content.count('/Subtype /Form'), 1)
+        # Logo is embedded once
+        self.assertEqual(content.count('/Subtype /Image'), 1)
+
+    def test_invoice(self):
+        bill = Bill.objects.latest('id')
+        content = get_bill_pdf(bill, payments=Payment)
+        self.assertTrue(content.startswith('%PDF'))
+        self.assertEqual(content.count('/Subtype /Form'), 1)
+
+
+class BillPDFStorageTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        membership = create_dummy_member('N')
+        membership.preapprove(self.user)
+        membership.approve(self.user)
+        makebills()
+        self.bill = Bill.objects.latest('id')
+
+    def tearDown(self):
+        bill = Bill.objects.get(id=self.bill.id)
+        if bill.pdf_file:
+            bill.pdf_file.delete(save=False)
+
+    def test_sharded_path(self):
+        path = bill_pdf_path(self.bill, u"bill_1.pdf")
+        self.assertRegexpMatches(path, r'^bill_pdfs/[0-9a-f]{2}/[0-9a-f]{2}/bill_1\.pdf$')
+        self.assertEqual(path, bill_pdf_path(None, "bill_1.pdf"))
+        self.assertNotEqual(path, bill_pdf_path(None, "bill_2.pdf"))
+
+        content = get_bill_pdf(self.bill, payments=Payment)
+        name = Bill.objects.get(id=self.bill.id).pdf_file.name
+        # Files left by earlier test runs with the same bill ids get a suffix
+        self.assertEqual(posixpath.dirname(name),
+                         posixpath.dirname(bill_pdf_path(self.bill, "bill_%d.pdf" % self.bill.id)))
+        self.assertEqual(get_bill_pdf(Bill.objects.get(id=self.bill.id)), content)
+
+    def test_shard_existing_files(self):
+        legacy_name = cache_storage.save("bill_pdfs/bill_%d.pdf" % self.bill.id, ContentFile("%PDF legacy"))
+        Bill.objects.filter(id=self.bill.id).update(pdf_file=legacy_name)
+        missing = Bill(billingcycle=self.bill.billingcycle, pdf_file="bill_pdfs/bill_missing.pdf")
+        missing.save()
+
+        self.assertEqual(shard_bill_pdfs(dry_run=True), {'moved': 1, 'missing': 1})
+        self.assertTrue(cache_storage.exists(legacy_name))
+        out = StringIO()
+        call_command('shard_bill_pdfs', stdout=out)
+        self.assertIn("Moved 1 bill PDFs, cleared 1 missing ones", out.getvalue())
+
+        bill = Bill.objects.get(id=self.bill.id)
+        self.assertEqual(bill.pdf_file.name, bill_pdf_path(bill, posixpath.basename(legacy_name)))
+        self.assertFalse(cache_storage.exists(legacy_name))
+        self.assertEqual(get_bill_pdf(bill), "%PDF legacy")
+        self.assertFalse(Bill.objects.get(id=missing.id).pdf_file)
+        self.assertEqual(shard_bill_pdfs(), {'moved': 0, 'missing': 0})
+
+
+class BillContextTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        for i in xrange(3):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        makebills()
+
+    def test_bill_context(self):
+        bill = Bill.objects.latest('id')
+        cycle = bill.billingcycle
+        context = bill_context(bill)
+        self.assertFalse(context['reminder'])
+        self.assertEqual(context['sum'], cycle.sum)
+        self.assertEqual(context['fee'], cycle.get_fee())
+        self.assertEqual(context['vat_percentage'], cycle.get_vat_percentage())
+        self.assertEqual(context['non_vat_amount'] + context['vat_amount'], cycle.sum)
+        self.assertEqual(context['barcode'], barcode_4(settings.IBAN_ACCOUNT_NUMBER,
+                                                       cycle.reference_number, bill.due_date, cycle.sum))
+        self.assertIn(context['barcode'], bill.render_as_text())
+
+    def test_reminder_context_subtracts_payments(self):
+        cycle = BillingCycle.objects.latest('id')
+        Payment(billingcycle=cycle, amount=5, payment_day=datetime.now(),
+                type="XYZ", payer_name="a", transaction_id="bill_context_1").save()
+        context = cycle_contexts([cycle], reminder=True, payments=Payment)[0]
+        self.assertEqual(context['amount_paid'], Decimal(5))
+        self.assertEqual(context['sum'], cycle.sum - 5)
+        self.assertIsNone(context['due_date'])
+        self.assertEqual(context['bill_id'], cycle.first_bill().id)
+        self.assertIsNotNone(context['latest_payment_date'])
+
+    def test_pdf_uses_given_context(self):
+        bill = Bill.objects.latest('id')
+        context = bill_context(bill, payments=Payment)
+        with CaptureQueriesContext(connection) as with_context:
+            bill.generate_pdf(context=context)
+        bill.pdf_file = None
+        with CaptureQueriesContext(connection) as without_context:
+            bill.generate_pdf()
+        self.assertLess(len(with_context), len(without_context))
+
+    def test_bill_email(self):
+        bill = Bill.objects.latest('id')
+        bill.pdf_file = None
+        mail.outbox = []
+        bill.send_as_email()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(bill_context(bill)['barcode'], mail.outbox[0].body)
+        filename, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertTrue(content.startswith('%PDF'))
+
+    def test_batch_query_count_is_constant(self):
+        # Bills, cycles, memberships, persons and fees
+        with self.assertNumQueries(5):
+            contexts = bill_contexts(Bill.objects.all())
+        self.assertEqual(len(contexts), 3)
+        # Memberships, persons, fees, payment sums, latest payment and first bills
+        cycles = list(BillingCycle.objects.all())
+        with self.assertNumQueries(6):
+            cycle_contexts(cycles, reminder=True, payments=Payment)
+
+
+class KeysetPaginationTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        day = datetime(2015, 3, 1, 12, 30, 15, 123456)
+        for i in xrange(25):
+            # Payment days repeat so that the primary key breaks the ties
+            Payment(amount=10 + i, payment_day=day - timedelta(days=i // 3),
+                    payer_name=u"Maksaja %d" % (i % 4), type="XYZ",
+                    transaction_id="keyset_%d" % i).save()
+
+    def walk(self, queryset, per_page):
+        paginator = KeysetPaginator(queryset, per_page)
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(after=pages[-1].next_cursor))
+        return paginator, pages
+
+    def test_pages_follow_ordering(self):
+        payments = Payment.objects.order_by('-payment_day', '-id')
+        paginator, pages = self.walk(payments, 10)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([p.id for page in pages for p in page],
+                         list(payments.values_list('id', flat=True)))
+        self.assertFalse(pages[0].has_previous())
+        self.assertEqual(paginator.count, 25)
+
+        previous = paginator.page(before=pages[2].previous_cursor)
+        self.assertEqual([p.id for p in previous], [p.id for p in pages[1]])
+        self.assertTrue(previous.has_next())
+        self.assertTrue(previous.has_previous())
+
+    def test_nullable_sort_key(self):
+        for i in xrange(3):
+            create_dummy_member('N', type='O')
+            create_dummy_member('N')
+        memberships = Membership.objects.order_by('person__last_name', 'person__first_name', 'id')
+        paginator, pages = self.walk(memberships, 4)
+        ids = [m.id for page in pages for m in page]
+        self.assertEqual(sorted(ids), sorted(memberships.values_list('id', flat=True)))
+
+    def test_chunked(self):
+        create_dummy_member('N', type='O')
+        create_dummy_member('N')
+        memberships = Membership.objects.order_by('person__last_name', 'id')
+        chunks = list(chunked(memberships, 1))
+        self.assertEqual([len(chunk) for chunk in chunks], [1, 1])
+        payments = Payment.objects.order_by('-payment_day', '-id')
+        self.assertEqual([len(chunk) for chunk in chunked(payments, 10)], [10, 10, 5])
+        self.assertEqual([p.id for p in chunked_iterator(payments, 4)],
+                         list(payments.values_list('id', flat=True)))
+
+    def test_unsupported_ordering(self):
+        with self.assertRaises(KeysetNotSupported):
+            KeysetPaginator(BillingCycle.objects.order_by('bill__due_date'), 10)
+
+    def test_invalid_cursor(self):
+        paginator = KeysetPaginator(Payment.objects.order_by('-payment_day', '-id'), 10)
+        with self.assertRaises(InvalidCursor):
+            paginator.page(after='not a cursor')
+        # Cursor of another ordering starts from the beginning
+        other = KeysetPaginator(Payment.objects.order_by('amount'), 10)
+        cursor = other.page().next_cursor
+        self.assertFalse(paginator.page(before=cursor).has_previous())
+
+    def test_payment_list_view(self):
+        for i in xrange(settings.ENTRIES_PER_PAGE):
+            Payment(amount=1, payment_day=datetime(2014, 1, 1), payer_name=u"Maksaja",
+                    type="XYZ", transaction_id="keyset_view_%d" % i).save()
+        self.client.login(username='admin', password='dhtn')
+        response = self.client.get('/membership/payments/')
+        page = response.context['page_obj']
+        self.assertTrue(response.context['paginator'].keyset)
+        self.assertTrue(page.has_next())
+        self.assertContains(response, 'after=%s' % page.next_cursor)
+        response = self.client.get('/membership/payments/', {'after': page.next_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['page_obj'].has_previous())
+        response = self.client.get('/membership/payments/', {'after': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+        # Explicit page numbers still use the offset paginator
+        response = self.client.get('/membership/payments/', {'page': '2'})
+        self.assertFalse(getattr(response.context['paginator'], 'keyset', False))
+
+
+class StartupTimeTest(TestCase):
+
+    def test_models_do_not_load_reportlab(self):
+        result = measure_startup('import membership.models')
+        self.assertFalse(result['reportlab'])
+        self.assertGreater(result['total_seconds'], result['seconds'])
+
+    def test_warm_up_loads_reportlab(self):
+        result = measure_startup('from membership.billing.pdf_utils import warm_up; warm_up()')
+        self.assertTrue(result['reportlab'])
+
+
+class ReferenceNumberLookupTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        user = User.objects.get(id=1)
+        membership = create_dummy_member('N')
+        membership.preapprove(user)
+        membership.approve(user)
+        makebills()
+        self.cycle = membership.billingcycle_set.latest('start')
+
+    def test_membership_reference(self):
+        reference = self.cycle.reference_number
+        with self.assertNumQueries(1):
+            self.assertEqual(BillingCycle.get_by_reference_number(reference), self.cycle)
+        self.assertEqual(BillingCycle.get_by_reference_number("000 " + group_right(reference)),
+                         self.cycle)
+
+    def test_stored_reference_of_another_year(self):
+        # The start of the cycle was corrected after the reference was generated
+        reference = self.cycle.reference_number
+        BillingCycle.objects.filter(id=self.cycle.id).update(
+            start=self.cycle.start.replace(year=self.cycle.start.year + 1))
+        self.assertEqual(BillingCycle.get_by_reference_number(reference), self.cycle)
+        self.assertEqual(BillingCycle.get_by_reference_number("000 " + group_right(reference)),
+                         self.cycle)
+
+    def test_decoded_reference_does_not_need_stored_string(self):
+        # The stored reference is not the generated one, so only the decoded
+        # lookup finds the cycle
+        reference = self.cycle.reference_number
+        BillingCycle.objects.filter(id=self.cycle.id).update(reference_number="0" + reference)
+        self.assertEqual(BillingCycle.get_by_reference_number("00 " + group_right(reference)),
+                         self.cycle)
+
+    def test_decoded_reference_of_another_year(self):
+        reference = generate_membership_bill_reference_number(self.cycle.membership.id,
+                                                              self.cycle.start.year - 1)
+        with self.assertRaises(BillingCycle.DoesNotExist):
+            BillingCycle.get_by_reference_number(reference)
+
+    def test_decoded_reference_of_ambiguous_year(self):
+        reference = self.cycle.reference_number
+        BillingCycle.objects.filter(id=self.cycle.id).update(reference_number="0" + reference)
+        BillingCycle(membership=self.cycle.membership, start=self.cycle.start,
+                     reference_number="1232").save()
+        with self.assertRaises(BillingCycle.DoesNotExist):
+            BillingCycle.get_by_reference_number(reference)
+
+    def test_non_standard_reference(self):
+        self.cycle.reference_number = "1232"
+        self.cycle.save()
+        self.assertEqual(BillingCycle.get_by_reference_number("1232"), self.cycle)
+
+    def test_reference_with_leading_zero(self):
+        self.cycle.reference_number = "01232"
+        self.cycle.save()
+        self.assertEqual(BillingCycle.get_by_reference_number("01232"), self.cycle)
+
+    def test_unknown_reference(self):
+        reference = generate_membership_bill_reference_number(self.cycle.membership.id + 1, 2015)
+        with self.assertRaises(BillingCycle.DoesNotExist):
+            BillingCycle.get_by_reference_number(reference)
+
+
+class PaymentMatchingTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        names = [(u"Matti", u"Virtanen"), (u"Liisa", u"Mäkinen"), (u"Pekka", u"Korhonen")]
+        for first_name, last_name in names:
+            membership = create_dummy_member('N')
+            membership.person.first_name = first_name
+            membership.person.last_name = last_name
+            membership.person.save()
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        makebills()
+        self.cycle = BillingCycle.objects.get(membership__person__last_name=u"Mäkinen")
+
+    def payment(self, reference, payer_name, amount=None, message=u""):
+        payment = Payment(reference_number=reference, payer_name=payer_name, message=message,
+                          amount=amount if amount is not None else self.cycle.sum,
+                          payment_day=datetime.now(), type="XYZ",
+                          transaction_id="matching_%s_%s" % (reference, Payment.objects.count()))
+        payment.save()
+        return payment
+
+    def test_repaired_references(self):
+        reference = self.cycle.reference_number
+        transposed = reference[1] + reference[0] + reference[2:]
+        self.assertIn(reference, repaired_references(transposed))
+        self.assertIn(reference, repaired_references(reference[:-1]))
+        self.assertIn(reference, repaired_references(reference[:2] + reference[3:]))
+        for variant in repaired_references(transposed):
+            self.assertTrue(check_checknumber(variant))
+
+    def test_mistyped_reference_is_attached(self):
+        reference = self.cycle.reference_number
+        payment = self.payment(reference[:-1], u"MAKINEN LIISA")
+        [(p, suggestions)] = suggest_matches()
+        self.assertEqual(suggestions[0].cycle, self.cycle)
+        self.assertIn(u"amount", suggestions[0].reasons)
+
+        attached = auto_attach(user=self.user)
+        self.assertEqual([(p.id, s.cycle.id) for p, s in attached], [(payment.id, self.cycle.id)])
+        self.assertEqual(Payment.objects.get(id=payment.id).billingcycle, self.cycle)
+        self.assertTrue(BillingCycle.objects.get(id=self.cycle.id).is_paid)
+
+    def test_name_and_amount_only_is_suggested(self):
+        payment = self.payment(u"", u"Makinen Liisa")
+        suggestions = OpenCycleIndex().suggest(payment)
+        self.assertEqual(suggestions[0].cycle, self.cycle)
+        self.assertEqual(auto_attach(dry_run=True), [])
+
+    def test_reference_in_message(self):
+        payment = self.payment(u"", u"Joku Muu", message=u"Jäsenmaksu, viite %s" % self.cycle.reference_number)
+        suggestions = OpenCycleIndex().suggest(payment)
+        self.assertEqual(suggestions[0].cycle, self.cycle)
+        self.assertIn(u"reference in message", suggestions[0].reasons)
+
+    def test_command(self):
+        self.payment(self.cycle.reference_number[:-1], u"MAKINEN LIISA")
+        output = StringIO()
+        call_command('match_payments', auto_attach=True, dry_run=True, stdout=output)
+        self.assertIn("1 payments matched", output.getvalue())
+        self.assertEqual(Payment.objects.filter(billingcycle=None).count(), 1)
+
+
+
+class ConnectPaymentTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        membership = create_dummy_member('N')
+        membership.preapprove(self.user)
+        membership.approve(self.user)
+        makebills()
+        self.cycle = BillingCycle.objects.get(membership=membership)
+        self.assertTrue(self.client.login(username='admin', password='dhtn'))
+
+    def payment(self, reference=u"", amount=Decimal('1.00'), payer_name=u"Joku Muu", message=u""):
+        payment = Payment(reference_number=reference, payer_name=payer_name, message=message,
+                          amount=amount, payment_day=datetime.now(), type="XYZ",
+                          transaction_id="connect_%s" % Payment.objects.count())
+        payment.save()
+        return payment
+
+    def test_ranking(self):
+        other = self.payment()
+        amount = self.payment(amount=self.cycle.sum)
+        in_message = self.payment(message=u"viite %s" % self.cycle.reference_number)
+        exact = self.payment(reference=self.cycle.reference_number, amount=self.cycle.sum)
+        candidates, has_next = payment_candidates(self.cycle)
+        self.assertEqual([c.payment for c in candidates], [exact, in_message, amount, other])
+        self.assertEqual(candidates[0].reasons, [u"reference", u"amount"])
+        self.assertEqual(candidates[0].score, Decimal('0.7'))
+        self.assertFalse(has_next)
+
+    def test_json_search_and_paging(self):
+        for i in xrange(3):
+            self.payment(payer_name=u"Virtanen %d" % i)
+        self.payment(payer_name=u"Korhonen")
+        url = '/membership/billing_cycles/connect_payment/%d/candidates/' % self.cycle.id
+        data = json.loads(self.client.get(url, {'q': u'virtanen', 'page': 2}).content)
+        self.assertEqual(data['page'], 2)
+        self.assertTrue(data['has_previous'])
+        self.assertFalse(data['has_next'])
+        candidates, has_next = payment_candidates(self.cycle, query=u"virtanen", per_page=2)
+        self.assertTrue(has_next)
+        self.assertEqual(len(candidates), 2)
+        data = json.loads(self.client.get(url, {'q': u'korhonen'}).content)
+        self.assertEqual([c['payer_name'] for c in data['candidates']], [u"Korhonen"])
+
+    def test_page_queries_do_not_depend_on_backlog(self):
+        url = '/membership/billing_cycles/connect_payment/%d/' % self.cycle.id
+        self.payment()
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for i in xrange(30):
+            self.payment()
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(url)
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(len(response.context['candidates']), 20)
+        self.assertTrue(response.context['has_next'])
+
+    def test_connect(self):
+        payment = self.payment(reference=u"123", amount=self.cycle.sum)
+        url = '/membership/billing_cycles/connect_payment/%d/' % self.cycle.id
+        response = self.client.post(url, {'payment': payment.id})
+        self.assertRedirects(response, '/membership/billing_cycles/edit/%d/' % self.cycle.id)
+        self.assertEqual(Payment.objects.get(id=payment.id).billingcycle, self.cycle)
+
+    def test_connect_rejects_unavailable_payments(self):
+        url = '/membership/billing_cycles/connect_payment/%d/' % self.cycle.id
+        ignored = self.payment()
+        ignored.ignore = True
+        ignored.save()
+        for payment_id in [ignored.id, 999999, u"x"]:
+            response = self.client.post(url, {'payment': payment_id})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.context['form'].errors)
+        self.assertIsNone(Payment.objects.get(id=ignored.id).billingcycle)
+
+
 class CSVNoMembersTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
 
@@ -968,6 +1650,42 @@ class CSVNoMembersTest(TestCase):
         error = "No payments should match without any members in db"
         self.assertEqual(nomatch_payments, 0, error)
 
+class CSVTestDataTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def test_print_csv(self):
+        user = User.objects.get(id=1)
+        for i in xrange(4):
+            membership = create_dummy_member('N')
+            membership.preapprove(user)
+            membership.approve(user)
+        makebills()
+        BillingCycle.objects.filter(id=BillingCycle.objects.latest('id').id).update(is_paid=True)
+
+        output = StringIO()
+        print_csv(stream=output, count=2)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], header_row)
+        # count unpaid cycles and one paid cycle
+        self.assertEqual(len(lines), 4)
+
+
+class PublicMemberlistCommandTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def test_same_as_view(self):
+        for i in xrange(3):
+            create_dummy_member('A')
+        Membership.objects.update(public_memberlist=True)
+        output = StringIO()
+        call_command('public_memberlist', stdout=output)
+        with self.settings(TRUSTED_HOSTS=['127.0.0.1']):
+            response = self.client.get('/membership/public_memberlist/')
+        self.assertEqual(output.getvalue().decode('utf-8'),
+                         b"".join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(output.getvalue().count('<person>'), 3)
+
+
 class CSVReadingTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
 
@@ -1022,6 +1740,139 @@ class CSVReadingTest(TestCase):
             process_op_csv(f)  # Valid csv should not raise header error
 
 
+
+class PaymentImportRegistryTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def csv(self, transaction_ids):
+        lines = [header_row]
+        for i, transaction_id in enumerate(transaction_ids):
+            lines.append(csv_row.format({'date': '0%d.01.2015' % (i + 1), 'sum': u"35,00",
+                                         'payer': u"MEIKALAINEN MATTI", 'account': u"",
+                                         'reference': u"", 'message': u"",
+                                         'id': transaction_id}))
+        return StringIO(u"\n".join(lines).encode('iso-8859-1'))
+
+    def test_same_file_is_skipped(self):
+        process_op_csv(self.csv(['a1', 'a2']))
+        self.assertEqual(Payment.objects.count(), 2)
+        with self.assertNumQueries(1):
+            messages = process_op_csv(self.csv(['a1', 'a2']))
+        self.assertIn(u"already imported", messages[0][2])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(PaymentImport.objects.count(), 1)
+
+        registered = PaymentImport.objects.get()
+        self.assertEqual((registered.rows, registered.new_rows), (2, 2))
+        self.assertEqual(registered.first_date, datetime(2015, 1, 1))
+        self.assertEqual(registered.last_date, datetime(2015, 1, 2))
+        self.assertEqual((registered.first_transaction, registered.last_transaction), ('a1', 'a2'))
+
+    def test_only_new_rows_are_processed(self):
+        process_op_csv(self.csv(['a1', 'a2']))
+        messages = process_op_csv(self.csv(['a1', 'a2', 'a3']))
+        self.assertIn(u"2 of 3 rows already imported, processing 1 new rows", messages[0][2])
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual(PaymentImport.objects.order_by('-id')[0].new_rows, 1)
+
+
+
+class PaymentImportJobTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.assertTrue(self.client.login(username='admin', password='dhtn'))
+
+    def upload(self, name):
+        with open_test_data(name) as f:
+            response = self.client.post('/membership/payments/import/', {'csv': f, 'format': 'op'})
+        job = PaymentImportJob.objects.latest('id')
+        self.assertRedirects(response, '/membership/payments/import/%d/' % job.id)
+        return job
+
+    def test_upload_is_processed_in_background(self):
+        job = self.upload("csv-test.csv")
+        self.assertEqual(job.status, 'Q')
+        self.assertEqual(job.filename, "csv-test.csv")
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertTrue(job.csv_file.storage.exists(job.csv_file.name))
+
+        call_command('process_payment_imports', stdout=StringIO())
+        job = PaymentImportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, 'D')
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual((job.rows_total, job.attached, job.unknown), (7, 0, 3))
+        self.assertEqual(job.rows_processed, 7)
+        self.assertEqual(len(job.import_messages()), 4)
+        self.assertFalse(job.csv_file)
+
+        progress = json.loads(self.client.get('/membership/payments/import/%d/progress/' % job.id).content)
+        self.assertTrue(progress['finished'])
+        self.assertEqual(progress['unknown'], 3)
+        response = self.client.get('/membership/payments/import/%d/' % job.id)
+        self.assertEqual(len(response.context['import_messages']), 4)
+
+    def test_failed_import_is_recorded(self):
+        job = self.upload("csv-invalid.csv")
+        call_command('process_payment_imports', stdout=StringIO())
+        job = PaymentImportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, 'F')
+        self.assertIn("RequiredFieldNotFoundException", job.error)
+        self.assertEqual(len(job.import_messages()), 1)
+        job.csv_file.delete()
+
+    def test_lost_worker(self):
+        job = self.upload("csv-test.csv")
+        self.assertEqual(claim_payment_import_job().id, job.id)
+        # The worker dies without finishing the job
+        self.assertEqual(recover_stale_jobs(), (0, 0))
+        later = datetime.now() + JOB_LEASE + timedelta(minutes=1)
+        self.assertEqual(recover_stale_jobs(now=later), (1, 0))
+        self.assertEqual(PaymentImportJob.objects.get(id=job.id).status, 'Q')
+
+        call_command('process_payment_imports', stdout=StringIO())
+        job = PaymentImportJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.attempts), ('D', 2))
+        self.assertEqual(Payment.objects.count(), 3)
+
+    def test_requeued_job_is_not_overwritten(self):
+        job = self.upload("csv-test.csv")
+        claimed = claim_payment_import_job()
+        # Requeued and claimed by another worker meanwhile
+        PaymentImportJob.objects.filter(id=job.id).update(attempts=claimed.attempts + 1)
+        run_payment_import_job(claimed)
+        job = PaymentImportJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.attempts), ('R', 2))
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertTrue(job.csv_file.storage.exists(job.csv_file.name))
+        job.csv_file.delete()
+
+    def test_progress_by_time(self):
+        class Progress(object):
+            def __init__(self):
+                self.updates = []
+
+            def update(self, processed, attached, unknown):
+                self.updates.append(processed)
+
+        with open_test_data("csv-test.csv") as f:
+            rows = list(OpDictReader(f))
+        progress = Progress()
+        process_payments(rows, progress=progress, progress_seconds=0)
+        # Before every row but the first, then the final update
+        self.assertEqual(progress.updates, range(1, len(rows)) + [len(rows)])
+
+    def test_lost_worker_retries_are_limited(self):
+        job = self.upload("csv-test.csv")
+        PaymentImportJob.objects.filter(id=job.id).update(status='R', attempts=MAX_ATTEMPTS)
+        later = datetime.now() + JOB_LEASE + timedelta(minutes=1)
+        self.assertEqual(recover_stale_jobs(now=later), (0, 1))
+        job = PaymentImportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, 'F')
+        self.assertEqual(len(job.import_messages()), 1)
+        job.csv_file.delete()
+
+
 class ProcountorCSVNoMembersTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
 
@@ -1131,7 +1982,8 @@ class LoginRequiredTest(TestCase):
         for url in self.urls:
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
-            self.assertEqual(response.context['user'].username, 'admin')
+            # The streamed exports have no template context
+            self.assertEqual(response.wsgi_request.user.username, 'admin')
 
 class TrustedHostTest(TestCase):
     def setUp(self):
@@ -1318,6 +2170,19 @@ class MemberApplicationTest(TestCase):
         new = Membership.objects.latest("id")
         self.assertEquals(new.person.first_name, u"Yrjö")
 
+    def test_application_services(self):
+        response = self.client.post('/membership/application/person/', self.post_data)
+        self.assertRedirects(response, '/membership/application/person/success/')
+        new = Membership.objects.latest("id")
+        services = Service.objects.filter(owner=new)
+        self.assertEquals(sorted(s.servicetype.servicetype for s in services),
+                          ['Email alias', 'MySQL database', 'PostgreSQL database',
+                           'UNIX account', 'WWW vhost'])
+        login_alias = Alias.objects.get(owner=new, account=True)
+        self.assertEquals(login_alias.name, 'luser')
+        self.assertTrue(Alias.objects.filter(owner=new, name='y.aikas').exists())
+        self.assertEquals(services.get(servicetype__servicetype='WWW vhost').alias, login_alias)
+
     def test_clean_ajax_output(self):
         post_data = self.post_data.copy()
         post_data['first_name'] = u'<b>Yrjö</b>'
@@ -1364,6 +2229,61 @@ class MemberApplicationTest(TestCase):
         self.assertEqual(result['valid'], True)
         alias.delete()
 
+class ServiceProvisioningTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.membership = create_dummy_member('N')
+        self.membership.save()
+
+    def test_servicetype_cache(self):
+        clear_servicetype_cache()
+        with self.assertNumQueries(1):
+            self.assertEquals(get_servicetype('UNIX account').servicetype, 'UNIX account')
+            self.assertEquals(get_servicetype('WWW vhost').servicetype, 'WWW vhost')
+        self.assertRaises(ServiceType.DoesNotExist, get_servicetype, 'Nonexistent')
+
+    def test_servicetype_cache_invalidated(self):
+        get_servicetype('UNIX account')
+        ServiceType.objects.create(servicetype='Shiny new service')
+        self.assertEquals(get_servicetype('Shiny new service').servicetype, 'Shiny new service')
+
+    def test_servicetype_cache_expires(self):
+        clear_servicetype_cache()
+        self.addCleanup(clear_servicetype_cache)
+        unix_account = get_servicetype('UNIX account')
+        # Changed by another process, so no signal is received here
+        ServiceType.objects.filter(id=unix_account.id).update(servicetype='UNIX login')
+        self.assertEquals(get_servicetype('UNIX account'), unix_account)
+
+        class LaterTime(object):
+            def time(self):
+                return real_time.time() + SERVICETYPE_CACHE_SECONDS + 1
+        real_time = services_models.time
+        services_models.time = LaterTime()
+        self.addCleanup(setattr, services_models, 'time', real_time)
+        self.assertRaises(ServiceType.DoesNotExist, get_servicetype, 'UNIX account')
+        self.assertEquals(get_servicetype('UNIX login').id, unix_account.id)
+
+    def test_provision_services(self):
+        services = provision_services(self.membership, 'jdoe', email_forward='john.doe',
+                                      mysql_database=True, login_vhost=True)
+        self.assertEquals([s.servicetype.servicetype for s in services],
+                          ['UNIX account', 'Email alias', 'MySQL database', 'WWW vhost'])
+        self.assertEquals(Service.objects.filter(owner=self.membership).count(), 4)
+        self.assertEquals(Alias.objects.get(name='jdoe').account, True)
+        self.assertEquals(Service.objects.get(servicetype__servicetype='Email alias',
+                                              owner=self.membership).alias.name, 'john.doe')
+
+    def test_provision_services_alias_taken(self):
+        other = create_dummy_member('A')
+        other.save()
+        Alias(owner=other, name='john.doe').save()
+        self.assertRaises(ValidationError, provision_services, self.membership,
+                          'jdoe', email_forward='john.doe')
+        self.assertFalse(Alias.objects.filter(owner=self.membership).exists())
+
+
 class PhoneNumberFieldTest(TestCase):
     def setUp(self):
         self.field = PhoneNumberField()
@@ -1499,6 +2419,25 @@ class MemberListTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue('<span class="member_id">#%i</span>' % self.m1.id in response.content)
 
+    def test_plaintext_list(self):
+        m4 = create_dummy_member('N', type='O')
+        m4.preapprove(self.user)
+        response = self.client.get('/membership/memberships/preapproved-plain/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content).decode('utf-8')
+        self.assertEqual(content, u"<pre>\n%d %s ja \n%d %s.\n</pre>" %
+                         (self.m2.id, escape(self.m2.name()), m4.id, escape(m4.name())))
+
+    def test_approved_emails(self):
+        m4 = create_dummy_member('N', type='O')
+        m4.preapprove(self.user)
+        m4.approve(self.user)
+        response = self.client.get('/membership/memberships/approved-emails/')
+        self.assertEqual(response.status_code, 200)
+        content = b"".join(response.streaming_content).decode('utf-8')
+        self.assertEqual(content.splitlines(), [self.m1.person.email, m4.organization.email])
+
 
 class MemberDeletionTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
@@ -1536,6 +2475,59 @@ class MemberDeletionTest(TestCase):
         self.assertEquals(Alias.objects.all().count(), 1)
         self.assertFalse(Alias.objects.all()[0].is_valid())
 
+    def _member_with_alias(self):
+        m = create_dummy_member('N')
+        a = Alias(owner=m, name=Alias.email_forwards(m)[0])
+        a.save()
+        Service(servicetype=ServiceType.objects.get(servicetype='Email alias'),
+                alias=a, owner=m, data=a.name).save()
+        return m
+
+    def test_purge(self):
+        application = self._member_with_alias()
+        preapproved = self._member_with_alias()
+        preapproved.preapprove(self.user)
+        approved = create_dummy_member('A')
+        contact_ids = [application.person_id, preapproved.person_id]
+        orphan = Contact(first_name=u"Orpo", last_name=u"Kontakti", street_address=u"Katu 1",
+                         postal_code=u"00100", post_office=u"Helsinki", country=u"Finland")
+        orphan.save()
+
+        counts = Membership.purge([application.id, preapproved.id, approved.id], self.user)
+        self.assertEqual(counts, {'memberships': 2, 'services': 1, 'aliases_deleted': 1,
+                                  'aliases_expired': 1, 'contacts': 2})
+        self.assertEqual(Membership.objects.filter(status='D').count(), 2)
+        self.assertEqual(Membership.objects.get(id=approved.id).status, 'A')
+        self.assertIsNone(Membership.objects.get(id=application.id).person)
+        self.assertFalse(Contact.objects.filter(id__in=contact_ids).exists())
+        # Only the contacts of the purged memberships are deleted
+        self.assertTrue(Contact.objects.filter(id=orphan.id).exists())
+        self.assertFalse(Alias.objects.get(owner=preapproved).is_valid())
+        self.assertEqual(Membership.objects.get(id=preapproved.id).logs
+                         .filter(change_message="Deleted").count(), 1)
+
+    def test_purge_command(self):
+        application = self._member_with_alias()
+        Membership.objects.filter(id=application.id).update(created=datetime.now() - timedelta(days=400))
+        self._member_with_alias()
+        out = StringIO()
+        call_command('purge_memberships', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Would delete 1 memberships, 1 services, "
+                         "1 aliases and 1 contacts, would expire 0 aliases")
+        self.assertEqual(Membership.objects.filter(status='D').count(), 0)
+        self.assertEqual(Alias.objects.count(), 2)
+
+        call_command('purge_memberships', '--user', 'admin', stdout=StringIO())
+        self.assertEqual(list(Membership.objects.filter(status='D')), [application])
+        self.assertEqual(Alias.objects.count(), 1)
+
+    def test_find_memberid(self):
+        m = create_dummy_member('N')
+        self.assertEqual(m.person.find_memberid(), m.id)
+        other = create_dummy_member('N')
+        Membership.objects.filter(id=other.id).update(billing_contact=m.person)
+        self.assertEqual(m.person.find_memberid(), m.id)
+
 
 class MemberDissociationRequestedTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
@@ -1696,6 +2688,234 @@ class MemberDissociationTest(TestCase):
         self.assertTrue(m.dissociated < after)
 
 
+class BulkStatusChangeTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        self.new = [create_dummy_member('N') for i in xrange(3)]
+        self.approved = create_dummy_member('A')
+        mail.outbox = []
+
+    def _post(self, request_type, payload):
+        login = self.client.login(username='admin', password='dhtn')
+        self.assertTrue(login, 'Could not log in')
+        response = self.client.post('/membership/application/handle_json/',
+                                    json.dumps({"requestType": request_type, "payload": payload}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['results']
+
+    def test_bulk_preapprove(self):
+        ids = [m.id for m in self.new]
+        results = Membership.bulk_preapprove(ids + [self.approved.id, 999999], self.user)
+        self.assertEqual(results[self.new[0].id], 'ok')
+        self.assertEqual(results[self.approved.id], 'invalid_transition')
+        self.assertEqual(results[999999], 'not_found')
+        self.assertEqual(Membership.objects.filter(id__in=ids, status='P').count(), 3)
+        self.assertEqual(self.new[1].logs.filter(change_message="Preapproved").count(), 1)
+        self.assertEqual(QueuedEmail.objects.count(), 3)
+
+        results = Membership.bulk_preapprove([self.new[0].id], self.user)
+        self.assertEqual(results[self.new[0].id], 'already')
+
+    def test_bulk_approve_query_count(self):
+        ids = [m.id for m in self.new]
+        Membership.bulk_preapprove(ids, self.user)
+        # Independent of the number of memberships
+        with self.assertNumQueries(7):
+            results = Membership.bulk_approve(ids, self.user)
+        self.assertEqual(set(results.values()), set(['ok']))
+        for m in Membership.objects.filter(id__in=ids):
+            self.assertEqual(m.status, 'A')
+            self.assertIsNotNone(m.approved)
+
+    def test_bulk_json(self):
+        ids = [m.id for m in self.new]
+        results = self._post("BULK_PREAPPROVE", ids + ["foo"])
+        self.assertEqual(results[unicode(ids[0])], 'ok')
+        self.assertEqual(results["foo"], 'invalid_id')
+        results = self._post("BULK_APPROVE", ids)
+        self.assertEqual(results, dict((unicode(id), 'ok') for id in ids))
+
+    def _unpaid_member(self, paper_reminder=True):
+        membership = create_dummy_member('N')
+        membership.preapprove(self.user)
+        membership.approve(self.user)
+        cycle = create_billingcycle(membership)
+        cycle.bill_set.update(due_date=datetime.now() - timedelta(days=40))
+        if paper_reminder:
+            Bill(billingcycle=cycle, type='P', reminder_count=1,
+                 due_date=datetime.now() - timedelta(days=20)).save()
+        return membership
+
+    def test_bulk_dissociate(self):
+        unpaid = [self._unpaid_member() for i in xrange(3)]
+        ids = [m.id for m in unpaid]
+        results, memberships = Membership.bulk_dissociate(ids + [self.new[0].id], self.user)
+        self.assertEqual(results[self.new[0].id], 'invalid_transition')
+        self.assertEqual([m.id for m in memberships], ids)
+        for m in Membership.objects.filter(id__in=ids):
+            self.assertEqual(m.status, 'I')
+            self.assertIsNotNone(m.dissociated)
+            self.assertEqual(m.logs.filter(change_message="Dissociated").count(), 1)
+        # Same cancellations as Membership.dissociate()
+        first_bills = [m.billingcycle_set.get().first_bill() for m in unpaid]
+        self.assertEqual(sorted(CancelledBill.objects.values_list('bill', flat=True)),
+                         sorted(bill.id for bill in first_bills))
+
+        results, memberships = Membership.bulk_dissociate(ids, self.user)
+        self.assertEqual(set(results.values()), set(['already']))
+        self.assertEqual(CancelledBill.objects.count(), 3)
+
+    def test_dissociate_unpaid_command(self):
+        unpaid = self._unpaid_member()
+        self._unpaid_member(paper_reminder=False)
+        out = StringIO()
+        call_command('dissociate_unpaid', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().decode('utf-8').splitlines(),
+                         [u"Would dissociate #%d %s" % (unpaid.id, unpaid.name()),
+                          u"1 memberships would be dissociated"])
+        self.assertEqual(Membership.objects.filter(status='I').count(), 0)
+        self.assertEqual(CancelledBill.objects.count(), 0)
+
+        call_command('dissociate_unpaid', '--user', 'admin', stdout=StringIO())
+        self.assertEqual(list(Membership.objects.filter(status='I')), [unpaid])
+        self.assertEqual(CancelledBill.objects.count(), 1)
+
+    def test_bulk_dissociate_json(self):
+        unpaid = self._unpaid_member()
+        results = self._post("BULK_DISSOCIATE", [unpaid.id])
+        self.assertEqual(results, {unicode(unpaid.id): 'ok'})
+        self.assertEqual(Membership.objects.get(id=unpaid.id).status, 'I')
+
+
+class MembershipDossierTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        self.membership = create_dummy_member('N')
+        self.membership.preapprove(self.user)
+        self.membership.approve(self.user)
+        Alias(owner=self.membership, name='dossier', account=True).save()
+        self.year = 2004
+
+    def _add_cycle(self, cancel=False):
+        cycle = BillingCycle(membership=self.membership, start=datetime(self.year, 1, 1))
+        cycle.save()
+        self.year += 1
+        bill = Bill(billingcycle=cycle)
+        bill.save()
+        Bill(billingcycle=cycle, reminder_count=1).save()
+        if cancel:
+            CancelledBill(bill=bill).save()
+        payment = Payment(billingcycle=cycle, amount=cycle.sum, payment_day=cycle.start,
+                          transaction_id="dossier-%d" % cycle.id)
+        payment.save()
+        return cycle
+
+    def _get_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/membership/memberships/edit/%d/' % self.membership.id)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_fixed_query_count(self):
+        self.assertTrue(self.client.login(username='admin', password='dhtn'))
+        self._add_cycle()
+        response, few = self._get_page()
+        for i in xrange(5):
+            self._add_cycle()
+        response, many = self._get_page()
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.context['dossier']['cycles']), 6)
+
+    def test_cancelled_cycle(self):
+        self._add_cycle()
+        cancelled = self._add_cycle(cancel=True)
+        dossier = Membership.objects.get(id=self.membership.id).dossier()
+        flags = dict((cycle.id, cycle.cancelled) for cycle in dossier['cycles'])
+        self.assertTrue(flags[cancelled.id])
+        self.assertEqual(sum(flags.values()), 1)
+        for cycle in dossier['cycles']:
+            self.assertEqual(cycle.cancelled, cycle.is_cancelled())
+            self.assertEqual(len(cycle.bills), 2)
+            self.assertEqual(len(cycle.payments), 1)
+        self.assertEqual([a.name for a in dossier['aliases']], ['dossier'])
+
+
+class ArchiveBillingTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        self.membership = create_dummy_member('N')
+        self.membership.preapprove(self.user)
+        self.membership.approve(self.user)
+
+    def _add_cycle(self, year, paid=True):
+        cycle = BillingCycle(membership=self.membership, start=datetime(year, 1, 1))
+        cycle.save()
+        Bill(billingcycle=cycle).save()
+        if paid:
+            Payment(billingcycle=cycle, amount=cycle.sum, payment_day=cycle.start,
+                    transaction_id="archive-%d" % cycle.id).save()
+            cycle.is_paid = True
+            cycle.save()
+        log_change(cycle, self.user, change_message="Archive test")
+        return cycle
+
+    def test_archive_billing(self):
+        old = self._add_cycle(2004)
+        unpaid = self._add_cycle(2005, paid=False)
+        latest = self._add_cycle(2006)
+        self.assertEqual(list(archivable_cycles(years=7)), [old])
+
+        out = StringIO()
+        call_command('archive_billing', '--years', '7', stdout=out)
+        self.assertIn("Archived 1 billing cycles, 1 bills, 0 cancelled bills, 1 payments "
+                      "and 1 log entries", out.getvalue())
+        self.assertEqual(list(BillingCycle.objects.filter(membership=self.membership)
+                              .order_by('id').values_list('id', flat=True)), [unpaid.id, latest.id])
+        archived = ArchivedBillingCycle.objects.get()
+        self.assertEqual((archived.id, archived.reference_number, archived.is_paid),
+                         (old.id, old.reference_number, True))
+        self.assertEqual(ArchivedBill.objects.get().billingcycle_id, old.id)
+        self.assertEqual(ArchivedPayment.objects.get().transaction_id, "archive-%d" % old.id)
+        self.assertEqual(ArchivedLogEntry.objects.get().object_id, str(old.id))
+        self.assertEqual(existing_transaction_ids(["archive-%d" % old.id, "new"]),
+                         set(["archive-%d" % old.id]))
+
+        out = StringIO()
+        call_command('archive_billing', '--years', '7', '--dry-run', stdout=out)
+        self.assertIn("0 billing cycles would be archived", out.getvalue())
+
+    def test_dissociated_membership(self):
+        self._add_cycle(2004)
+        self._add_cycle(2005, paid=False)
+        Membership.objects.filter(id=self.membership.id).update(status='I')
+        self.assertEqual(archivable_cycles(years=7).count(), 2)
+
+    def test_archived_history_on_demand(self):
+        old = self._add_cycle(2004)
+        self._add_cycle(2006)
+        call_command('archive_billing', '--years', '7', stdout=StringIO())
+        self.assertTrue(self.client.login(username='admin', password='dhtn'))
+        url = '/membership/memberships/edit/%d/' % self.membership.id
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['dossier']['cycles']), 1)
+        self.assertContains(response, 'id="show_archived"')
+        response = self.client.get(url + '?archived=1')
+        cycles = response.context['dossier']['cycles']
+        self.assertEqual([cycle.id for cycle in cycles][0], old.id)
+        self.assertTrue(cycles[0].archived)
+        self.assertEqual(len(cycles[0].bills), 1)
+        self.assertEqual(len(cycles[0].payments), 1)
+        self.assertNotContains(response, 'id="show_archived"')
+        self.assertNotContains(response, '/membership/bills/edit/%d/' % cycles[0].bills[0].id)
+
+
 class MetricsInterfaceTest(TestCase):
     def setUp(self):
         self.orig_trusted = settings.TRUSTED_HOSTS
@@ -1715,6 +2935,75 @@ class MetricsInterfaceTest(TestCase):
         for key in [u'unpaid_count', u'unpaid_sum']:
             self.assertTrue(d[u'bills'].has_key(key))
 
+
+class DailyStatisticsTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.orig_trusted = settings.TRUSTED_HOSTS
+        settings.TRUSTED_HOSTS = ['127.0.0.1']
+        self.user = User.objects.get(id=1)
+        self.today = datetime.now().date()
+        for answer in ['friend', 'friend', 'other: a poster']:
+            membership = create_dummy_member('N')
+            ApplicationPoll(membership=membership, answer=answer).save()
+        membership.preapprove(self.user)
+        membership.approve(self.user)
+        BillingCycle(membership=membership, start=datetime.now()).save()
+
+    def tearDown(self):
+        settings.TRUSTED_HOSTS = self.orig_trusted
+
+    def test_collect_statistics(self):
+        collect_statistics(self.today)
+        # Collecting again replaces the day
+        collect_statistics(self.today)
+        values = dict(((s.name, s.key), s.value) for s in DailyStatistic.objects.filter(date=self.today))
+        cycle = BillingCycle.objects.get()
+        self.assertEqual(values, {('status', 'N'): 2, ('status', 'A'): 1,
+                                  ('type', cycle.membership.type): 1,
+                                  ('unpaid', 'count'): 1, ('unpaid', 'sum'): cycle.sum,
+                                  ('applications', ''): 3, ('approvals', ''): 1,
+                                  ('poll', 'friend'): 2, ('poll', 'other'): 1})
+
+    def test_backfill_keeps_snapshots(self):
+        past = self.today - timedelta(days=2)
+        DailyStatistic(date=past, name='status', key='A', value=5).save()
+        collect_statistics(past)
+        values = dict(((s.name, s.key), s.value) for s in DailyStatistic.objects.filter(date=past))
+        self.assertEqual(values, {('status', 'A'): 5, ('applications', ''): 0, ('approvals', ''): 0})
+
+    def test_command_and_history(self):
+        yesterday = self.today - timedelta(days=1)
+        past = self.today - timedelta(days=2)
+        out = StringIO()
+        # By default the previous day, with the state at run time
+        call_command('rollup_statistics', stdout=out)
+        self.assertIn("for %s" % yesterday.isoformat(), out.getvalue())
+        call_command('rollup_statistics', '--date', self.today.isoformat(), stdout=StringIO())
+        # Backfilling an older day stores only the counts of events
+        call_command('rollup_statistics', '--date', past.isoformat(), stdout=StringIO())
+        self.assertRaises(CommandError, call_command, 'rollup_statistics',
+                          '--date', (self.today + timedelta(days=1)).isoformat())
+
+        self.assertEqual(statistics_series(['status']),
+                         {'status': {'A': [[yesterday.isoformat(), 1], [self.today.isoformat(), 1]],
+                                     'N': [[yesterday.isoformat(), 2], [self.today.isoformat(), 2]]}})
+        response = self.client.get('/membership/metrics/history/?name=applications&name=unpaid')
+        self.assertEqual(response.status_code, 200)
+        d = json.loads(response.content)
+        self.assertEqual(sorted(d.keys()), [u'applications', u'unpaid'])
+        self.assertEqual(d[u'applications'][u''], [[past.isoformat(), 0], [yesterday.isoformat(), 0],
+                                                   [self.today.isoformat(), 3]])
+        self.assertEqual(d[u'unpaid'][u'count'], [[yesterday.isoformat(), 1], [self.today.isoformat(), 1]])
+
+        response = self.client.get('/membership/metrics/history/?start=%s' % self.today.isoformat())
+        self.assertEqual([date for date, value in json.loads(response.content)[u'poll'][u'friend']],
+                         [self.today.isoformat()])
+        response = self.client.get('/membership/metrics/history/?start=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+
 class IpRangeListTest(TestCase):
     def test_rangelist(self):
         list1 = IpRangeList('127.0.0.1', '10.0.0.0/8', '127.0.0.2')
@@ -1920,6 +3209,78 @@ class MembershipPaperReminderSentTest(TestCase):
         self.assertIn(self.m, qs)
         self.assertIn(self.m2, qs)
 
+    def test_reminder_stage(self):
+        self.assertEquals(self.m.billingcycle_set.get().reminder_stage, REMINDER_STAGE_PAPER_SENT)
+        cycle = self.m3.billingcycle_set.get()
+        self.assertEquals(cycle.reminder_stage, REMINDER_STAGE_BILLED)
+        for i in xrange(2):
+            Bill(billingcycle=cycle, reminder_count=i + 1,
+                 due_date=datetime.now() - timedelta(days=10 - i)).save()
+        self.assertEquals(BillingCycle.objects.get(id=cycle.id).reminder_stage, REMINDER_STAGE_PAPER_DUE)
+
+        with self.settings(ENABLE_REMINDERS=True):
+            self.assertEquals(list(BillingCycle.get_reminder_billingcycles()), [cycle])
+            self.assertEquals(BillingCycle.create_paper_reminder_list(memberid=self.m3.id), [cycle])
+            self.assertEquals(BillingCycle.create_paper_reminder_list(memberid=self.m.id), [])
+
+    def test_reminder_stage_follows_bill_changes(self):
+        cycle = self.m3.billingcycle_set.get()
+        reminders = []
+        for i in xrange(2):
+            reminder = Bill(billingcycle=cycle, reminder_count=i + 1,
+                            due_date=datetime.now() - timedelta(days=10 - i))
+            reminder.save()
+            reminders.append(reminder)
+
+        with self.settings(ENABLE_REMINDERS=True):
+            self.assertEquals(list(BillingCycle.get_reminder_billingcycles()), [cycle])
+
+            reminders[1].type = 'P'
+            reminders[1].save()
+            self.assertEquals(list(BillingCycle.get_reminder_billingcycles()), [])
+
+            reminders[1].type = 'E'
+            reminders[1].save()
+            self.assertEquals(list(BillingCycle.get_reminder_billingcycles()), [cycle])
+
+            reminders[1].delete()
+            self.assertEquals(BillingCycle.objects.get(id=cycle.id).reminder_stage, REMINDER_STAGE_REMINDED)
+            self.assertEquals(list(BillingCycle.get_reminder_billingcycles()), [])
+
+            # Deleting the paper bill makes the cycle due for one again
+            paper_cycle = self.m.billingcycle_set.get()
+            for i in xrange(3):
+                Bill(billingcycle=paper_cycle, reminder_count=i + 1,
+                     due_date=datetime.now() - timedelta(days=10 - i)).save()
+            self.assertEquals(list(BillingCycle.get_reminder_billingcycles()), [])
+            paper_cycle.bill_set.get(type='P').delete()
+            self.assertEquals(list(BillingCycle.get_reminder_billingcycles()), [paper_cycle])
+
+    def test_reminder_stage_not_recomputed_for_unchanged_type(self):
+        bill = Bill.objects.get(billingcycle__membership=self.m3)
+        with CaptureQueriesContext(connection) as queries:
+            bill.save()
+        self.assertFalse([q for q in queries.captured_queries if 'reminder_stage' in q['sql']])
+
+    def test_bulk_delete(self):
+        cycle = self.m3.billingcycle_set.get()
+        for i in xrange(2):
+            Bill(billingcycle=cycle, reminder_count=i + 1,
+                 due_date=datetime.now() - timedelta(days=10 - i)).save()
+        self.assertEquals(BillingCycle.objects.get(id=cycle.id).reminder_stage, REMINDER_STAGE_PAPER_DUE)
+        paper_cycle = self.m.billingcycle_set.get()
+
+        deleted = Bill.bulk_delete(Bill.objects.filter(Q(reminder_count__gt=0) | Q(billingcycle=paper_cycle)))
+        self.assertEquals(deleted, 3)
+        self.assertEquals(BillingCycle.objects.get(id=cycle.id).reminder_stage, REMINDER_STAGE_BILLED)
+        self.assertEquals(BillingCycle.objects.get(id=paper_cycle.id).reminder_stage, REMINDER_STAGE_NONE)
+
+    def test_unpaid_paper_reminded_plain(self):
+        self.client.login(username='admin', password='dhtn')
+        response = self.client.get('/membership/memberships/unpaid_paper_reminded-plain/')
+        content = b"".join(response.streaming_content).decode('utf-8')
+        self.assertEqual(content, u"<pre>\n%d %s.\n</pre>" % (self.m.id, escape(self.m.name())))
+
 
 class CorrectVatAmountInBillTest(TestCase):
     """
@@ -1967,6 +3328,64 @@ class CorrectVatAmountInBillTest(TestCase):
         self.assertNotIn("vero 24", self.bill_2013.render_as_text())
 
 
+class QueuedEmailTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        mail.outbox = []
+
+    def test_preapprove_only_enqueues(self):
+        membership = create_dummy_member('N')
+        membership.preapprove(self.user)
+        self.assertEqual(len(mail.outbox), 0)
+        queued = QueuedEmail.objects.get()
+        self.assertEqual(queued.status, 'Q')
+        self.assertEqual(queued.to_message().to, [settings.SYSADMIN_EMAIL])
+
+    def test_application_only_enqueues(self):
+        post_data = {
+            "first_name": u"Yrjö", "given_names": u"Yrjö Kapsi", "last_name": u"Äikäs",
+            "street_address": "Vasagatan 9", "postal_code": "90230", "post_office": "VAASA",
+            "phone": "0123123123", "sms": "0123123123", "email": "veijo.invalid@valpas.kapsi.fi",
+            "homepage": "", "nationality": "Suomi", "country": "Suomi", "municipality": "Vaasa",
+            "extra_info": "", "unix_login": "luser", "birth_year": "1993", "email_forward": "no",
+        }
+        response = self.client.post('/membership/application/person/', post_data)
+        self.assertRedirects(response, '/membership/application/person/success/')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(deliver_queued_email(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("veijo.invalid@valpas.kapsi.fi", mail.outbox[0].to[0])
+        self.assertEqual(QueuedEmail.objects.get().status, 'S')
+
+    def test_delivery_concurrent(self):
+        for i in xrange(5):
+            QueuedEmail.enqueue(EmailMessage(u"Subject %d" % i, u"Body", settings.FROM_EMAIL,
+                                             ["member%d@example.com" % i]))
+        self.assertEqual(deliver_queued_email(workers=3), (5, 0))
+        self.assertEqual(sorted(m.subject for m in mail.outbox),
+                         [u"Subject %d" % i for i in xrange(5)])
+        self.assertEqual(deliver_queued_email(), (0, 0))
+
+    def test_delivery_backoff(self):
+        queued = QueuedEmail.enqueue(EmailMessage(u"Subject", u"Body", settings.FROM_EMAIL,
+                                                  ["member@example.com"]))
+        with self.settings(EMAIL_BACKEND='nonexistent.EmailBackend'):
+            self.assertEqual(deliver_queued_email(max_attempts=2), (0, 1))
+            queued.refresh_from_db()
+            self.assertEqual(queued.status, 'Q')
+            self.assertTrue(queued.next_attempt > datetime.now())
+            # Not due yet
+            self.assertEqual(deliver_queued_email(max_attempts=2), (0, 0))
+            QueuedEmail.objects.update(next_attempt=datetime.now())
+            self.assertEqual(deliver_queued_email(max_attempts=2), (0, 1))
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'F')
+        self.assertEqual(queued.attempts, 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+
 class EmailUtilsTests(TestCase):
     def test_unicode_in_name(self):
         res = email_utils.format_email(u'räyh', 'foo@bar')
@@ -1993,6 +3412,47 @@ class EmailUtilsTests(TestCase):
         self.assertEqual(res, u'"rauh\'joo" <foo@bar>')
 
 
+class MboxEmailBackendTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mbox')
+
+    def tearDown(self):
+        mboxemailbackend.close_files()
+        shutil.rmtree(self.directory)
+
+    def _send(self, *subjects):
+        backend = mboxemailbackend.EmailBackend()
+        return backend.send_messages([EmailMessage(subject, u"Body", settings.FROM_EMAIL,
+                                                   ["member@example.com"])
+                                      for subject in subjects])
+
+    def test_send_messages(self):
+        with self.settings(EMAIL_MBOX_FILE_PATH=self.path):
+            self.assertEqual(self._send("First", "Second"), 2)
+            self.assertEqual(self._send("Third"), 1)
+        with open(self.path) as f:
+            messages = list(mailbox.UnixMailbox(f))
+        self.assertEqual([m['Subject'] for m in messages], ["First", "Second", "Third"])
+
+    def test_reopen_moved_file(self):
+        with self.settings(EMAIL_MBOX_FILE_PATH=self.path):
+            self._send("First")
+            os.rename(self.path, self.path + ".old")
+            self._send("Second")
+        with open(self.path) as f:
+            self.assertEqual([m['Subject'] for m in mailbox.UnixMailbox(f)], ["Second"])
+
+    def test_rotate(self):
+        with self.settings(EMAIL_MBOX_FILE_PATH=self.path, EMAIL_MBOX_ROTATE=True):
+            self._send("First")
+            rotated = mboxemailbackend.mbox_file_path()
+        self.assertNotEqual(rotated, self.path)
+        self.assertTrue(os.path.exists(rotated))
+        self.assertFalse(os.path.exists(self.path))
+
+
 class TestMembersToLock(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
 
@@ -2088,3 +3548,37 @@ class TestGenerateTestData(TestCase):
         self.assertEquals(Membership.objects.filter(status="D").count(), 6)
         self.assertEquals(Membership.objects.filter(status="P").count(), 7)
         self.assertEquals(Membership.objects.filter(status="A").count(), 8)
+
+
+class BenchmarkBillingTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def cached_files(self):
+        return sum(len(files) for path, dirs, files in os.walk(settings.CACHE_DIRECTORY))
+
+    def test_small_run(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        cached_files = self.cached_files()
+        try:
+            call_command('benchmark_billing', '--members', '20', '--pdf-count', '2',
+                         '--batch-size', '7', '--output', path, stdout=StringIO())
+            with open(path) as f:
+                report = json.load(f)
+        finally:
+            os.remove(path)
+        # The PDFs are rendered into a temporary directory
+        self.assertEqual(self.cached_files(), cached_files)
+        self.assertIs(Bill._meta.get_field('pdf_file').storage, cache_storage)
+        self.assertEquals(Membership.objects.filter(status='A').count(), 20)
+        stages = dict((stage['stage'], stage) for stage in report['stages'])
+        self.assertEquals(stages['makebills']['bills'], 20)
+        self.assertEquals(stages['get_bill_pdf']['pdfs'], 2)
+        self.assertTrue(stages['makebills']['queries'] > 20)
+        self.assertEquals(stages['view /membership/payments/']['status_code'], 200)
+        self.assertEquals(Payment.objects.filter(billingcycle=None).count(), 0)
+
+    def test_peak_rss_reported(self):
+        err = StringIO()
+        call_command('public_memberlist', stdout=StringIO(), stderr=err, verbosity=2)
+        self.assertTrue(re.match(r'Peak RSS of public_memberlist: \d+ kB', err.getvalue()))
@@ -29,6 +29,7 @@ urlpatterns = [
 
     url(r'testemail/$', membership.views.test_email, name='test_email'),
     url(r'metrics/$', membership.views.membership_metrics),
+    url(r'metrics/history/$', membership.views.membership_metrics_history),
     url(r'public_memberlist/$', membership.views.public_memberlist),
     url(r'unpaid_members/$', membership.views.unpaid_members),
     url(r'users_to_lock/$', membership.views.users_to_lock),
@@ -55,10 +56,15 @@ urlpatterns = [
     url(r'bills/pdf/bill_(\d+)\.pdf$', membership.views.bill_pdf, name='bill_pdf'),
     url(r'billing_cycles/connect_payment/(\d+)/$', membership.views.billingcycle_connect_payment,
         name='billingcycle_connect_payment'),
+    url(r'billing_cycles/connect_payment/(\d+)/candidates/$', membership.views.billingcycle_payment_candidates_json,
+        name='billingcycle_payment_candidates_json'),
     url(r'billing_cycles/edit/(\d+)/$', membership.views.billingcycle_edit, name='billingcycle_edit'),
 
     url(r'payments/edit/(\d+)/$', membership.views.payment_edit, name='payment_edit'),
     url(r'payments/import/$', membership.views.import_payments, name='import_payments'),
+    url(r'payments/import/(\d+)/$', membership.views.payment_import_job, name='payment_import_job'),
+    url(r'payments/import/(\d+)/progress/$', membership.views.payment_import_job_json,
+        name='payment_import_job_json'),
     url(r'payments/send_duplicate_notification/(\d+)$', membership.views.send_duplicate_notification,
         name='payment_send_duplicate_notification'),
 
@@ -74,45 +80,38 @@ urlpatterns = [
         {'queryset': Membership.objects.filter(status__exact='N').order_by('id'),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='new_memberships'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='new_memberships'),
     url(r'memberships/preapproved/$', membership.views.member_object_list,
         {'queryset': Membership.objects.filter(status__exact='P').order_by('id'),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='preapproved_memberships'),
-    url(r'memberships/preapproved-plain/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='P').order_by('id'),
-         'template_name': 'membership/membership_list_plaintext.html',
-         'context_object_name': 'member_list'},
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='preapproved_memberships'),
+    url(r'memberships/preapproved-plain/$', membership.views.member_list_plaintext,
+        {'queryset': Membership.objects.filter(status__exact='P').order_by('id')},
          name='preapproved_memberships_plain'),
     url(r'memberships/approved/$', membership.views.member_object_list,
         {'queryset': Membership.objects.filter(status__exact='A').
             order_by('person__last_name', 'person__first_name', 'id'),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='approved_memberships'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='approved_memberships'),
     url(r'memberships/dissociation_requested/$', membership.views.member_object_list,
         {'queryset': Membership.objects.filter(status__exact='S').
             order_by('person__last_name', 'person__first_name', 'id'),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='dissociation_requested_memberships'),
-    url(r'memberships/dissociation_requested-plain/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='S').order_by('id'),
-         'template_name': 'membership/membership_list_plaintext.html',
-         'context_object_name': 'member_list'},
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='dissociation_requested_memberships'),
+    url(r'memberships/dissociation_requested-plain/$', membership.views.member_list_plaintext,
+        {'queryset': Membership.objects.filter(status__exact='S').order_by('id')},
          name='dissociation_requested_memberships_plain'),
     url(r'memberships/dissociated/$', membership.views.member_object_list,
         {'queryset': Membership.objects.filter(status__exact='I').
             order_by('person__last_name', 'person__first_name', 'id'),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='dissociated_memberships'),
-    url(r'memberships/approved-emails/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='A').
-            order_by('id').values('person__email', 'organization__email'),
-         'template_name': 'membership/membership_list_emails.txt',
-         'context_object_name': 'member_list'},
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='dissociated_memberships'),
+    url(r'memberships/approved-emails/$', membership.views.member_list_emails,
+        {'queryset': Membership.objects.filter(status__exact='A').order_by('id')},
          name='approved_memberships_emails'),
     url(r'memberships/unpaid_paper_reminded/$', membership.views.unpaid_paper_reminded, name='unpaid_paper_reminded_memberships'),
     url(r'memberships/unpaid_paper_reminded-plain/$', membership.views.unpaid_paper_reminded_plain,
@@ -121,38 +120,39 @@ urlpatterns = [
         {'queryset': Membership.objects.filter(status__exact='D').order_by('-id'),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='deleted_memberships'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='deleted_memberships'),
     url(r'memberships/$', membership.views.member_object_list,
         {'queryset': Membership.objects.all(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='all_memberships'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='all_memberships'),
 
     url(r'^memberships/inline/search/$', membership.views.search,
         {'template_name': 'membership/membership_list_inline.html',
-         'context_object_name': 'member_list', 'paginate_by': ENTRIES_PER_PAGE}),
+         'context_object_name': 'member_list', 'paginate_by': ENTRIES_PER_PAGE,
+         'keyset': True}),
     url(r'^memberships/search/$', membership.views.search,
         {'template_name': 'membership/membership_list.html',
-         'context_object_name': 'member_list', 'paginate_by': ENTRIES_PER_PAGE},
-         name='membership_search'),
+         'context_object_name': 'member_list', 'paginate_by': ENTRIES_PER_PAGE,
+         'keyset': True}, name='membership_search'),
 
     url(r'bills/$', membership.views.billing_object_list,
         {'queryset': BillingCycle.objects.filter(
             membership__status='A').order_by('-start', '-id'),
          'template_name': 'membership/bill_list.html',
          'context_object_name': 'cycle_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='cycle_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='cycle_list'),
     url(r'bills/unpaid/$', membership.views.billing_object_list,
         {'queryset': BillingCycle.objects.filter(is_paid__exact=False,
             membership__status='A').order_by('start', 'id'),
          'template_name': 'membership/bill_list.html',
          'context_object_name': 'cycle_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='unpaid_cycle_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='unpaid_cycle_list'),
     url(r'bills/locked/$', membership.views.billing_object_list,
         {'queryset': BillingCycle.get_reminder_billingcycles(),
          'template_name': 'membership/bill_list.html',
          'context_object_name': 'cycle_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='locked_cycle_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='locked_cycle_list'),
     url(r'bills/print_reminders/$', membership.views.print_reminders,
             name='print_reminders'),
 
@@ -160,17 +160,17 @@ urlpatterns = [
         {'queryset': payments,
          'template_name': 'membership/payment_list.html',
          'context_object_name': 'payment_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='payment_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='payment_list'),
     url(r'payments/unknown/$', membership.views.billing_object_list,
         {'queryset': payments.filter(billingcycle=None, ignore=False),
          'template_name': 'membership/payment_list.html',
          'context_object_name': 'payment_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='unknown_payment_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='unknown_payment_list'),
     url(r'payments/ignored/$', membership.views.billing_object_list,
         {'queryset': payments.filter(ignore=True),
          'template_name': 'membership/payment_list.html',
          'context_object_name': 'payment_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='ignored_payment_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset': True}, name='ignored_payment_list'),
 ]
 
 urlpatterns += [
@@ -71,6 +71,21 @@ def log_change(object, user, before=None, after=None, change_message=None):
         change_message  = change_message
     )
 
+def bulk_log_change(objects, user, change_message):
+    """Writes the same change log entry for many objects with one insert"""
+    if not objects:
+        return
+    from django.contrib.admin.models import LogEntry, CHANGE
+    content_type_id = ContentType.objects.get_for_model(objects[0]).pk
+    LogEntry.objects.bulk_create([
+        LogEntry(user_id         = user.pk,
+                 content_type_id = content_type_id,
+                 object_id       = force_unicode(object.pk),
+                 object_repr     = force_unicode(object)[:200],
+                 action_flag     = CHANGE,
+                 change_message  = change_message)
+        for object in objects])
+
 def change_message_to_list(row):
     """Convert humanized diffs to a list for usage in template"""
     retval = []
@@ -4,35 +4,40 @@ import logging
 import json
 from django.conf import settings
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.template.loader import render_to_string
 from django.db.models.aggregates import Sum
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required
-from django.core.mail import send_mail
+from django.core.mail import send_mail, EmailMessage
 from django.db import transaction
 from django.forms import ChoiceField, ModelForm, Form, EmailField, BooleanField
-from django.forms import ModelChoiceField, CharField, Textarea, HiddenInput, FileField
+from django.forms import ModelChoiceField, CharField, Textarea, HiddenInput, FileField, IntegerField
+from django.forms import ValidationError
 from django.forms.models import model_to_dict
-from django.http import HttpResponse, HttpResponseForbidden, HttpResponseServerError
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, \
+    HttpResponseServerError, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.html import escape
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic.list import ListView
-from services.models import Alias, Service, ServiceType
+from services.models import Alias, provision_services
 
 from membership.templatetags.sorturl import lookup_sort
+from membership.pagination import InvalidCursor, KeysetNotSupported, KeysetPaginator
+from membership.payment_matching import payment_candidates
 from membership.decorators import trusted_host_required
 from membership.forms import PersonApplicationForm, OrganizationApplicationForm, PersonContactForm, ServiceForm, \
     ContactForm
 from membership.utils import log_change, serializable_membership_info, admtool_membership_details, \
     get_client_ip, bake_log_entries
-from membership.public_memberlist import public_memberlist_data
+from membership.public_memberlist import public_memberlist_data, public_memberlist_xml
 from membership.unpaid_members import unpaid_members_data, members_to_lock
-from membership.management.commands.csvbills import process_op_csv, process_procountor_csv
+from membership.statistics import statistics_series
 from membership.models import Contact, Membership, MEMBER_TYPES_DICT, Bill, BillingCycle, Payment, ApplicationPoll, \
-    MembershipAlreadyStatus
+    MembershipAlreadyStatus, QueuedEmail, PaymentImportJob
 from services.views import check_alias_availability, validate_alias
 
 logger = logging.getLogger("membership.views")
@@ -43,11 +48,17 @@ ENTRIES_PER_PAGE = settings.ENTRIES_PER_PAGE
 
 
 class SortListView(ListView):
-    """ListView with search query parameter"""
+    """ListView with search query parameter
+
+    With keyset=True the list is paginated with after/before cursors instead
+    of page numbers, unless a page number is requested or the sort order can
+    not be used as a keyset.
+    """
     search_query = ''
     sort = None
     header = ''
     disable_duplicates_header = ''
+    keyset = False
 
     def get_context_data(self, **kwargs):
         context = super(SortListView, self).get_context_data(**kwargs)
@@ -56,6 +67,21 @@ class SortListView(ListView):
         context['disable_duplicates_header'] = self.disable_duplicates_header
         return context
 
+    def paginate_queryset(self, queryset, page_size):
+        if self.keyset and 'page' not in self.request.GET:
+            try:
+                paginator = KeysetPaginator(queryset, page_size)
+            except KeysetNotSupported as e:
+                logger.debug("Offset pagination: %s" % e)
+            else:
+                try:
+                    page = paginator.page(after=self.request.GET.get('after'),
+                                          before=self.request.GET.get('before'))
+                except InvalidCursor:
+                    raise Http404(_("Invalid page"))
+                return (paginator, page, page.object_list, page.has_other_pages())
+        return super(SortListView, self).paginate_queryset(queryset, page_size)
+
     def get_queryset(self):
         qs = super(SortListView, self).get_queryset()
         ordering = lookup_sort(self.request.GET.get('sort'))
@@ -115,38 +141,14 @@ def person_application(request, template_name='membership/new_person_application
                 membership.save()
 
                 # Service handling
-                services = []
-
-                login_alias = Alias(owner=membership, name=f['unix_login'], account=True)
-                login_alias.save()
-                unix_account_service = Service(servicetype=ServiceType.objects.get(servicetype='UNIX account'),
-                                               alias=login_alias, owner=membership, data=f['unix_login'])
-                unix_account_service.save()
-                services.append(unix_account_service)
-
+                email_forward = None
                 if f['email_forward'] != 'no' and f['email_forward'] != f['unix_login']:
-                    forward_alias = Alias(owner=membership, name=f['email_forward'])
-                    forward_alias.save()
-                    forward_alias_service = Service(servicetype=ServiceType.objects.get(servicetype='Email alias'),
-                                                    alias=forward_alias, owner=membership, data=f['unix_login'])
-                    forward_alias_service.save()
-                    services.append(forward_alias_service)
-
-                if f['mysql_database'] == True:
-                    mysql_service = Service(servicetype=ServiceType.objects.get(servicetype='MySQL database'),
-                                            alias=login_alias, owner=membership, data=f['unix_login'].replace('-', '_'))
-                    mysql_service.save()
-                    services.append(mysql_service)
-                if f['postgresql_database'] == True:
-                    postgresql_service = Service(servicetype=ServiceType.objects.get(servicetype='PostgreSQL database'),
-                                                 alias=login_alias, owner=membership, data=f['unix_login'])
-                    postgresql_service.save()
-                    services.append(postgresql_service)
-                if f['login_vhost'] == True:
-                    login_vhost_service = Service(servicetype=ServiceType.objects.get(servicetype='WWW vhost'),
-                                                  alias=login_alias, owner=membership, data=f['unix_login'])
-                    login_vhost_service.save()
-                    services.append(login_vhost_service)
+                    email_forward = f['email_forward']
+                services = provision_services(membership, f['unix_login'],
+                                              email_forward=email_forward,
+                                              mysql_database=f['mysql_database'] == True,
+                                              postgresql_database=f['postgresql_database'] == True,
+                                              login_vhost=f['login_vhost'] == True)
 
                 logger.debug("Attempting to save with the following services: %s." % ", ".join((str(service) for service in services)))
                 # End of services
@@ -160,7 +162,8 @@ def person_application(request, template_name='membership/new_person_application
                     pollanswer.save()
 
                 logger.info("New application {person} from {ip}:.".format(person=person, ip=get_client_ip(request)))
-                send_mail(_('Membership application received'),
+                QueuedEmail.enqueue(EmailMessage(
+                          _('Membership application received'),
                           render_to_string('membership/application_confirmation.txt',
                                            { 'membership': membership,
                                              'membership_type': MEMBER_TYPES_DICT[membership.type],
@@ -170,7 +173,7 @@ def person_application(request, template_name='membership/new_person_application
                                              'ip': get_client_ip(request),
                                              'services': services}),
                           settings.FROM_EMAIL,
-                          [membership.email_to()], fail_silently=False)
+                          [membership.email_to()]))
                 return redirect('new_person_application_success')
 
     return render(request, template_name,
@@ -350,34 +353,14 @@ def organization_application_save(request):
 
         membership.save()
 
-        services = []
         services_request = request.session['services']
-        login_alias = Alias(owner=membership, name=services_request['unix_login'], account=True)
-        login_alias.save()
-        unix_account_service = Service(servicetype=ServiceType.objects.get(servicetype='UNIX account'),
-                                       alias=login_alias, owner=membership, data=services_request['unix_login'])
-        unix_account_service.save()
-        services.append(unix_account_service)
-        if 'mysql_database' in services_request:
-            mysql_service = Service(servicetype=ServiceType.objects.get(servicetype='MySQL database'),
-                                    alias=login_alias, owner=membership,
-                                    data=services_request['mysql_database'].replace('-', '_'))
-            mysql_service.save()
-            services.append(mysql_service)
-        if 'postgresql_database' in services_request:
-            postgresql_service = Service(servicetype=ServiceType.objects.get(servicetype='PostgreSQL database'),
-                                         alias=login_alias, owner=membership,
-                                         data=services_request['postgresql_database'])
-            postgresql_service.save()
-            services.append(postgresql_service)
-        if 'login_vhost' in services_request:
-            login_vhost_service = Service(servicetype=ServiceType.objects.get(servicetype='WWW vhost'),
-                                          alias=login_alias, owner=membership,
-                                          data=services_request['login_vhost'])
-            login_vhost_service.save()
-            services.append(login_vhost_service)
-
-        send_mail(_('Membership application received'),
+        services = provision_services(membership, services_request['unix_login'],
+                                      mysql_database='mysql_database' in services_request,
+                                      postgresql_database='postgresql_database' in services_request,
+                                      login_vhost='login_vhost' in services_request)
+
+        QueuedEmail.enqueue(EmailMessage(
+                  _('Membership application received'),
                   render_to_string('membership/application_confirmation.txt',
                                    { 'membership': membership,
                                      'membership_type': MEMBER_TYPES_DICT[membership.type],
@@ -387,7 +370,7 @@ def organization_application_save(request):
                                      'ip': get_client_ip(request),
                                      'services': services}),
                   settings.FROM_EMAIL,
-                  [membership.email_to()], fail_silently=False)
+                  [membership.email_to()]))
 
         logger.info("New application {organization} from {ip}:.".format(organization=organization, ip=get_client_ip(request)))
         request.session.set_expiry(0)  # make this expire when the browser exits
@@ -515,19 +498,28 @@ def bill_pdf(request, bill_id):
     return response
 
 
+def _candidate_page(request):
+    try:
+        return max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return 1
+
+
 @permission_required('membership.manage_bills')
 def billingcycle_connect_payment(request, id, template_name='membership/billingcycle_connect_payment.html'):
     billingcycle = get_object_or_404(BillingCycle, id=id)
 
-    class SpeciallyLabeledModelChoiceField(ModelChoiceField):
-        def label_from_instance(self, obj):
-            return u"%s, %s, %s, %s" % (obj.payer_name, obj.reference_number, obj.amount, obj.payment_day)
-
     class PaymentForm(Form):
-        qs = Payment.objects.filter(billingcycle__exact=None, ignore=False).order_by("payer_name")
-        payment = SpeciallyLabeledModelChoiceField(queryset=qs,
-                                                   empty_label=_("None chosen"), required=True)
+        # Candidates are looked up with billingcycle_payment_candidates_json,
+        # only the chosen payment is validated here
+        payment = IntegerField(required=True)
 
+        def clean_payment(self):
+            try:
+                return Payment.objects.get(id=self.cleaned_data['payment'],
+                                           billingcycle__exact=None, ignore=False)
+            except Payment.DoesNotExist:
+                raise ValidationError(_("Choose an unattached payment."))
 
     if request.method == 'POST':
         form = PaymentForm(request.POST)
@@ -555,14 +547,41 @@ def billingcycle_connect_payment(request, id, template_name='membership/billingc
             messages.error(request, unicode(_("Changes to BillingCycle %s not saved.") % billingcycle))
     else:
         form =  PaymentForm()
+    query = request.GET.get('q', u'')
+    page = _candidate_page(request)
+    candidates, has_next = payment_candidates(billingcycle, query=query, page=page)
     logentries = bake_log_entries(billingcycle.logs.all())
     return render(request, template_name,
-                  {'form': form, 'cycle': billingcycle, 'logentries': logentries})
+                  {'form': form, 'cycle': billingcycle, 'logentries': logentries,
+                   'candidates': candidates, 'query': query, 'page': page, 'has_next': has_next})
+
+
+@permission_required('membership.manage_bills')
+def billingcycle_payment_candidates_json(request, id):
+    billingcycle = get_object_or_404(BillingCycle, id=id)
+    page = _candidate_page(request)
+    candidates, has_next = payment_candidates(billingcycle, query=request.GET.get('q', u''), page=page)
+    json_obj = {
+        'page': page,
+        'has_next': has_next,
+        'has_previous': page > 1,
+        'candidates': [{
+            'id': c.payment.id,
+            'payer_name': c.payment.payer_name,
+            'reference_number': c.payment.reference_number,
+            'message': c.payment.message,
+            'amount': unicode(c.payment.amount),
+            'payment_day': c.payment.payment_day.date().isoformat(),
+            'score': float(c.score),
+            'reasons': c.reasons,
+        } for c in candidates],
+    }
+    return HttpResponse(json.dumps(json_obj, sort_keys=True),
+                        content_type='application/json')
 
 
 @permission_required('membership.can_import_payments')
 def import_payments(request, template_name='membership/import_payments.html'):
-    import_messages = []
     class PaymentCSVForm(Form):
         csv = FileField(label=_('CSV File'),
                          help_text=_('Choose CSV file to upload'))
@@ -572,27 +591,41 @@ def import_payments(request, template_name='membership/import_payments.html'):
     if request.method == 'POST':
         form = PaymentCSVForm(request.POST, request.FILES)
         if form.is_valid():
-            try:
-                in_memory_file = request.FILES['csv']
-                logger.info("Beginning payment import.")
-                if form.cleaned_data['format'] == 'op':
-                    import_messages = process_op_csv(in_memory_file, user=request.user)
-                elif form.cleaned_data['format'] == 'procountor':
-                    import_messages = process_procountor_csv(in_memory_file, user=request.user)
-                messages.success(request, unicode(_("Payment import succeeded!")))
-            except:
-                  logger.error("%s" % traceback.format_exc())
-                  logger.error("Payment CSV import failed.")
-                  messages.error(request, unicode(_("Payment import failed.")))
+            # The file is processed by the process_payment_imports command
+            upload = request.FILES['csv']
+            job = PaymentImportJob(filename=upload.name[:255], format=form.cleaned_data['format'],
+                                   user=request.user)
+            job.csv_file.save(upload.name, upload, save=False)
+            job.save()
+            logger.info("Payment import %s queued." % job.id)
+            messages.success(request, unicode(_("Payment file queued for import.")))
+            return redirect('payment_import_job', job.id)
         else:
             messages.error(request, unicode(_("Payment import failed.")))
     else:
         form = PaymentCSVForm()
 
+    jobs = PaymentImportJob.objects.select_related('user').order_by('-created', '-id')[:10]
     return render(request, template_name,
                   {'title': _("Import payments"),
                    'form': form,
-                   'import_messages': import_messages})
+                   'jobs': jobs})
+
+
+@permission_required('membership.can_import_payments')
+def payment_import_job(request, id, template_name='membership/payment_import_job.html'):
+    job = get_object_or_404(PaymentImportJob, id=id)
+    return render(request, template_name,
+                  {'title': _("Import payments"),
+                   'job': job,
+                   'import_messages': job.import_messages()})
+
+
+@permission_required('membership.can_import_payments')
+def payment_import_job_json(request, id):
+    job = get_object_or_404(PaymentImportJob, id=id)
+    return HttpResponse(json.dumps(job.progress(), sort_keys=True),
+                        content_type='application/json')
 
 
 @permission_required('membership.read_bills')
@@ -780,7 +813,8 @@ def send_duplicate_notification(request, payment, **kwargs):
 
 @permission_required('membership.read_members')
 def membership_edit(request, id, template_name='membership/membership_edit.html'):
-    membership = get_object_or_404(Membership, id=id)
+    membership = get_object_or_404(Membership.objects.select_related(
+        'person', 'billing_contact', 'tech_contact', 'organization'), id=id)
 
     class Form(ModelForm):
         class Meta:
@@ -817,10 +851,12 @@ def membership_edit(request, id, template_name='membership/membership_edit.html'
     else:
         form = Form(instance=membership)
         form.disable_fields()
-    # Pretty print log entries for template
-    logentries = bake_log_entries(membership.logs.all())
+    # Archived billing history is only read when asked for
+    show_archived = bool(request.GET.get('archived'))
+    dossier = membership.dossier(include_archived=show_archived)
     return render(request, template_name,
-                  {'form': form, 'membership': membership, 'logentries': logentries})
+                  {'form': form, 'membership': membership, 'dossier': dossier,
+                   'logentries': dossier['logentries'], 'show_archived': show_archived})
 
 
 @permission_required('membership.read_members')
@@ -851,12 +887,7 @@ def unpaid_paper_reminded(request):
 
 @permission_required('membership.read_members')
 def unpaid_paper_reminded_plain(request):
-    view_params = {'queryset': Membership.paper_reminder_sent_unpaid_after().order_by('id'),
-                   'template_name': 'membership/membership_list_plaintext.html',
-                   'context_object_name': 'member_list'
-                   }
-
-    return member_object_list(request, **view_params)
+    return member_list_plaintext(request, Membership.paper_reminder_sent_unpaid_after().order_by('id'))
 
 
 @permission_required('membership.delete_members')
@@ -993,6 +1024,36 @@ def membership_approve_json(request, id):
     return HttpResponse(id, content_type='text/plain')
 
 
+def _bulk_status_json(ids, change_status):
+    results = {}
+    valid_ids = []
+    for id in ids:
+        try:
+            valid_ids.append(int(id))
+        except (TypeError, ValueError):
+            results[unicode(id)] = 'invalid_id'
+    if valid_ids:
+        for id, result in change_status(valid_ids).items():
+            results[unicode(id)] = result
+    return HttpResponse(json.dumps({'results': results}, sort_keys=True),
+                        content_type='application/json')
+
+
+@permission_required('membership.manage_members')
+def membership_bulk_preapprove_json(request, ids):
+    return _bulk_status_json(ids, lambda ids: Membership.bulk_preapprove(ids, request.user))
+
+
+@permission_required('membership.manage_members')
+def membership_bulk_approve_json(request, ids):
+    return _bulk_status_json(ids, lambda ids: Membership.bulk_approve(ids, request.user))
+
+
+@permission_required('membership.manage_members')
+def membership_bulk_dissociate_json(request, ids):
+    return _bulk_status_json(ids, lambda ids: Membership.bulk_dissociate(ids, request.user)[0])
+
+
 @permission_required('membership.read_members')
 def membership_detail_json(request, id):
     membership = get_object_or_404(Membership, id=id)
@@ -1007,6 +1068,9 @@ def handle_json(request):
     msg = json.loads(request.body)
     funcs = {'PREAPPROVE': membership_preapprove_json,
              'APPROVE': membership_approve_json,
+             'BULK_PREAPPROVE': membership_bulk_preapprove_json,
+             'BULK_APPROVE': membership_bulk_approve_json,
+             'BULK_DISSOCIATE': membership_bulk_dissociate_json,
              'MEMBERSHIP_DETAIL': membership_detail_json,
              'ALIAS_AVAILABLE': check_alias_availability,
              'VALIDATE_ALIAS': validate_alias}
@@ -1064,11 +1128,30 @@ def membership_metrics(request):
                         content_type='application/json')
 
 
+@trusted_host_required
+def membership_metrics_history(request):
+    """
+    Time series of the daily statistics rollup. Optional GET parameters
+    are name (repeatable) and start and end as YYYY-MM-DD, by default the
+    last 365 days.
+    """
+    try:
+        start = request.GET.get('start')
+        start = (datetime.strptime(start, '%Y-%m-%d').date() if start
+                 else datetime.now().date() - timedelta(days=365))
+        end = request.GET.get('end')
+        end = datetime.strptime(end, '%Y-%m-%d').date() if end else None
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be given as YYYY-MM-DD")
+    series = statistics_series(request.GET.getlist('name'), start, end)
+    return HttpResponse(json.dumps(series, sort_keys=True, indent=4),
+                        content_type='application/json')
+
+
 @trusted_host_required
 def public_memberlist(request):
-    template_name = 'membership/public_memberlist.xml'
     data = public_memberlist_data()
-    return render(request, template_name, data, content_type='text/xml')
+    return StreamingHttpResponse(public_memberlist_xml(data), content_type='text/xml')
 
 
 @trusted_host_required
@@ -1108,6 +1191,69 @@ def member_object_list(request, **kwargs):
     return SortListView.as_view(**kwargs)(request)
 
 
+# Columns needed for Membership.name()
+MEMBER_NAME_FIELDS = ('id', 'organization_id', 'organization__organization_name',
+                      'organization__first_name', 'organization__last_name',
+                      'person_id', 'person__organization_name',
+                      'person__first_name', 'person__last_name')
+
+
+def _member_name(row):
+    """Membership.name() of a MEMBER_NAME_FIELDS values_list row"""
+    (membership_id, organization_id, organization_name, organization_first_name,
+     organization_last_name, person_id, person_organization_name,
+     person_first_name, person_last_name) = row
+    if organization_id:
+        contact = (organization_name, organization_first_name, organization_last_name)
+    elif person_id:
+        contact = (person_organization_name, person_first_name, person_last_name)
+    else:
+        return u"#%d" % membership_id
+    if contact[0]:
+        return contact[0]
+    return u'%s %s' % contact[1:]
+
+
+def _plaintext_rows(queryset):
+    """
+    Lines of "id name" separated by commas, the last two joined with
+    "ja". Two rows are read ahead to know where the list ends.
+    """
+    def line(row, separator):
+        return u"%d %s%s\n" % (row[0], escape(_member_name(row)), separator)
+
+    yield u"<pre>\n"
+    pending = []
+    for row in queryset.values_list(*MEMBER_NAME_FIELDS).iterator():
+        pending.append(row)
+        if len(pending) == 3:
+            yield line(pending.pop(0), u",")
+    if len(pending) == 2:
+        yield line(pending.pop(0), u" ja ")
+    if pending:
+        yield line(pending[0], u".")
+    yield u"</pre>"
+
+
+@permission_required('membership.read_members')
+def member_list_plaintext(request, queryset):
+    """Memberships as a plain list, streamed without loading all rows"""
+    return StreamingHttpResponse(_plaintext_rows(queryset))
+
+
+def _email_rows(queryset):
+    for person_email, organization_email in queryset.values_list(
+            'person__email', 'organization__email').iterator():
+        yield u"%s\n" % escape(organization_email or person_email)
+
+
+@permission_required('membership.read_members')
+def member_list_emails(request, queryset):
+    """Email addresses of memberships one per line, the organization
+    address when there is one"""
+    return StreamingHttpResponse(_email_rows(queryset))
+
+
 @permission_required('membership.read_bills')
 def billing_object_list(request, **kwargs):
     return SortListView.as_view(**kwargs)(request)
@@ -2,6 +2,7 @@ import logging
 logger = logging.getLogger("services.models")
 
 from datetime import datetime
+import time
 import unicodedata
 
 from django.contrib.contenttypes.models import ContentType
@@ -181,6 +182,92 @@ class Alias(models.Model):
     def __unicode__(self):
         return self.name
 
+# Service types are created by a data migration and practically never change,
+# so they are resolved by name from a process-wide cache.
+_servicetype_cache = {}
+# Changes made by other processes are seen after at most this many seconds
+SERVICETYPE_CACHE_SECONDS = 60
+_servicetype_cache_expires = [0]
+
+def get_servicetype(name):
+    '''Returns the ServiceType called name from the cache, loading all
+    service types with a single query on a miss. Changes are seen at once
+    in the process that made them and within SERVICETYPE_CACHE_SECONDS
+    in other processes.'''
+    if time.time() >= _servicetype_cache_expires[0]:
+        clear_servicetype_cache()
+    try:
+        return _servicetype_cache[name]
+    except KeyError:
+        pass
+    _servicetype_cache.clear()
+    for servicetype in ServiceType.objects.all():
+        _servicetype_cache[servicetype.servicetype] = servicetype
+    _servicetype_cache_expires[0] = time.time() + SERVICETYPE_CACHE_SECONDS
+    try:
+        return _servicetype_cache[name]
+    except KeyError:
+        raise ServiceType.DoesNotExist("Service type '%s' does not exist" % name)
+
+def clear_servicetype_cache(*args, **kwargs):
+    _servicetype_cache.clear()
+    _servicetype_cache_expires[0] = 0
+
+def provision_services(membership, unix_login, email_forward=None,
+                       mysql_database=False, postgresql_database=False,
+                       login_vhost=False):
+    '''Creates the aliases and services of a new membership application.
+
+    Aliases and services are inserted with one bulk insert each and the
+    alias name uniqueness is checked with one query for all names. Returns
+    the list of created services in the order they were requested.'''
+    login_alias = Alias(owner=membership, name=unix_login, account=True)
+    aliases = [login_alias]
+    forward_alias = None
+    if email_forward:
+        forward_alias = Alias(owner=membership, name=email_forward)
+        aliases.append(forward_alias)
+
+    for alias in aliases:
+        # Owner was just saved and uniqueness is checked below for all
+        # aliases at once
+        alias.full_clean(exclude=['owner'], validate_unique=False)
+    names = [alias.name for alias in aliases]
+    taken = list(Alias.objects.filter(name__in=names).values_list('name', flat=True))
+    if taken:
+        raise ValidationError({'name': [_('Alias with this name already exists: %s') % ", ".join(taken)]})
+
+    Alias.objects.bulk_create(aliases)
+    if login_alias.pk is None:
+        # Only some databases return primary keys from bulk inserts
+        created = dict((alias.name, alias) for alias in
+                       Alias.objects.filter(owner=membership, name__in=names))
+        login_alias = created[login_alias.name]
+        if forward_alias:
+            forward_alias = created[forward_alias.name]
+    for alias in aliases:
+        logging_log_change(Alias, alias, True)
+
+    services = [Service(servicetype=get_servicetype('UNIX account'),
+                        alias=login_alias, owner=membership, data=unix_login)]
+    if forward_alias:
+        services.append(Service(servicetype=get_servicetype('Email alias'),
+                                alias=forward_alias, owner=membership, data=unix_login))
+    if mysql_database:
+        services.append(Service(servicetype=get_servicetype('MySQL database'),
+                                alias=login_alias, owner=membership,
+                                data=unix_login.replace('-', '_')))
+    if postgresql_database:
+        services.append(Service(servicetype=get_servicetype('PostgreSQL database'),
+                                alias=login_alias, owner=membership, data=unix_login))
+    if login_vhost:
+        services.append(Service(servicetype=get_servicetype('WWW vhost'),
+                                alias=login_alias, owner=membership, data=unix_login))
+    Service.objects.bulk_create(services)
+    for service in services:
+        logging_log_change(Service, service, True)
+    return services
+
 def valid_aliases(owner):
     '''Builds a queryset of all valid aliases'''
     no_expire = Q(expiration_date=None)
@@ -190,3 +277,5 @@ def valid_aliases(owner):
 
 models.signals.post_save.connect(logging_log_change, sender=Alias)
 models.signals.post_save.connect(logging_log_change, sender=Service)
+models.signals.post_save.connect(clear_servicetype_cache, sender=ServiceType)
+models.signals.post_delete.connect(clear_servicetype_cache, sender=ServiceType)
@@ -1,7 +1,11 @@
 from __future__ import with_statement
 
 from contextlib import contextmanager
+from datetime import datetime
 from fcntl import flock, LOCK_EX, LOCK_UN
+import os
+import threading
+import time
 
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
@@ -22,25 +26,66 @@ def file_lock(file_handle):
         flock(file_handle, LOCK_UN)
 
 
+# Django creates a new backend for every get_connection(), so the open mbox
+# files are shared by all backend instances of the process.
+_files = {}
+_files_lock = threading.Lock()
+
+# With EMAIL_MBOX_ROTATE every process (e.g. one makebills run) writes to
+# its own file
+_run_suffix = "%s.%d" % (datetime.now().strftime("%Y%m%d-%H%M%S"), os.getpid())
+
+
+def mbox_file_path():
+    file_path = getattr(settings, 'EMAIL_MBOX_FILE_PATH', None)
+    if getattr(settings, 'EMAIL_MBOX_ROTATE', False):
+        file_path = "%s.%s" % (file_path, _run_suffix)
+    return file_path
+
+
+def _get_file(file_path):
+    """Returns an append mode handle for file_path, reopening it if the file
+    has been moved away (e.g. by logrotate). Call with _files_lock held."""
+    f = _files.get(file_path)
+    if f is not None:
+        try:
+            if os.stat(file_path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except OSError:
+            pass
+        f.close()
+    f = open(file_path, 'ab')
+    _files[file_path] = f
+    return f
+
+
+def close_files():
+    with _files_lock:
+        for f in _files.values():
+            f.close()
+        _files.clear()
+
+
 class EmailBackend(BaseEmailBackend):
 
     def __init__(self, *args, **kwargs):
-        self.file_path = getattr(settings, 'EMAIL_MBOX_FILE_PATH', None)
-        with open(self.file_path, 'a') as f:
-            with file_lock(f):
-                f.write('')
+        self.file_path = mbox_file_path()
         super(EmailBackend, self).__init__(*args, **kwargs)
 
     def send_messages(self, email_messages):
         if not email_messages:
             return
         try:
-            with open(self.file_path, 'a') as f:
+            # Serialize everything before taking the lock so that it is only
+            # held for a single write
+            from_line = "From sikteeri %s\n" % time.asctime()
+            data = "".join(from_line + message.message().as_string() + '\n\n'
+                           for message in email_messages)
+            with _files_lock:
+                f = _get_file(self.file_path)
                 with file_lock(f):
-                    for message in email_messages:
-                        f.write("From sikteeri Mon Mar 23 08:36:59 2009\n")
-                        f.write(message.message().as_string())
-                        f.write('\n\n')
+                    f.write(data)
+                    f.flush()
         except:
             if not self.fail_silently:
                 raise
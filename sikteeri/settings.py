@@ -122,6 +122,9 @@ BUSINESS_ID = get_required("BUSINESS_ID")
 
 FONT_PATH = os.path.join(BASE_DIR, 'external/fonts')
 IMG_PATH = os.path.join(BASE_DIR, 'external/img')
+# Load ReportLab and the fonts when the WSGI application is created, so that
+# a pre-forking server (e.g. gunicorn --preload) shares them with its workers
+PDF_WARM_UP = config.get('PDF_WARM_UP', False)
 
 # When PRODUCTION is true, show production graphics and colours.
 # Otherwise indicate that this is a development environment (logo, colour)
@@ -316,6 +319,8 @@ LOGGING = {
 
 EMAIL_SUBJECT_PREFIX = get_required('EMAIL_SUBJECT_PREFIX')
 EMAIL_MBOX_FILE_PATH = config.get('EMAIL_MBOX_FILE_PATH', None)
+# Write each process run into its own mbox file
+EMAIL_MBOX_ROTATE = config.get('EMAIL_MBOX_ROTATE', False)
 
 if EMAIL_MBOX_FILE_PATH:
     logger.info("Emails redirected to {0}".format(EMAIL_MBOX_FILE_PATH))
@@ -12,3 +12,8 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sikteeri.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+from django.conf import settings
+if settings.PDF_WARM_UP:
+    from membership.billing.pdf_utils import warm_up
+    warm_up()